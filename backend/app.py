@@ -1,21 +1,38 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 import pandas as pd
 import os
 import urllib.parse
 import json
 import requests
+from requests.adapters import HTTPAdapter
 from sqlalchemy import create_engine
 from sqlalchemy import inspect
 from sqlalchemy import text
+from sqlalchemy import bindparam, and_, or_, select, MetaData, Table
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 import numpy as np
 import hashlib
+import zlib
 import jwt
 import datetime
-from functools import wraps
+import threading
+import time
+import uuid
+import random
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from functools import wraps, lru_cache
 
 # 导入处理docx文件的库
 from docx import Document
+# 案件表快照使用Arrow IPC文件，未安装pyarrow时只从MySQL读取
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as pa_ipc
+except ImportError:
+    pa = None
 
 # JWT配置
 SECRET_KEY = 'your-secret-key-for-jwt-token'
@@ -99,13 +116,14 @@ DB_NAME = 'case_analysis'
 DB_HOST = 'localhost'
 DB_PORT = '3306'
 
-# 创建数据库引擎
+# 创建数据库引擎：设置环境变量 DATABASE_URL 时连接该数据库（如基准测试使用的临时数据库），否则连接上面配置的MySQL
 encoded_password = urllib.parse.quote_plus(DB_PASSWORD)
-engine = create_engine(f'mysql+pymysql://{DB_USER}:{encoded_password}@{DB_HOST}:{DB_PORT}/{DB_NAME}')
+engine = create_engine(os.environ.get('DATABASE_URL') or f'mysql+pymysql://{DB_USER}:{encoded_password}@{DB_HOST}:{DB_PORT}/{DB_NAME}')
 
 # 导入用户表模型
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, DateTime, Text
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Text, LargeBinary, Float
+from sqlalchemy.types import Integer as SQLInteger, String as SQLString, DateTime as SQLDateTime
 from sqlalchemy.sql import func
 from sqlalchemy.orm import sessionmaker
 
@@ -165,12 +183,452 @@ class Article(Base):
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     published_at = Column(DateTime(timezone=True))
 
+# 考核方案模型：每个考核单位的目标部门、过滤规则、权重和排名规则
+class AssessmentProfile(Base):
+    __tablename__ = 'assessment_profiles'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String(100), unique=True, nullable=False)  # 考核单位名称，对应 /api/assess 的 department 参数
+    targets = Column(Text, nullable=False)  # 目标处置部门列表（JSON数组）
+    filters = Column(Text)  # 过滤规则（JSON），如 {"exclude_stage_keywords": ["挂账"]}
+    weights = Column(Text)  # 得分权重（JSON），未配置的项使用默认权重
+    ranking = Column(String(50), default='score_desc')  # 排名规则：指标_desc 或 指标_asc
+    enabled = Column(Integer, nullable=False, default=1)
+    order = Column(Integer, default=0)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+# 案件数据表上传代次模型（每次上传或删除数据表时递增，用于跨进程的缓存失效；导入地名库时递增 address_gazetteer 的代次）
+class CaseTableGeneration(Base):
+    __tablename__ = 'case_table_generations'
+    
+    table_name = Column(String(255), primary_key=True)
+    generation = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+# 案件数据表字段类型映射模型（上传时识别的字段类型）
+class CaseTableSchema(Base):
+    __tablename__ = 'case_table_schemas'
+    
+    table_name = Column(String(255), primary_key=True)
+    column_mapping = Column(Text, nullable=False)  # 字段 -> 类型信息（JSON）
+    row_count = Column(Integer, default=0)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+# 大模型回复缓存模型（按模型、提示词和参数的哈希寻址）
+class LLMResponseCache(Base):
+    __tablename__ = 'llm_response_cache'
+    
+    cache_key = Column(String(64), primary_key=True)  # sha256
+    model = Column(String(100), nullable=False)
+    response = Column(Text(length=4294967295), nullable=False)
+    created_at = Column(DateTime, nullable=False, index=True)
+    accessed_at = Column(DateTime, nullable=False, index=True)
+
+# 跨月份重复案件索引模型：规范化文本去重后保存MinHash签名，LSH桶和各数据表中的出现次数分表保存
+class DuplicateText(Base):
+    __tablename__ = 'duplicate_texts'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    text_hash = Column(String(40), unique=True, nullable=False)  # 规范化文本的sha1
+    problem = Column(Text)
+    address = Column(Text)
+    signature = Column(LargeBinary, nullable=False)  # MinHash签名（uint32数组）
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class DuplicateBucket(Base):
+    __tablename__ = 'duplicate_buckets'
+    
+    band = Column(Integer, primary_key=True, autoincrement=False)
+    bucket_key = Column(BigInteger, primary_key=True, autoincrement=False)
+    text_id = Column(Integer, primary_key=True, autoincrement=False, index=True)
+
+class DuplicateOccurrence(Base):
+    __tablename__ = 'duplicate_occurrences'
+    
+    table_name = Column(String(255), primary_key=True)
+    text_id = Column(Integer, primary_key=True, autoincrement=False, index=True)
+    case_count = Column(Integer, nullable=False)
+    row_ids = Column(Text)  # 部分案件行号（JSON）
+
+# 地址缓存模型：每个原始地址只规范化、匹配坐标一次
+class AddressCache(Base):
+    __tablename__ = 'address_cache'
+    
+    address_hash = Column(String(40), primary_key=True)  # 原始地址的sha1
+    address = Column(Text, nullable=False)
+    normalized = Column(String(255), nullable=False)  # 规范化后的地址键
+    precise = Column(Integer, default=0)  # 是否为精准地址
+    longitude = Column(Float)
+    latitude = Column(Float)
+    version = Column(Integer, nullable=False)  # 规范化规则版本，规则变化后自动重新计算
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+# 地名库模型：规范化地址 -> 坐标，由管理员导入
+class AddressGazetteer(Base):
+    __tablename__ = 'address_gazetteer'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    normalized = Column(String(255), unique=True, nullable=False)
+    address = Column(Text, nullable=False)
+    longitude = Column(Float, nullable=False)
+    latitude = Column(Float, nullable=False)
+    street = Column(String(255))
+    community = Column(String(255))
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+# 案件数据立方体模型：上传后按常用维度组合预先聚合案件数和按期、超期、延期、返工数
+class CaseTableCube(Base):
+    __tablename__ = 'case_table_cubes'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    table_name = Column(String(255), nullable=False, index=True)
+    grouping_set = Column(String(50), nullable=False)  # 维度组合名称，见 CASE_CUBE_GROUPINGS
+    dim1 = Column(Text)
+    dim2 = Column(Text)
+    total = Column(Integer, nullable=False, default=0)
+    on_time = Column(Integer, nullable=False, default=0)
+    overdue = Column(Integer, nullable=False, default=0)
+    delay = Column(Integer, nullable=False, default=0)
+    rework = Column(Integer, nullable=False, default=0)
+    first_row = Column(Integer)  # 该维度值首次出现的行序号，用于还原 value_counts 中并列项的顺序
+
+class CaseTableCubeInfo(Base):
+    __tablename__ = 'case_table_cube_info'
+    
+    table_name = Column(String(255), primary_key=True)
+    generation = Column(Integer, nullable=False)  # 聚合时数据表的上传代次，与当前代次不一致时视为过期
+    row_count = Column(Integer, default=0)
+    columns = Column(Text)  # 字段列表（JSON）
+    sample_data = Column(Text(length=4294967295))  # 前5行样例数据（JSON）
+    fields = Column(Text)  # 各分析类型识别出的关键字段（JSON）
+    parse_stats = Column(Text)  # 时间字段的解析统计（JSON）
+    groupings = Column(Text)  # 已聚合的维度组合（JSON数组）
+    built_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+# 后台任务模型（耗时的分析、抽查请求异步执行，结果持久化）
+class BackgroundJob(Base):
+    __tablename__ = 'background_jobs'
+    
+    id = Column(String(36), primary_key=True)
+    job_type = Column(String(50), nullable=False)  # analyze / analyze_batch / spotcheck / duplicate_index / case_cube / upload_postprocess
+    status = Column(String(20), nullable=False, default='pending')  # pending / running / succeeded / failed
+    params = Column(Text)  # 任务参数（JSON）
+    result = Column(Text(length=4294967295))  # 任务结果（JSON，MySQL下为LONGTEXT）
+    error = Column(Text)
+    user_id = Column(Integer, index=True)
+    owner = Column(String(200))  # 执行任务的进程（主机:开机ID:进程号:启动ID）
+    heartbeat_at = Column(DateTime(timezone=True))  # 执行进程最近一次续约的时间，超过 JOB_LEASE_SECONDS 未续约视为进程已退出
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime(timezone=True))
+    finished_at = Column(DateTime(timezone=True))
+
 # 创建数据库表
 Base.metadata.create_all(engine)
 
+def ensure_background_job_columns():
+    """为旧版本创建的任务表补充 owner、heartbeat_at 字段（create_all 不会修改已存在的表）"""
+    columns = {col['name'] for col in inspect(engine).get_columns(BackgroundJob.__tablename__)}
+    with engine.begin() as conn:
+        if 'owner' not in columns:
+            conn.execute(text(f"ALTER TABLE {BackgroundJob.__tablename__} ADD COLUMN owner VARCHAR(200)"))
+        if 'heartbeat_at' not in columns:
+            conn.execute(text(f"ALTER TABLE {BackgroundJob.__tablename__} ADD COLUMN heartbeat_at DATETIME"))
+
+ensure_background_job_columns()
+
 # 创建会话工厂
 Session = sessionmaker(bind=engine)
 
+# 案件数据表缓存配置
+TABLE_CACHE_MAX_ENTRIES = 8  # 最多缓存的数据表个数
+TABLE_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 缓存内存预算（1GB）
+
+class TableCache:
+    """进程内的案件数据表缓存，按（表名, 上传代次）存放DataFrame，支持LRU和内存预算淘汰"""
+    
+    def __init__(self, max_entries=TABLE_CACHE_MAX_ENTRIES, max_bytes=TABLE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (DataFrame, 字节数)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            # 命中后移到队尾，表示最近使用
+            self._entries.move_to_end(key)
+            return entry[0]
+    
+    def put(self, key, df):
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        if size > self.max_bytes:
+            # 单表超过整个预算时不缓存，避免把其他表全部挤出
+            print(f"数据表 {key[0]} 占用 {size} 字节，超过缓存预算，不进行缓存")
+            return
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (df, size)
+            self._total_bytes += size
+            # 按LRU顺序淘汰，直到满足条目数和内存预算
+            while len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_size
+    
+    def invalidate(self, table_name):
+        """清除某个数据表的所有缓存条目（不论代次）"""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == table_name]:
+                self._total_bytes -= self._entries.pop(key)[1]
+
+table_cache = TableCache()
+
+def get_table_generation(table_name):
+    """读取数据表当前的上传代次，未记录过的表视为第0代"""
+    with engine.connect() as conn:
+        row = conn.execute(text("SELECT generation FROM case_table_generations WHERE table_name = :table_name"), {'table_name': table_name}).fetchone()
+    return row[0] if row else 0
+
+def bump_table_generation(table_name):
+    """数据表被上传替换或删除后递增代次，并清除本进程中该表的缓存"""
+    with engine.begin() as conn:
+        updated = conn.execute(text("UPDATE case_table_generations SET generation = generation + 1 WHERE table_name = :table_name"), {'table_name': table_name})
+        if updated.rowcount == 0:
+            conn.execute(text("INSERT INTO case_table_generations (table_name, generation) VALUES (:table_name, 1)"), {'table_name': table_name})
+    table_cache.invalidate(table_name)
+
+# 分析结果中返回的样例数据行数
+CASE_TABLE_SAMPLE_ROWS = 5
+# 不同取值较少的文本字段（处置部门、所属街道、小类名称等）在加载时转换为category类型
+CATEGORY_MAX_UNIQUE = 1000  # 不同取值数上限
+CATEGORY_MAX_UNIQUE_RATIO = 0.5  # 不同取值数占非空值数的比例上限
+
+def convert_category_columns(df):
+    """把低基数的文本字段转换为category类型：只保存一份取值和整数编码，内存占用小，计数和分组按编码进行"""
+    for col in df.columns:
+        values = df[col]
+        if isinstance(values.dtype, pd.CategoricalDtype) or not pd.api.types.is_string_dtype(values):
+            continue
+        non_null = int(values.notna().sum())
+        if non_null == 0:
+            continue
+        unique_count = values.nunique()
+        if unique_count <= CATEGORY_MAX_UNIQUE and unique_count <= non_null * CATEGORY_MAX_UNIQUE_RATIO:
+            df[col] = values.astype('category')
+    return df
+
+def top_value_counts(values, n=10):
+    """取出现次数最多的前n个取值，结果与 value_counts().head(n) 相同（数量降序，数量相同时先出现的在前）
+    
+    category字段直接按整数编码计数，只返回实际出现的取值
+    """
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        return values.value_counts().head(n)
+    codes = values.cat.codes.to_numpy()
+    codes = codes[codes >= 0]
+    present, first_rows = np.unique(codes, return_index=True)
+    counts = np.bincount(codes, minlength=len(values.cat.categories))[present]
+    order = np.lexsort((first_rows, -counts))[:n]
+    return pd.Series(counts[order], index=pd.Index(values.cat.categories[present[order]], name=values.name), name='count')
+
+def get_case_table_columns(table_name):
+    """从表结构读取案件表的数据字段（不含上传时添加的自增主键），按建表顺序排列"""
+    return [col['name'] for col in inspect(engine).get_columns(table_name) if col['name'] != CASE_TABLE_ROW_ID]
+
+def load_case_table(table_name, columns=None):
+    """读取案件数据表，同一代次的数据表只读取一次
+    
+    优先从上传后导出的快照文件读取，没有快照时从MySQL读取。
+    指定columns时只读取这些字段（案件表大多是长文本字段，分析只用到其中几个），
+    按（表名, 代次, 字段）单独缓存；整张表已在缓存中时直接从中取字段。
+    """
+    generation = get_table_generation(table_name)
+    if columns is None:
+        key = (table_name, generation)
+    else:
+        columns = list(dict.fromkeys(columns))
+        df = table_cache.get((table_name, generation))
+        if df is not None:
+            # 与从MySQL、快照读取时一致：忽略表中不存在的字段
+            return df[[col for col in columns if col in df.columns]]
+        key = (table_name, generation, tuple(columns))
+    
+    df = table_cache.get(key)
+    if df is None:
+        df = read_case_table_snapshot(table_name, generation, columns)
+        if df is None and columns is None:
+            df = pd.read_sql_table(table_name, engine)
+        elif df is None:
+            table_columns = [col['name'] for col in inspect(engine).get_columns(table_name)]
+            selected = [col for col in columns if col in table_columns]
+            if CASE_TABLE_ROW_ID in table_columns:
+                selected.insert(0, CASE_TABLE_ROW_ID)
+            if selected:
+                df = pd.read_sql_table(table_name, engine, columns=selected)
+            else:
+                # 没有需要读取的字段时只统计行数
+                with engine.connect() as conn:
+                    row_count = conn.execute(text(f"SELECT COUNT(*) FROM {quote_identifier(table_name)}")).scalar()
+                df = pd.DataFrame(index=pd.RangeIndex(row_count))
+        # 上传时添加的自增主键作为DataFrame的索引，不作为数据字段
+        if CASE_TABLE_ROW_ID in df.columns:
+            df = df.set_index(CASE_TABLE_ROW_ID)
+        df = convert_category_columns(df)
+        table_cache.put(key, df)
+    # 返回浅拷贝：调用方新增或替换列不会影响缓存中的DataFrame
+    return df.copy(deep=False)
+
+def load_case_table_head(table_name):
+    """读取数据表前几行的全部字段作为样例数据，按代次缓存"""
+    generation = get_table_generation(table_name)
+    key = (table_name, generation, 'head')
+    df = table_cache.get(key)
+    if df is None:
+        full = table_cache.get((table_name, generation))
+        if full is not None:
+            return full.head(CASE_TABLE_SAMPLE_ROWS)
+        table = Table(table_name, MetaData(), autoload_with=engine)
+        query = select(table)
+        if CASE_TABLE_ROW_ID in table.c:
+            query = query.order_by(table.c[CASE_TABLE_ROW_ID])
+        df = pd.read_sql(query.limit(CASE_TABLE_SAMPLE_ROWS), engine)
+        if CASE_TABLE_ROW_ID in df.columns:
+            df = df.set_index(CASE_TABLE_ROW_ID)
+        table_cache.put(key, df)
+    return df.copy(deep=False)
+
+# 案件表快照：上传后把数据表导出为Arrow IPC文件（按表名和上传代次命名），
+# 分析和考核通过内存映射读取，不再与CMS、登录等请求争用MySQL
+CASE_SNAPSHOT_DIR = os.path.join('data', 'case_snapshots')
+CASE_SNAPSHOT_BATCH_ROWS = 20000  # 导出快照时每批从MySQL读取的行数
+CASE_SNAPSHOT_FLOAT_TYPES = ('FLOAT', 'DOUBLE', 'DECIMAL', 'NUMERIC', 'REAL')
+
+def case_snapshot_prefix(table_name):
+    """快照文件名前缀：表名来自上传的文件名，可能含中文和特殊字符，用其MD5命名"""
+    return hashlib.md5(table_name.encode('utf-8')).hexdigest() + '_'
+
+def case_snapshot_path(table_name, generation):
+    return os.path.join(CASE_SNAPSHOT_DIR, f"{case_snapshot_prefix(table_name)}{generation}.arrow")
+
+def case_snapshot_schema(table_name):
+    """按MySQL字段类型确定快照各字段的Arrow类型，保证分批写入时类型一致，读回的dtype与从MySQL读取相同"""
+    fields = []
+    for name, type_name in get_table_column_types(table_name).items():
+        if type_name in PUSHDOWN_DATETIME_TYPES:
+            arrow_type = pa.timestamp('us')
+        elif type_name in CASE_SNAPSHOT_FLOAT_TYPES:
+            arrow_type = pa.float64()
+        elif type_name in PUSHDOWN_NUMERIC_TYPES:
+            arrow_type = pa.int64()
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(name, arrow_type))
+    return pa.schema(fields)
+
+def build_case_table_snapshot(table_name):
+    """把案件表当前代次的数据导出为快照文件（上传后在后台任务中执行），分批读取，内存占用只与批大小有关"""
+    if pa is None:
+        print(f"未安装pyarrow，数据表 {table_name} 不导出快照")
+        return {'table_name': table_name, 'snapshot': False}
+    generation = get_table_generation(table_name)
+    schema = case_snapshot_schema(table_name)
+    path = case_snapshot_path(table_name, generation)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(CASE_SNAPSHOT_DIR, exist_ok=True)
+    
+    query = f"SELECT * FROM {quote_identifier(table_name)}"
+    if CASE_TABLE_ROW_ID in schema.names:
+        query += f" ORDER BY {quote_identifier(CASE_TABLE_ROW_ID)}"
+    row_count = 0
+    try:
+        # 服务端游标逐批取数，不把整张表缓存在客户端
+        with engine.connect().execution_options(stream_results=True) as conn:
+            with pa_ipc.new_file(temp_path, schema) as writer:
+                for chunk in pd.read_sql(text(query), conn, chunksize=CASE_SNAPSHOT_BATCH_ROWS):
+                    writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                    row_count += len(chunk)
+        
+        # 导出期间数据表又被替换或删除时放弃，由新的上传任务重新导出
+        if get_table_generation(table_name) != generation:
+            print(f"数据表 {table_name} 在导出期间已被替换或删除，放弃快照")
+            os.remove(temp_path)
+            return {'table_name': table_name, 'generation': generation, 'snapshot': False, 'stale': True}
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    
+    remove_case_table_snapshots(table_name, keep=path)
+    print(f"数据表 {table_name} 已导出快照：{row_count} 行")
+    return {'table_name': table_name, 'generation': generation, 'snapshot': True, 'rows': row_count}
+
+def remove_case_table_snapshots(table_name, keep=None):
+    """删除数据表的快照文件（重新上传或删除数据表时调用），keep为需要保留的当前代次快照"""
+    if not os.path.isdir(CASE_SNAPSHOT_DIR):
+        return
+    prefix = case_snapshot_prefix(table_name)
+    for name in os.listdir(CASE_SNAPSHOT_DIR):
+        path = os.path.join(CASE_SNAPSHOT_DIR, name)
+        if name.startswith(prefix) and name.endswith('.arrow') and path != keep:
+            try:
+                os.remove(path)
+            except OSError as e:
+                # Windows下正在被读取（内存映射）的文件不能删除，留待下次清理
+                print(f"删除快照文件 {path} 失败: {str(e)}")
+
+def read_case_table_snapshot(table_name, generation, columns=None):
+    """从当前代次的快照读取数据表，只读取columns中存在的字段；没有快照或读取失败时返回None，由调用方从MySQL读取
+    
+    文件按内存映射打开，未选中的字段不会被读入内存。
+    """
+    if pa is None:
+        return None
+    path = case_snapshot_path(table_name, generation)
+    if not os.path.exists(path):
+        return None
+    try:
+        with pa.memory_map(path, 'r') as source:
+            table = pa_ipc.open_file(source).read_all()
+            if columns is not None:
+                selected = [col for col in columns if col in table.schema.names]
+                if not selected:
+                    return pd.DataFrame(index=pd.RangeIndex(table.num_rows))
+                if CASE_TABLE_ROW_ID in table.schema.names:
+                    selected.insert(0, CASE_TABLE_ROW_ID)
+                table = table.select(selected)
+            return table.to_pandas()
+    except Exception as e:
+        print(f"读取数据表 {table_name} 的快照失败，改为从MySQL读取: {str(e)}")
+        return None
+
+def process_uploaded_case_table(table_name):
+    """上传后的后处理（在上传专用线程池中依次执行各步骤）
+    
+    快照最先导出，之后的步骤通过 load_case_table 从快照读取，不再各自从MySQL整表读取；
+    某一步失败不影响后续步骤，结束时有失败的步骤则任务记为失败。
+    """
+    steps = [('snapshot', build_case_table_snapshot), ('cube', build_case_table_cube),
+             ('duplicate_index', index_case_table_duplicates)]
+    results = {}
+    errors = []
+    for step, func in steps:
+        try:
+            results[step] = func(table_name)
+        except Exception as e:
+            print(f"数据表 {table_name} 上传后处理步骤 {step} 失败: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            errors.append(f"{step}: {str(e)}")
+    if errors:
+        raise RuntimeError('；'.join(errors))
+    return {'table_name': table_name, 'steps': results}
+
 # 生成slug函数
 def generate_slug(text):
     import re
@@ -304,6 +762,246 @@ API_KEY = '58a51ac5-3b75-4c5e-85ac-1fb4ef652bd0'
 API_URL = 'https://ark.cn-beijing.volces.com/api/v3/chat/completions'
 MODEL = 'doubao-seed-1-8-251228'
 
+# 大模型客户端配置
+LLM_TIMEOUT = (10, 300)  # 连接超时10秒，读取超时300秒
+LLM_MAX_RETRIES = 3
+LLM_BACKOFF_BASE = 2  # 退避基数（秒），按指数增长并加随机抖动
+LLM_BACKOFF_MAX = 30
+LLM_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+LLM_MAX_CONCURRENCY = 8  # 同时进行的大模型请求数，也是连接池大小
+LLM_ACQUIRE_TIMEOUT = 120  # 等待并发名额的最长时间（秒）
+LLM_BREAKER_THRESHOLD = 5  # 连续失败多少次后熔断
+LLM_BREAKER_COOLDOWN = 60  # 熔断持续时间（秒），之后放行一次试探请求
+
+class LLMError(Exception):
+    """大模型调用失败"""
+    pass
+
+class LLMClient:
+    """大模型调用客户端：复用连接池，统一重试退避，限制并发，服务异常时熔断"""
+    
+    def __init__(self, api_url, api_key, model):
+        self.api_url = api_url
+        self.model = model
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=LLM_MAX_CONCURRENCY, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'Authorization': f'Bearer {api_key}'
+        })
+        self._semaphore = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+    
+    def _allow_request(self):
+        """熔断检查：熔断期间拒绝请求，冷却后每个冷却周期只放行一次试探请求"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= LLM_BREAKER_COOLDOWN:
+                self._opened_at = time.monotonic()
+                return True
+            return False
+    
+    def _record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                print("大模型服务已恢复，关闭熔断")
+            self._failures = 0
+            self._opened_at = None
+    
+    def _record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= LLM_BREAKER_THRESHOLD and self._opened_at is None:
+                print(f"大模型API连续失败 {self._failures} 次，熔断 {LLM_BREAKER_COOLDOWN} 秒")
+                self._opened_at = time.monotonic()
+    
+    def _backoff(self, attempt):
+        """指数退避加随机抖动，避免多个请求同时重试"""
+        delay = min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * (2 ** attempt))
+        return delay / 2 + random.uniform(0, delay / 2)
+    
+    def _send(self, payload, stream=False):
+        """发送请求（熔断检查、并发限制、重试），成功时返回响应且仍占用并发名额，由调用方释放"""
+        for attempt in range(LLM_MAX_RETRIES):
+            if not self._allow_request():
+                raise LLMError("大模型服务暂时不可用，请稍后重试")
+            if not self._semaphore.acquire(timeout=LLM_ACQUIRE_TIMEOUT):
+                raise LLMError("大模型请求排队超时，请稍后重试")
+            try:
+                response = self.session.post(self.api_url, json=payload, timeout=LLM_TIMEOUT, stream=stream)
+                response.raise_for_status()
+                return response
+            except requests.exceptions.RequestException as e:
+                self._semaphore.release()
+                error = e
+            
+            # 超时、连接错误、限流和服务端错误才重试，其余错误（如鉴权失败）直接返回
+            status_code = error.response.status_code if getattr(error, 'response', None) is not None else None
+            retryable = status_code is None or status_code in LLM_RETRY_STATUS_CODES
+            if not retryable:
+                raise LLMError(str(error))
+            self._record_failure()
+            if attempt < LLM_MAX_RETRIES - 1:
+                delay = self._backoff(attempt)
+                print(f"API调用失败，{delay:.1f}秒后重试... (尝试 {attempt+1}/{LLM_MAX_RETRIES})")
+                time.sleep(delay)
+            else:
+                raise LLMError(f"多次尝试后仍然失败 - {str(error)}")
+    
+    def chat(self, messages, temperature=0.3, max_tokens=2000):
+        """发送对话请求并返回模型回复内容，失败时抛出LLMError"""
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens
+        }
+        
+        response = self._send(payload)
+        try:
+            content = response.json()['choices'][0]['message']['content']
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            raise LLMError(f"大模型返回格式异常: {str(e)}")
+        finally:
+            self._semaphore.release()
+        self._record_success()
+        return content
+    
+    def stream_chat(self, messages, temperature=0.3, max_tokens=2000):
+        """流式对话请求，逐段返回模型生成的内容；只在收到响应前重试，输出中断时抛出LLMError"""
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": True
+        }
+        
+        response = self._send(payload, stream=True)
+        # 流式响应头通常不带charset，requests会按ISO-8859-1解码，这里显式指定
+        response.encoding = 'utf-8'
+        try:
+            with response:
+                for line in response.iter_lines(decode_unicode=True):
+                    # 服务端按SSE格式返回：data: {...}，以 data: [DONE] 结束
+                    if not line or not line.startswith('data:'):
+                        continue
+                    data = line[len('data:'):].strip()
+                    if data == '[DONE]':
+                        break
+                    choices = json.loads(data).get('choices') or []
+                    content = (choices[0].get('delta') or {}).get('content') if choices else None
+                    if content:
+                        yield content
+            self._record_success()
+        except requests.exceptions.RequestException as e:
+            self._record_failure()
+            raise LLMError(f"流式输出中断 - {str(e)}")
+        except (ValueError, AttributeError) as e:
+            raise LLMError(f"大模型返回格式异常: {str(e)}")
+        finally:
+            self._semaphore.release()
+
+llm_client = LLMClient(API_URL, API_KEY, MODEL)
+
+# 大模型回复缓存配置
+LLM_CACHE_TTL = 7 * 24 * 60 * 60  # 缓存有效期（秒）
+LLM_CACHE_MAX_ENTRIES = 2000  # 缓存条数上限，超过时淘汰最久未使用的条目
+
+def llm_cache_key(messages, temperature, max_tokens):
+    """由模型、提示词和调用参数计算缓存键"""
+    raw = json.dumps({
+        'model': MODEL,
+        'messages': messages,
+        'temperature': temperature,
+        'max_tokens': max_tokens
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def get_cached_llm_response(cache_key):
+    """读取未过期的缓存回复，没有时返回None"""
+    session = Session()
+    try:
+        now = datetime.datetime.now()
+        entry = session.query(LLMResponseCache).filter_by(cache_key=cache_key).first()
+        if not entry:
+            return None
+        if entry.created_at < now - datetime.timedelta(seconds=LLM_CACHE_TTL):
+            session.delete(entry)
+            session.commit()
+            return None
+        entry.accessed_at = now
+        session.commit()
+        return entry.response
+    except Exception as e:
+        session.rollback()
+        print(f"读取大模型缓存失败: {str(e)}")
+        return None
+    finally:
+        session.close()
+
+def save_cached_llm_response(cache_key, response):
+    """写入缓存回复，并清理过期和超出上限的条目"""
+    session = Session()
+    try:
+        now = datetime.datetime.now()
+        session.merge(LLMResponseCache(
+            cache_key=cache_key,
+            model=MODEL,
+            response=response,
+            created_at=now,
+            accessed_at=now
+        ))
+        session.query(LLMResponseCache).filter(
+            LLMResponseCache.created_at < now - datetime.timedelta(seconds=LLM_CACHE_TTL)
+        ).delete(synchronize_session=False)
+        stale_keys = [row.cache_key for row in session.query(LLMResponseCache.cache_key)
+                      .order_by(LLMResponseCache.accessed_at.desc())
+                      .offset(LLM_CACHE_MAX_ENTRIES)]
+        if stale_keys:
+            session.query(LLMResponseCache).filter(
+                LLMResponseCache.cache_key.in_(stale_keys)
+            ).delete(synchronize_session=False)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        print(f"写入大模型缓存失败: {str(e)}")
+    finally:
+        session.close()
+
+def cached_llm_chat(messages, temperature=0.3, max_tokens=2000, force_refresh=False):
+    """带持久化缓存的大模型调用；force_refresh为True时跳过缓存重新生成，失败结果不缓存"""
+    cache_key = llm_cache_key(messages, temperature, max_tokens)
+    if not force_refresh:
+        cached = get_cached_llm_response(cache_key)
+        if cached is not None:
+            return cached
+    
+    content = llm_client.chat(messages, temperature=temperature, max_tokens=max_tokens)
+    save_cached_llm_response(cache_key, content)
+    return content
+
+def stream_cached_llm_chat(messages, temperature=0.3, max_tokens=2000, force_refresh=False):
+    """流式大模型调用：命中缓存时一次返回缓存内容，否则逐段转发，完整生成后写入缓存"""
+    cache_key = llm_cache_key(messages, temperature, max_tokens)
+    if not force_refresh:
+        cached = get_cached_llm_response(cache_key)
+        if cached is not None:
+            yield cached
+            return
+    
+    parts = []
+    for content in llm_client.stream_chat(messages, temperature=temperature, max_tokens=max_tokens):
+        parts.append(content)
+        yield content
+    save_cached_llm_response(cache_key, ''.join(parts))
+
 @app.route('/api/upload', methods=['POST'])
 @admin_required
 def upload_file():
@@ -317,17 +1015,29 @@ def upload_file():
             return jsonify({'error': 'No selected file'}), 400
         
         if file and file.filename.endswith('.xlsx'):
-            # 读取Excel文件
-            df = pd.read_excel(file)
-            
             # 用文件名作为表名（去除.xlsx后缀）
             table_name = os.path.splitext(file.filename)[0]
             
-            # 写入数据库
-            df.to_sql(table_name, engine, if_exists='replace', index=False)
+            # 分批读取Excel并写入临时表：识别已知案件字段并转换为DATETIME、INT和VARCHAR，
+            # 建立主键和索引后原子替换目标表
+            try:
+                schema, row_count = ingest_case_workbook(file.stream, table_name)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            # 数据表已被替换，使缓存和旧快照失效
+            bump_table_generation(table_name)
+            remove_case_table_snapshots(table_name)
+            
+            # 在上传专用线程池中执行后处理：导出快照、预先聚合数据立方体、登记到跨月份重复案件索引，
+            # 完成前的读取仍从MySQL进行，分析和考核请求仍从原始数据计算
+            postprocess_job_id = submit_job('upload_postprocess', process_uploaded_case_table, (table_name,),
+                                            {'table_name': table_name}, request.user_id, executor=upload_executor)
             
             session.commit()
-            return jsonify({'message': 'File uploaded successfully', 'table_name': table_name}), 200
+            # 无法转换为识别类型而置为空的值，按字段列出个数
+            dropped_values = {col: info['dropped'] for col, info in schema.items() if info.get('dropped')}
+            return jsonify({'message': 'File uploaded successfully', 'table_name': table_name, 'row_count': row_count, 'schema': schema,
+                            'dropped_values': dropped_values, 'postprocess_job_id': postprocess_job_id}), 200
         else:
             return jsonify({'error': 'Only Excel files are allowed'}), 400
     except Exception as e:
@@ -794,14 +1504,19 @@ def delete_table(table_name):
     session = Session()
     try:
         # 防止删除系统表
-        protected_tables = ['users', 'permissions']
+        protected_tables = ['users', 'permissions', 'case_table_generations', 'assessment_profiles', 'case_table_schemas', 'background_jobs', 'llm_response_cache', 'duplicate_texts', 'duplicate_buckets', 'duplicate_occurrences', 'address_cache', 'address_gazetteer', 'case_table_cubes', 'case_table_cube_info']
         if table_name in protected_tables:
             return jsonify({'error': f'不能删除系统表 {table_name}'}), 403
         
         # 删除数据表
         from sqlalchemy import text
         session.execute(text(f"DROP TABLE IF EXISTS {table_name}"))
+        session.execute(text("DELETE FROM case_table_schemas WHERE table_name = :table_name"), {'table_name': table_name})
         session.commit()
+        bump_table_generation(table_name)
+        remove_from_duplicate_index(table_name)
+        remove_case_table_cube(table_name)
+        remove_case_table_snapshots(table_name)
         return jsonify({'message': f'Table {table_name} deleted successfully'})
     except Exception as e:
         session.rollback()
@@ -812,6 +1527,401 @@ def delete_table(table_name):
     finally:
         session.close()
 
+# 案件时间字段常见格式（各格式互不重叠，解析顺序不影响结果）
+CASE_TIME_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y/%m/%d %H:%M:%S', '%Y-%m-%d', '%Y/%m/%d', '%d-%m-%Y', '%d/%m/%Y']
+TIME_FORMAT_SAMPLE_SIZE = 200  # 识别主要时间格式时抽样的行数
+
+def _parse_single_timestamp(value):
+    """逐行兜底解析单个时间值，无法解析时返回NaT"""
+    if not isinstance(value, str) and pd.isna(value):
+        return pd.NaT
+    if not value:
+        return pd.NaT
+    try:
+        timestamp = pd.to_datetime(value)
+    except Exception:
+        return pd.NaT
+    # 带时区的时间保留本地时间，去掉时区信息
+    if timestamp is not pd.NaT and timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_localize(None)
+    return timestamp
+
+def parse_case_timestamps(values):
+    """整列解析案件时间字段，返回（datetime Series, 解析统计信息）
+    
+    先抽样识别主要格式并整列向量化解析，GMT格式单独批量解析，
+    相对时长（如 1小时55分18秒）记为NaT，只有剩余的少量值逐行兜底。
+    """
+    index = values.index
+    values = values.reset_index(drop=True)
+    stats = {'total': len(values), 'format': None, 'fallback_count': 0}
+    
+    if pd.api.types.is_datetime64_any_dtype(values):
+        parsed = values.dt.tz_localize(None) if values.dt.tz is not None else values
+        stats['format'] = 'datetime'
+    else:
+        values = values.astype(object)
+        parsed = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+        is_str = values.map(lambda v: isinstance(v, str)).astype(bool)
+        strings = values[is_str]
+        handled = is_str.copy()
+        
+        # 已经是时间对象的值（如openpyxl读出的单元格）整批转换
+        is_datetime = values.map(lambda v: isinstance(v, (datetime.datetime, datetime.date))).astype(bool)
+        if is_datetime.any():
+            try:
+                attempt = pd.to_datetime(values[is_datetime])
+                if attempt.dt.tz is not None:
+                    attempt = attempt.dt.tz_localize(None)
+                parsed[attempt.index] = attempt
+                handled |= is_datetime
+            except (ValueError, TypeError):
+                pass
+        
+        # 处理 GMT 格式：Wed, 31 Dec 2025 15:02:18 GMT
+        gmt = strings[strings.str.contains('GMT', regex=False)]
+        if not gmt.empty:
+            attempt = pd.to_datetime(gmt.str.split(', ', n=1).str[1].str.replace(' GMT', '', regex=False), format='%d %b %Y %H:%M:%S', errors='coerce')
+            matched = attempt.index[attempt.notna()]
+            parsed[matched] = attempt[matched]
+            strings = strings.drop(matched)
+        
+        # 相对时间格式无法转换为绝对时间，直接记为NaT
+        strings = strings[~strings.str.contains('小时|分|秒')]
+        
+        # 按抽样命中数排列格式，主要格式一次解析绝大多数行
+        sample = strings.head(TIME_FORMAT_SAMPLE_SIZE)
+        hits = {fmt: int(pd.to_datetime(sample, format=fmt, errors='coerce').notna().sum()) for fmt in CASE_TIME_FORMATS}
+        formats = sorted(CASE_TIME_FORMATS, key=hits.get, reverse=True)
+        # 抽样中没有任何值符合已知格式时不报告格式
+        if hits[formats[0]] > 0:
+            stats['format'] = formats[0]
+        for fmt in formats:
+            if strings.empty:
+                break
+            attempt = pd.to_datetime(strings, format=fmt, errors='coerce')
+            matched = attempt.index[attempt.notna()]
+            parsed[matched] = attempt[matched]
+            strings = strings.drop(matched)
+        
+        # 剩余的字符串和非字符串值逐行兜底解析
+        residue = pd.concat([strings, values[~handled & values.notna()]])
+        stats['fallback_count'] = len(residue)
+        if not residue.empty:
+            parsed[residue.index] = pd.to_datetime(residue.map(_parse_single_timestamp))
+    
+    parsed.index = index
+    stats['valid'] = int(parsed.notna().sum())
+    stats['success_rate'] = round(stats['valid'] / stats['total'], 4) if stats['total'] else 0
+    return parsed, stats
+
+# 上传时识别的已知案件字段
+CASE_DATETIME_COLUMNS = ['上报时间', '立案时间', '派遣时间', '受理时间', '处置时间', '结案时间', '捆绑处置截止时间', '处置截止时间']
+CASE_INT_COLUMNS = ['延期次数']
+CASE_CATEGORY_COLUMNS = ['处置部门', '所属街道', '所属社区', '所属片区', '大类名称', '小类名称', '问题类型', '问题来源', '当前阶段名称', '返工次数']
+CASE_SCHEMA_MIN_PARSE_RATE = 0.9  # 非空值中能成功转换的比例达到该值才改变字段类型
+CASE_CATEGORY_MAX_LENGTH = 255  # 分类字段存为VARCHAR的最大长度
+
+def _present_values(values):
+    """非空且不是空白字符串的值（空白字符串本来就视为空值）"""
+    return values.notna() & (values.astype(object).astype(str).str.strip() != '')
+
+def _is_number(value):
+    return isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, (bool, np.bool_))
+
+def infer_case_schema(df):
+    """识别案件表中的已知字段，返回 字段 -> 类型信息（datetime / int / category / bigint / float）
+    
+    其他字段的取值全部是数字（Excel数值单元格）时保持数值类型，与 read_excel + to_sql 一致。
+    """
+    schema = {}
+    for col in df.columns:
+        values = df[col]
+        non_null = values.dropna()
+        if non_null.empty:
+            continue
+        
+        # 时间字段：已知字段名，或字段名包含“时间”“日期”
+        if col in CASE_DATETIME_COLUMNS or '时间' in str(col) or '日期' in str(col):
+            parsed, stats = parse_case_timestamps(non_null)
+            parse_rate = stats['valid'] / len(non_null)
+            if parse_rate >= CASE_SCHEMA_MIN_PARSE_RATE:
+                schema[col] = {'kind': 'datetime', 'parse_rate': round(parse_rate, 4), 'format': stats['format']}
+                continue
+        
+        # 整数字段：已知字段名，或字段名包含“次数”且取值为整数
+        if col in CASE_INT_COLUMNS or '次数' in str(col):
+            numbers = pd.to_numeric(non_null, errors='coerce')
+            valid = numbers.dropna()
+            parse_rate = len(valid) / len(non_null)
+            if parse_rate >= CASE_SCHEMA_MIN_PARSE_RATE and (valid == valid.round()).all():
+                schema[col] = {'kind': 'int', 'parse_rate': round(parse_rate, 4)}
+                continue
+        
+        # 分类字段：已知的低基数文本字段
+        if col in CASE_CATEGORY_COLUMNS:
+            max_length = int(non_null.astype(str).str.len().max())
+            if max_length <= CASE_CATEGORY_MAX_LENGTH:
+                schema[col] = {'kind': 'category', 'distinct': int(non_null.nunique())}
+                continue
+        
+        # 数值字段（经纬度、编号、金额等）：整数存为BIGINT，含小数的存为DOUBLE
+        if non_null.map(_is_number).all():
+            is_integer = non_null.map(lambda v: isinstance(v, (int, np.integer))).all()
+            schema[col] = {'kind': 'bigint' if is_integer else 'float'}
+            continue
+        
+        # Excel时间单元格
+        if non_null.map(lambda v: isinstance(v, datetime.datetime)).all():
+            schema[col] = {'kind': 'datetime', 'parse_rate': 1.0, 'format': 'datetime'}
+    return schema
+
+def apply_case_schema(df, schema):
+    """按识别出的类型转换字段，无法转换的值置为空
+    
+    返回（转换后的DataFrame, 字段 -> 被置为空的非空值个数），原值无法保留，由调用方报告。
+    """
+    df = df.copy()
+    dropped = {}
+    for col, info in schema.items():
+        if col not in df.columns:
+            continue
+        original = df[col]
+        if info['kind'] == 'datetime':
+            df[col] = parse_case_timestamps(original)[0]
+        elif info['kind'] == 'int':
+            df[col] = pd.to_numeric(original, errors='coerce').round().astype('Int64')
+        elif info['kind'] == 'category':
+            df[col] = original.astype(object).where(original.isna(), original.astype(str).str.strip())
+        elif info['kind'] == 'bigint':
+            df[col] = pd.to_numeric(original, errors='coerce').astype('Int64')
+        elif info['kind'] == 'float':
+            df[col] = pd.to_numeric(original, errors='coerce').astype('float64')
+        else:
+            continue
+        lost = int((_present_values(original) & df[col].isna()).sum())
+        if lost:
+            dropped[col] = lost
+    return df, dropped
+
+def case_schema_sql_types(schema):
+    """将字段类型信息转换为 to_sql 的 dtype 参数"""
+    sql_types = {}
+    for col, info in schema.items():
+        if info['kind'] == 'datetime':
+            sql_types[col] = SQLDateTime()
+        elif info['kind'] == 'int':
+            sql_types[col] = SQLInteger()
+        elif info['kind'] == 'category':
+            sql_types[col] = SQLString(CASE_CATEGORY_MAX_LENGTH)
+        elif info['kind'] == 'bigint':
+            sql_types[col] = BigInteger()
+        elif info['kind'] == 'float':
+            sql_types[col] = Float(precision=53)
+        elif info['kind'] == 'text':
+            sql_types[col] = Text()
+    return sql_types
+
+def find_schema_conflicts(df, schema):
+    """检查后续批次是否与第一批识别的类型冲突，返回需要放宽为TEXT的字段
+    
+    数值字段在后续批次中出现非数字的取值、分类字段出现超过VARCHAR长度的取值时，
+    整列改存为TEXT，已写入的值转换为文本，不丢失数据。
+    """
+    conflicts = []
+    for col, info in schema.items():
+        if col not in df.columns:
+            continue
+        non_null = df[col].dropna()
+        if non_null.empty:
+            continue
+        if info['kind'] in ('bigint', 'float'):
+            if not non_null.map(_is_number).all():
+                conflicts.append(col)
+        elif info['kind'] == 'category':
+            if int(non_null.astype(str).str.strip().str.len().max()) > CASE_CATEGORY_MAX_LENGTH:
+                conflicts.append(col)
+    return conflicts
+
+def widen_staging_column(staging_table, col, schema, sql_types):
+    """把临时表中的字段改为TEXT，并更新类型信息，后续批次按文本写入"""
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {quote_identifier(staging_table)} MODIFY COLUMN {quote_identifier(col)} TEXT"))
+    schema[col] = {'kind': 'text', 'widened_from': schema[col]['kind']}
+    sql_types[col] = Text()
+
+# 流式导入配置
+UPLOAD_CHUNK_ROWS = 5000  # 每批从Excel读取的行数（第一批同时用于识别字段类型）
+UPLOAD_INSERT_BATCH_ROWS = 1000  # 每条多行INSERT语句包含的行数
+
+def iter_excel_chunks(stream, chunk_rows=UPLOAD_CHUNK_ROWS):
+    """以openpyxl只读模式逐批读取Excel第一个工作表，每批返回一个DataFrame"""
+    from openpyxl import load_workbook
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        
+        # 与pandas一致：空列名记为 Unnamed: n，重复列名追加 .1、.2
+        columns = []
+        for i, name in enumerate(header):
+            name = f"Unnamed: {i}" if name is None else str(name)
+            candidate, suffix = name, 1
+            while candidate in columns:
+                candidate = f"{name}.{suffix}"
+                suffix += 1
+            columns.append(candidate)
+        width = len(columns)
+        
+        batch = []
+        for row in rows:
+            row = tuple(row[:width]) + (None,) * (width - len(row))
+            # 跳过空行
+            if all(value is None for value in row):
+                continue
+            batch.append(row)
+            if len(batch) >= chunk_rows:
+                yield pd.DataFrame(batch, columns=columns)
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=columns)
+    finally:
+        workbook.close()
+
+def swap_in_staging_table(staging_table, table_name):
+    """用临时表原子替换目标表，读取方不会看到写了一半的数据"""
+    # 同名文件同时上传时各自使用不同的旧表名，互不影响；名称长度固定，不会因表名较长超过MySQL的64字符限制
+    old_table = f"_old_{uuid.uuid4().hex}"
+    with engine.begin() as conn:
+        if table_name in inspect(engine).get_table_names():
+            # 一条RENAME TABLE语句同时完成两次改名，是原子操作
+            conn.execute(text(
+                f"RENAME TABLE {quote_identifier(table_name)} TO {quote_identifier(old_table)}, "
+                f"{quote_identifier(staging_table)} TO {quote_identifier(table_name)}"
+            ))
+            conn.execute(text(f"DROP TABLE {quote_identifier(old_table)}"))
+        else:
+            conn.execute(text(f"RENAME TABLE {quote_identifier(staging_table)} TO {quote_identifier(table_name)}"))
+
+def ingest_case_workbook(stream, table_name):
+    """流式导入Excel案件表：分批读取、转换类型、多行INSERT写入临时表，最后原子替换目标表
+    
+    返回（字段类型信息, 行数）；字段类型信息中的 dropped 为该字段无法转换而置为空的值个数。
+    """
+    # 临时表名随机生成：同名文件同时上传时不会删除或写入对方的临时表，长度也与目标表名无关
+    staging_table = f"_stg_{uuid.uuid4().hex}"
+    
+    schema = None
+    sql_types = None
+    row_count = 0
+    dropped = {}
+    try:
+        for chunk in iter_excel_chunks(stream):
+            if schema is None:
+                # 用第一批数据识别字段类型，未识别的字段存为TEXT
+                schema = infer_case_schema(chunk)
+                sql_types = {col: Text() for col in chunk.columns}
+                sql_types.update(case_schema_sql_types(schema))
+            else:
+                # 后续批次与识别的类型冲突时放宽字段类型
+                for col in find_schema_conflicts(chunk, schema):
+                    print(f"数据表 {table_name} 字段 {col} 从第 {row_count + 1} 行起出现与 {schema[col]['kind']} 类型不符的值（非数字或过长），改存为TEXT")
+                    widen_staging_column(staging_table, col, schema, sql_types)
+            raw = chunk
+            chunk, chunk_dropped = apply_case_schema(chunk, schema)
+            for col, count in chunk_dropped.items():
+                # 时间、整数字段在后续批次中大量无法转换，说明按第一批识别的类型不适用于整列，拒绝导入
+                present = int(_present_values(raw[col]).sum())
+                if count > present * (1 - CASE_SCHEMA_MIN_PARSE_RATE):
+                    raise ValueError(f"字段 {col} 从第 {row_count + 1} 行起的 {len(raw)} 行中有 {count} 个值无法转换为 "
+                                     f"{schema[col]['kind']}（按前 {UPLOAD_CHUNK_ROWS} 行识别的类型），请检查数据后重新上传")
+                dropped[col] = dropped.get(col, 0) + count
+            chunk.to_sql(staging_table, engine, if_exists='append' if row_count else 'replace', index=False,
+                         dtype=sql_types, method='multi', chunksize=UPLOAD_INSERT_BATCH_ROWS)
+            row_count += len(chunk)
+            print(f"数据表 {table_name} 已写入 {row_count} 行")
+        
+        if schema is None:
+            raise ValueError('Excel文件中没有数据')
+        
+        # 在临时表上建好主键和索引后再替换目标表
+        ensure_case_table_indexes(staging_table)
+        swap_in_staging_table(staging_table, table_name)
+    except Exception:
+        with engine.begin() as conn:
+            conn.execute(text(f"DROP TABLE IF EXISTS {quote_identifier(staging_table)}"))
+        raise
+    
+    # 转换类型时丢弃的原值记录在字段类型信息中，随上传结果返回
+    for col, count in dropped.items():
+        schema[col]['dropped'] = count
+        print(f"数据表 {table_name} 字段 {col} 有 {count} 个值无法转换为 {schema[col]['kind']}，已置为空")
+    save_case_table_schema(table_name, schema, row_count)
+    return schema, row_count
+
+def save_case_table_schema(table_name, schema, row_count):
+    """记录数据表上传时识别的字段类型"""
+    session = Session()
+    try:
+        session.merge(CaseTableSchema(
+            table_name=table_name,
+            column_mapping=json.dumps(schema, ensure_ascii=False),
+            row_count=row_count
+        ))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+# 上传后为案件表添加的自增主键和需要建立索引的字段（按各分析类型的关键字段识别规则查找）
+CASE_TABLE_ROW_ID = '_row_id'
+CASE_INDEX_FIELDS = [
+    ('space_analysis', '所属街道'),
+    ('space_analysis', '所属社区'),
+    ('space_analysis', '所属片区'),
+    ('space_analysis', '小类名称'),
+    ('time_analysis', '上报时间'),
+    ('monthly_comparison', '捆绑处置截止时间')
+]
+CASE_INDEX_PREFIX_LENGTH = 100  # TEXT字段只能建立前缀索引
+CASE_INDEX_TEXT_TYPES = ('TEXT', 'TINYTEXT', 'MEDIUMTEXT', 'LONGTEXT')
+
+def ensure_case_table_indexes(table_name):
+    """为案件表添加自增主键，并为处置部门、街道、社区、片区、小类、截止时间和上报时间字段建立索引"""
+    column_types = get_table_column_types(table_name)
+    columns = list(column_types.keys())
+    
+    index_columns = []
+    if '处置部门' in column_types:
+        index_columns.append('处置部门')
+    for analysis_type, field in CASE_INDEX_FIELDS:
+        col = resolve_analysis_fields(analysis_type, columns).get(field)
+        if col and col != CASE_TABLE_ROW_ID and col not in index_columns:
+            index_columns.append(col)
+    
+    inspector = inspect(engine)
+    existing_indexes = {index['name'] for index in inspector.get_indexes(table_name)}
+    clauses = []
+    if CASE_TABLE_ROW_ID not in column_types:
+        clauses.append(f"ADD COLUMN {quote_identifier(CASE_TABLE_ROW_ID)} BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY FIRST")
+    for col in index_columns:
+        index_name = f"idx_{col}"[:64]
+        if index_name in existing_indexes:
+            continue
+        prefix = f"({CASE_INDEX_PREFIX_LENGTH})" if column_types[col] in CASE_INDEX_TEXT_TYPES else ''
+        clauses.append(f"ADD INDEX {quote_identifier(index_name)} ({quote_identifier(col)}{prefix})")
+    
+    if clauses:
+        # 所有修改合并为一条ALTER语句，只重建一次表
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {quote_identifier(table_name)} " + ', '.join(clauses)))
+        print(f"数据表 {table_name} 已建立索引：{index_columns}")
+    return index_columns
+
 def convert_nan_to_null(obj):
     """将数据结构中的NaN值转换为null值"""
     if isinstance(obj, dict):
@@ -820,100 +1930,217 @@ def convert_nan_to_null(obj):
         return [convert_nan_to_null(item) for item in obj]
     elif isinstance(obj, float) and np.isnan(obj):
         return None
+    elif obj is pd.NaT:
+        return None
     else:
         return obj
 
 # 考核计分相关函数
 import datetime
 
-def calculate_law_enforcement_score(cases):
-    """计算城市综合行政执法队8个片区的考核分数和排名"""
-    # 定义8个目标执法分队
-    target_departments = [
-        "执法东片区", "执法北片区", "执法南片区", "执法西片区",
-        "执法中片区", "大渠执法分队", "姚孟执法分队", "安邑执法分队"
-    ]
-    print(f"目标统计部门：{target_departments}")
+# 各考核单位的目标处置部门
+LAW_ENFORCEMENT_DEPARTMENTS = [
+    "执法东片区", "执法北片区", "执法南片区", "执法西片区",
+    "执法中片区", "大渠执法分队", "姚孟执法分队", "安邑执法分队"
+]
+HUANWEI_AREAS = [
+    "环卫东片区", "环卫北片区", "环卫南片区",
+    "环卫西片区", "环卫中片区"
+]
+GARDEN_AREAS = [
+    "园林东片区", "园林北片区", "园林南片区",
+    "园林西片区", "园林中片区"
+]
+PARKS = ["南风广场", "天逸公园", "体育公园", "航天公园", "圣惠公园", "禹都公园", "人民公园"]
+
+# 考核得分权重：得分 = ((按期率×on_time + 超期率×overdue)×timeliness + (1-延期率)×delay + (1-返工率)×rework)×100
+DEFAULT_SCORE_WEIGHTS = {
+    'on_time': 1,
+    'overdue': 0.4,
+    'timeliness': 0.8,
+    'delay': 0.1,
+    'rework': 0.1
+}
+
+# 考核计分用到的字段（英文字段为备用字段），pandas计算时只读取这些字段
+CASE_FLAG_COLUMNS = ['结案时间', 'handle_time', '捆绑处置截止时间', 'deadline', '延期次数', 'delay', '返工次数', 'rework']
+ASSESSMENT_COLUMNS = ['处置部门', '当前阶段名称'] + CASE_FLAG_COLUMNS
+GENERIC_SCORE_COLUMNS = ['status', '状态', 'create_time', '创建时间', 'handle_time', '处理时间', '完成时间']
+
+def _coalesce_case_column(df, primary, fallback):
+    """取主字段的值，主字段为空时取备用字段（如 结案时间 → handle_time）"""
+    values = df[primary] if primary in df.columns else pd.Series(None, index=df.index, dtype=object)
+    if fallback in df.columns:
+        empty = values.isna() | (values.astype(object) == '')
+        values = values.astype(object).where(~empty, df[fallback].astype(object))
+    return values
+
+def _to_case_datetime(values):
+    """将时间字段整列转换为datetime，字符串按 '%Y-%m-%d %H:%M:%S' 解析，无法解析的记为NaT"""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    return pd.to_datetime(values, format='%Y-%m-%d %H:%M:%S', errors='coerce')
+
+def compute_case_flags(df):
+    """向量化计算每个案件的按期、超期、延期、返工标记"""
+    close_time = _to_case_datetime(_coalesce_case_column(df, '结案时间', 'handle_time'))
+    deadline = _to_case_datetime(_coalesce_case_column(df, '捆绑处置截止时间', 'deadline'))
+    delay_num = pd.to_numeric(_coalesce_case_column(df, '延期次数', 'delay'), errors='coerce').astype(float)
+    rework_val = _coalesce_case_column(df, '返工次数', 'rework')
+    return pd.DataFrame({
+        # 与NaT比较的结果均为False，缺少时间的案件既不算按期也不算超期
+        'on_time': (close_time < deadline).to_numpy(),
+        'overdue': (close_time > deadline).to_numpy(),
+        'delay': (delay_num.notna() & (np.trunc(delay_num) != 0)).to_numpy(),
+        'rework': (rework_val.astype(str) == '是').to_numpy()
+    }, index=df.index)
+
+def aggregate_department_counts(df, target_departments, exclude_stage_keywords=()):
+    """按处置部门一次分组，统计目标部门的案件总数、按期、超期、延期、返工数量"""
+    if '处置部门' not in df.columns:
+        df = df.assign(处置部门=None)
+    mask = df['处置部门'].isin(target_departments)
     
-    # 按部门分组计算各项指标
-    team_results = []
+    # 排除当前阶段包含指定关键字（如挂账）的案件
+    if exclude_stage_keywords and '当前阶段名称' in df.columns:
+        stage = df['当前阶段名称'].astype(object).where(df['当前阶段名称'].notna(), '').astype(str).str.strip().str.lower()
+        excluded = pd.Series(False, index=df.index)
+        for keyword in exclude_stage_keywords:
+            excluded |= stage.str.contains(keyword, regex=False)
+        print(f"\n{'/'.join(exclude_stage_keywords)}过滤结果：")
+        print(f"   - 原始案件数：{len(df)}")
+        print(f"   - 排除后案件数：{int((~excluded).sum())}")
+        print(f"   - 排除的案件数：{int(excluded.sum())}")
+        mask &= ~excluded
     
-    for dept_name in target_departments:
-        # 筛选该部门的数据
-        dept_cases = [c for c in cases if c.get('处置部门') == dept_name]
-        
-        # 计算各项指标
-        total = len(dept_cases)
-        on_time = 0
-        overdue = 0
-        delay = 0
-        rework = 0
-        
-        for case in dept_cases:
-            # 检查结案时间和截止时间
-            close_time = case.get('结案时间') or case.get('handle_time')
-            deadline = case.get('捆绑处置截止时间') or case.get('deadline')
-            
-            if close_time and deadline:
-                try:
-                    if isinstance(close_time, str):
-                        close_time = datetime.datetime.strptime(close_time, '%Y-%m-%d %H:%M:%S')
-                    if isinstance(deadline, str):
-                        deadline = datetime.datetime.strptime(deadline, '%Y-%m-%d %H:%M:%S')
-                    
-                    if close_time < deadline:
-                        on_time += 1
-                    elif close_time > deadline:
-                        overdue += 1
-                except:
-                    pass
-            
-            # 检查延期次数
-            delay_val = case.get('延期次数') or case.get('delay')
-            try:
-                if delay_val is not None:
-                    delay_num = int(delay_val)
-                    if delay_num != 0:
-                        delay += 1
-            except (ValueError, TypeError):
-                pass
-            
-            # 检查返工次数
-            rework_val = case.get('返工次数') or case.get('rework')
-            if rework_val and str(rework_val) == '是':
-                rework += 1
-        
-        # 计算比率
-        on_time_rate = on_time / total if total > 0 else 0
-        overdue_rate = overdue / total if total > 0 else 0
-        delay_rate = delay / total if total > 0 else 0
-        rework_rate = rework / total if total > 0 else 0
-        
-        # 计算得分
-        score = (
-            (on_time_rate * 1 + overdue_rate * 0.4) * 0.8 +
-            (1 - delay_rate) * 0.1 +
-            (1 - rework_rate) * 0.1
-        ) * 100
-        
+    subset = df.loc[mask]
+    flags = compute_case_flags(subset)
+    flags['total'] = 1
+    # category字段按整数编码分组，只保留出现过的部门
+    counts = flags.groupby(subset['处置部门'], observed=True, sort=False).sum()
+    counts = counts.reindex(target_departments, fill_value=0)
+    return counts[['total', 'on_time', 'overdue', 'delay', 'rework']].astype(int)
+
+# 可以下推到MySQL计算的字段类型
+PUSHDOWN_DATETIME_TYPES = ('DATETIME', 'TIMESTAMP', 'DATE')
+PUSHDOWN_NUMERIC_TYPES = ('INT', 'INTEGER', 'BIGINT', 'SMALLINT', 'TINYINT', 'MEDIUMINT', 'FLOAT', 'DOUBLE', 'DECIMAL', 'NUMERIC', 'REAL')
+PUSHDOWN_STRING_TYPES = ('VARCHAR', 'CHAR', 'TEXT', 'TINYTEXT', 'MEDIUMTEXT', 'LONGTEXT')
+
+def quote_identifier(name):
+    """为MySQL标识符加反引号"""
+    return '`' + str(name).replace('`', '``') + '`'
+
+def get_table_column_types(table_name):
+    """读取数据表各字段的类型名称（大写，不含长度）"""
+    return {col['name']: str(col['type']).upper().split('(')[0] for col in inspect(engine).get_columns(table_name)}
+
+def aggregate_department_counts_sql(table_name, target_departments, exclude_stage_keywords=()):
+    """在MySQL中按处置部门 GROUP BY 统计各项数量；字段类型不支持下推时返回None"""
+    column_types = get_table_column_types(table_name)
+    
+    # 备用英文字段只在pandas计算中参与取值，存在时不下推
+    if '处置部门' not in column_types or any(col in column_types for col in ('handle_time', 'deadline', 'delay', 'rework')):
+        return None
+    # 时间字段必须是DATETIME类型才能在MySQL中直接比较
+    for col in ('结案时间', '捆绑处置截止时间'):
+        if col in column_types and column_types[col] not in PUSHDOWN_DATETIME_TYPES:
+            return None
+    if '延期次数' in column_types and column_types['延期次数'] not in PUSHDOWN_NUMERIC_TYPES:
+        return None
+    for col in ('返工次数', '当前阶段名称'):
+        if col in column_types and column_types[col] not in PUSHDOWN_STRING_TYPES:
+            return None
+    
+    dept = quote_identifier('处置部门')
+    if '结案时间' in column_types and '捆绑处置截止时间' in column_types:
+        close_time = quote_identifier('结案时间')
+        deadline = quote_identifier('捆绑处置截止时间')
+        on_time_expr = f"SUM(CASE WHEN {close_time} < {deadline} THEN 1 ELSE 0 END)"
+        overdue_expr = f"SUM(CASE WHEN {close_time} > {deadline} THEN 1 ELSE 0 END)"
+    else:
+        on_time_expr = overdue_expr = "0"
+    if '延期次数' in column_types:
+        delay_col = quote_identifier('延期次数')
+        delay_expr = f"SUM(CASE WHEN {delay_col} IS NOT NULL AND TRUNCATE({delay_col}, 0) <> 0 THEN 1 ELSE 0 END)"
+    else:
+        delay_expr = "0"
+    if '返工次数' in column_types:
+        rework_expr = f"SUM(CASE WHEN {quote_identifier('返工次数')} = '是' THEN 1 ELSE 0 END)"
+    else:
+        rework_expr = "0"
+    
+    where_clauses = [f"{dept} IN :targets"]
+    params = {'targets': list(target_departments)}
+    if exclude_stage_keywords and '当前阶段名称' in column_types:
+        stage = f"LOWER(TRIM({quote_identifier('当前阶段名称')}))"
+        for i, keyword in enumerate(exclude_stage_keywords):
+            where_clauses.append(f"COALESCE(LOCATE(:stage_keyword_{i}, {stage}), 0) = 0")
+            params[f'stage_keyword_{i}'] = keyword
+    
+    sql = text(
+        f"SELECT {dept} AS department, COUNT(*) AS total, "
+        f"{on_time_expr} AS on_time, {overdue_expr} AS overdue, "
+        f"{delay_expr} AS delay, {rework_expr} AS rework "
+        f"FROM {quote_identifier(table_name)} "
+        f"WHERE {' AND '.join(where_clauses)} "
+        f"GROUP BY {dept}"
+    ).bindparams(bindparam('targets', expanding=True))
+    
+    with engine.connect() as conn:
+        rows = conn.execute(sql, params).fetchall()
+    counts = pd.DataFrame(
+        [tuple(row[1:]) for row in rows],
+        index=[row[0] for row in rows],
+        columns=['total', 'on_time', 'overdue', 'delay', 'rework']
+    )
+    counts = counts.groupby(level=0).sum().reindex(target_departments, fill_value=0)
+    return counts.astype(int)
+
+def aggregate_department_counts_cube(table_name, target_departments, exclude_stage_keywords=()):
+    """从数据立方体的 处置部门×当前阶段 汇总中统计各项数量；立方体未建立或已过期时返回None"""
+    cube = load_case_table_cube(table_name, ('department_stage',))
+    if cube is None or 'department_stage' not in cube['groupings']:
+        return None
+    frame = cube['groupings']['department_stage']
+    mask = frame['dim1'].isin(target_departments)
+    # 阶段名称在聚合时已去除首尾空格并转为小写，按关键字排除（如挂账）
+    for keyword in exclude_stage_keywords:
+        mask &= ~frame['dim2'].str.contains(keyword, regex=False)
+    counts = frame[mask].groupby('dim1')[CASE_CUBE_MEASURES].sum()
+    return counts.reindex(target_departments, fill_value=0).astype(int)
+
+def build_team_results(counts, weights=None, rank_by='score', descending=True):
+    """根据各部门的计数计算比率、得分和排名，返回考核结果"""
+    weights = {**DEFAULT_SCORE_WEIGHTS, **(weights or {})}
+    total = counts['total'].where(counts['total'] > 0)
+    rates = counts[['on_time', 'overdue', 'delay', 'rework']].div(total, axis=0).fillna(0)
+    scores = (
+        (rates['on_time'] * weights['on_time'] + rates['overdue'] * weights['overdue']) * weights['timeliness'] +
+        (1 - rates['delay']) * weights['delay'] +
+        (1 - rates['rework']) * weights['rework']
+    ) * 100
+    
+    team_results = []
+    for dept_name, row in counts.iterrows():
+        score = float(scores[dept_name])
         team_results.append({
             'department': dept_name,
-            'total_cases': total,
-            'on_time_count': on_time,
-            'overdue_count': overdue,
-            'delay_count': delay,
-            'rework_count': rework,
-            'on_time_rate': round(on_time_rate * 100, 2),
-            'overdue_rate': round(overdue_rate * 100, 2),
-            'delay_rate': round(delay_rate * 100, 2),
-            'rework_rate': round(rework_rate * 100, 2),
+            'total_cases': int(row['total']),
+            'on_time_count': int(row['on_time']),
+            'overdue_count': int(row['overdue']),
+            'delay_count': int(row['delay']),
+            'rework_count': int(row['rework']),
+            'on_time_rate': round(float(rates.at[dept_name, 'on_time']) * 100, 2),
+            'overdue_rate': round(float(rates.at[dept_name, 'overdue']) * 100, 2),
+            'delay_rate': round(float(rates.at[dept_name, 'delay']) * 100, 2),
+            'rework_rate': round(float(rates.at[dept_name, 'rework']) * 100, 2),
             'score': round(score, 2)
         })
         
-        print(f"  {dept_name}: 总数={total}, 按期={on_time}, 超期={overdue}, 延期={delay}, 返工={rework}, 得分={score:.2f}")
+        print(f"  {dept_name}: 总数={int(row['total'])}, 按期={int(row['on_time'])}, 超期={int(row['overdue'])}, 延期={int(row['delay'])}, 返工={int(row['rework'])}, 得分={score:.2f}")
     
-    # 按得分排名
-    team_results.sort(key=lambda x: x['score'], reverse=True)
+    # 按排名指标排序（默认按得分从高到低）
+    team_results.sort(key=lambda x: x[rank_by], reverse=descending)
     
     for i, team in enumerate(team_results, 1):
         team['rank'] = i
@@ -924,7 +2151,7 @@ def calculate_law_enforcement_score(cases):
     
     # 计算总体数据
     total_cases = sum(t['total_cases'] for t in team_results)
-    total_score = sum(t['score'] for t in team_results) / len(team_results)
+    total_score = sum(t['score'] for t in team_results) / len(team_results) if team_results else 0
     
     return {
         'total_cases': total_cases,
@@ -933,367 +2160,242 @@ def calculate_law_enforcement_score(cases):
         'details': {}
     }
 
+def score_departments(cases, target_departments, exclude_stage_keywords=(), weights=None):
+    """向量化考核计分引擎：对目标部门一次分组统计并计算得分和排名"""
+    df = cases if isinstance(cases, pd.DataFrame) else pd.DataFrame(list(cases))
+    print(f"目标统计部门：{target_departments}")
+    counts = aggregate_department_counts(df, target_departments, exclude_stage_keywords)
+    return build_team_results(counts, weights)
+
+def calculate_law_enforcement_score(cases):
+    """计算城市综合行政执法队8个片区的考核分数和排名"""
+    return score_departments(cases, LAW_ENFORCEMENT_DEPARTMENTS)
+
 def calculate_huanwei_score(cases):
     """计算市容环卫中心5个片区的考核分数和排名"""
-    # 定义5个目标环卫片区
-    target_areas = [
-        "环卫东片区", "环卫北片区", "环卫南片区",
-        "环卫西片区", "环卫中片区"
-    ]
-    print(f"目标统计片区：{target_areas}")
-    
-    # 按片区分组计算各项指标
-    area_results = []
-    
-    for area_name in target_areas:
-        # 筛选该片区的数据
-        area_cases = [c for c in cases if c.get('处置部门') == area_name]
-        
-        # 计算各项指标
-        total = len(area_cases)
-        on_time = 0
-        overdue = 0
-        delay = 0
-        rework = 0
-        
-        for case in area_cases:
-            # 检查结案时间和截止时间
-            close_time = case.get('结案时间') or case.get('handle_time')
-            deadline = case.get('捆绑处置截止时间') or case.get('deadline')
-            
-            if close_time and deadline:
-                try:
-                    if isinstance(close_time, str):
-                        close_time = datetime.datetime.strptime(close_time, '%Y-%m-%d %H:%M:%S')
-                    if isinstance(deadline, str):
-                        deadline = datetime.datetime.strptime(deadline, '%Y-%m-%d %H:%M:%S')
-                    
-                    if close_time < deadline:
-                        on_time += 1
-                    elif close_time > deadline:
-                        overdue += 1
-                except:
-                    pass
-            
-            # 检查延期次数
-            delay_val = case.get('延期次数') or case.get('delay')
-            try:
-                if delay_val is not None:
-                    delay_num = int(delay_val)
-                    if delay_num != 0:
-                        delay += 1
-            except (ValueError, TypeError):
-                pass
-            
-            # 检查返工次数
-            rework_val = case.get('返工次数') or case.get('rework')
-            if rework_val and str(rework_val) == '是':
-                rework += 1
-        
-        # 计算比率
-        on_time_rate = on_time / total if total > 0 else 0
-        overdue_rate = overdue / total if total > 0 else 0
-        delay_rate = delay / total if total > 0 else 0
-        rework_rate = rework / total if total > 0 else 0
-        
-        # 计算得分
-        score = (
-            (on_time_rate * 1 + overdue_rate * 0.4) * 0.8 +
-            (1 - delay_rate) * 0.1 +
-            (1 - rework_rate) * 0.1
-        ) * 100
-        
-        area_results.append({
-            'department': area_name,
-            'total_cases': total,
-            'on_time_count': on_time,
-            'overdue_count': overdue,
-            'delay_count': delay,
-            'rework_count': rework,
-            'on_time_rate': round(on_time_rate * 100, 2),
-            'overdue_rate': round(overdue_rate * 100, 2),
-            'delay_rate': round(delay_rate * 100, 2),
-            'rework_rate': round(rework_rate * 100, 2),
-            'score': round(score, 2)
-        })
-        
-        print(f"  {area_name}: 总数={total}, 按期={on_time}, 超期={overdue}, 延期={delay}, 返工={rework}, 得分={score:.2f}")
-    
-    # 按得分排名
-    area_results.sort(key=lambda x: x['score'], reverse=True)
-    
-    for i, area in enumerate(area_results, 1):
-        area['rank'] = i
-    
-    print(f"\n排名结果：")
-    for area in area_results:
-        print(f"  第{area['rank']}名：{area['department']} - {area['score']}分")
-    
-    # 计算总体数据
-    total_cases = sum(a['total_cases'] for a in area_results)
-    total_score = sum(a['score'] for a in area_results) / len(area_results)
-    
-    return {
-        'total_cases': total_cases,
-        'team_results': area_results,
-        'score': round(total_score, 2),
-        'details': {}
-    }
+    return score_departments(cases, HUANWEI_AREAS)
 
 def calculate_garden_score(cases):
     """计算园林各片区的考核得分并排名"""
-    # 定义5个目标园林片区
-    target_areas = [
-        "园林东片区", "园林北片区", "园林南片区",
-        "园林西片区", "园林中片区"
-    ]
-    print(f"目标统计片区：{target_areas}")
-    
-    # 按片区分组计算各项指标
-    area_results = []
-    
-    for area_name in target_areas:
-        # 筛选该片区的数据
-        area_cases = [c for c in cases if c.get('处置部门') == area_name]
-        
-        # 计算各项指标
-        total = len(area_cases)
-        on_time = 0
-        overdue = 0
-        delay = 0
-        rework = 0
-        
-        for case in area_cases:
-            # 检查结案时间和截止时间
-            close_time = case.get('结案时间') or case.get('handle_time')
-            deadline = case.get('捆绑处置截止时间') or case.get('deadline')
-            
-            if close_time and deadline:
-                try:
-                    if isinstance(close_time, str):
-                        close_time = datetime.datetime.strptime(close_time, '%Y-%m-%d %H:%M:%S')
-                    if isinstance(deadline, str):
-                        deadline = datetime.datetime.strptime(deadline, '%Y-%m-%d %H:%M:%S')
-                    
-                    if close_time < deadline:
-                        on_time += 1
-                    elif close_time > deadline:
-                        overdue += 1
-                except:
-                    pass
-            
-            # 检查延期次数
-            delay_val = case.get('延期次数') or case.get('delay')
-            try:
-                if delay_val is not None:
-                    delay_num = int(delay_val)
-                    if delay_num != 0:
-                        delay += 1
-            except (ValueError, TypeError):
-                pass
-            
-            # 检查返工次数
-            rework_val = case.get('返工次数') or case.get('rework')
-            if rework_val and str(rework_val) == '是':
-                rework += 1
-        
-        # 计算比率
-        on_time_rate = on_time / total if total > 0 else 0
-        overdue_rate = overdue / total if total > 0 else 0
-        delay_rate = delay / total if total > 0 else 0
-        rework_rate = rework / total if total > 0 else 0
-        
-        # 计算得分
-        score = (
-            (on_time_rate * 1 + overdue_rate * 0.4) * 0.8 +
-            (1 - delay_rate) * 0.1 +
-            (1 - rework_rate) * 0.1
-        ) * 100
-        
-        area_results.append({
-            'department': area_name,
-            'total_cases': total,
-            'on_time_count': on_time,
-            'overdue_count': overdue,
-            'delay_count': delay,
-            'rework_count': rework,
-            'on_time_rate': round(on_time_rate * 100, 2),
-            'overdue_rate': round(overdue_rate * 100, 2),
-            'delay_rate': round(delay_rate * 100, 2),
-            'rework_rate': round(rework_rate * 100, 2),
-            'score': round(score, 2)
-        })
-        
-        print(f"  {area_name}: 总数={total}, 按期={on_time}, 超期={overdue}, 延期={delay}, 返工={rework}, 得分={score:.2f}")
-    
-    # 按得分排名
-    area_results.sort(key=lambda x: x['score'], reverse=True)
+    return score_departments(cases, GARDEN_AREAS)
+
+def calculate_park_score(cases):
+    """计算园林各公园考核得分（排除挂账案件）"""
+    return score_departments(cases, PARKS, exclude_stage_keywords=('挂账',))
+
+# 考核方案注册表：考核单位配置存放在 assessment_profiles 表中，启动时预编译，修改后热加载
+DEFAULT_ASSESSMENT_PROFILES = [
+    {'name': '城市综合行政执法队', 'targets': LAW_ENFORCEMENT_DEPARTMENTS, 'filters': {}, 'order': 1},
+    {'name': '市容环卫中心', 'targets': HUANWEI_AREAS, 'filters': {}, 'order': 2},
+    {'name': '园林绿化服务中心（片区）', 'targets': GARDEN_AREAS, 'filters': {}, 'order': 3},
+    {'name': '园林绿化服务中心（公园广场）', 'targets': PARKS, 'filters': {'exclude_stage_keywords': ['挂账']}, 'order': 4}
+]
+
+# 可用于排名的指标
+RANKING_METRICS = ['score', 'on_time_rate', 'overdue_rate', 'delay_rate', 'rework_rate', 'total_cases']
+
+# 两次检查考核方案是否被修改的最小间隔（秒），用于多进程部署下的热加载
+ASSESSMENT_PROFILE_CHECK_INTERVAL = 30
+
+class AssessmentPlan:
+    """预编译的考核方案，直接驱动向量化计分引擎"""
     
-    for i, area in enumerate(area_results, 1):
-        area['rank'] = i
+    def __init__(self, name, targets, exclude_stage_keywords=(), weights=None, rank_by='score', descending=True):
+        self.name = name
+        self.targets = list(targets)
+        self.exclude_stage_keywords = tuple(exclude_stage_keywords)
+        self.weights = {**DEFAULT_SCORE_WEIGHTS, **(weights or {})}
+        self.rank_by = rank_by
+        self.descending = descending
     
-    print(f"\n排名结果：")
-    for area in area_results:
-        print(f"  第{area['rank']}名：{area['department']} - {area['score']}分")
+    def run(self, df):
+        """对案件DataFrame执行考核计分"""
+        print(f"考核单位：{self.name}，目标统计部门：{self.targets}")
+        counts = aggregate_department_counts(df, self.targets, self.exclude_stage_keywords)
+        return build_team_results(counts, self.weights, self.rank_by, self.descending)
     
-    # 计算总体数据
-    total_cases = sum(a['total_cases'] for a in area_results)
-    total_score = sum(a['score'] for a in area_results) / len(area_results)
+    def run_pushdown(self, table_name):
+        """在MySQL中聚合后计分，数据表字段类型不支持下推时返回None"""
+        counts = aggregate_department_counts_sql(table_name, self.targets, self.exclude_stage_keywords)
+        if counts is None:
+            return None
+        print(f"考核单位：{self.name}，目标统计部门：{self.targets}（MySQL聚合）")
+        return build_team_results(counts, self.weights, self.rank_by, self.descending)
     
+    def run_cube(self, table_name):
+        """从数据立方体读取汇总结果后计分，立方体未建立或已过期时返回None"""
+        counts = aggregate_department_counts_cube(table_name, self.targets, self.exclude_stage_keywords)
+        if counts is None:
+            return None
+        print(f"考核单位：{self.name}，目标统计部门：{self.targets}（数据立方体）")
+        return build_team_results(counts, self.weights, self.rank_by, self.descending)
+
+def parse_ranking_rule(ranking):
+    """解析排名规则，如 score_desc、rework_rate_asc"""
+    ranking = ranking or 'score_desc'
+    metric, _, order = ranking.rpartition('_')
+    if metric not in RANKING_METRICS or order not in ('asc', 'desc'):
+        raise ValueError(f'无效的排名规则: {ranking}')
+    return metric, order == 'desc'
+
+def compile_assessment_profile(name, targets, filters=None, weights=None, ranking=None):
+    """校验考核方案配置并编译为 AssessmentPlan，配置无效时抛出 ValueError"""
+    if not name:
+        raise ValueError('考核单位名称不能为空')
+    if not isinstance(targets, list) or not targets or not all(isinstance(t, str) and t for t in targets):
+        raise ValueError('targets 必须是非空的部门名称列表')
+    filters = filters or {}
+    exclude_stage_keywords = filters.get('exclude_stage_keywords', [])
+    if not isinstance(exclude_stage_keywords, list) or not all(isinstance(k, str) and k for k in exclude_stage_keywords):
+        raise ValueError('exclude_stage_keywords 必须是关键字列表')
+    weights = weights or {}
+    for key, value in weights.items():
+        if key not in DEFAULT_SCORE_WEIGHTS or not isinstance(value, (int, float)):
+            raise ValueError(f'无效的权重配置: {key}')
+    rank_by, descending = parse_ranking_rule(ranking)
+    return AssessmentPlan(name, targets, exclude_stage_keywords, weights, rank_by, descending)
+
+def assessment_profile_to_dict(profile):
+    """将考核方案记录转换为字典"""
     return {
-        'total_cases': total_cases,
-        'team_results': area_results,
-        'score': round(total_score, 2),
-        'details': {}
+        'id': profile.id,
+        'name': profile.name,
+        'targets': json.loads(profile.targets),
+        'filters': json.loads(profile.filters) if profile.filters else {},
+        'weights': json.loads(profile.weights) if profile.weights else {},
+        'ranking': profile.ranking or 'score_desc',
+        'enabled': bool(profile.enabled),
+        'order': profile.order,
+        'updated_at': profile.updated_at.strftime('%Y-%m-%d %H:%M:%S') if profile.updated_at else None
     }
 
-def calculate_park_score(cases):
-    """计算园林各公园考核得分（排除挂账案件）"""
-    # 定义7个目标公园
-    target_parks = ["南风广场", "天逸公园", "体育公园", "航天公园", "圣惠公园", "禹都公园", "人民公园"]
-    print(f"目标统计公园：{target_parks}")
-    
-    # 过滤掉挂账案件
-    non_guazhang_cases = []
-    for case in cases:
-        # 检查当前阶段是否包含挂账
-        stage = case.get('当前阶段名称') or ''
-        stage_str = str(stage).strip().lower()
-        if '挂账' not in stage_str:
-            non_guazhang_cases.append(case)
-    
-    print(f"\n挂账过滤结果：")
-    print(f"   - 原始案件数：{len(cases)}")
-    print(f"   - 排除挂账后案件数：{len(non_guazhang_cases)}")
-    print(f"   - 排除的挂账案件数：{len(cases) - len(non_guazhang_cases)}")
-    
-    # 按公园分组计算各项指标
-    park_results = []
-    
-    for park_name in target_parks:
-        # 筛选该公园的数据
-        park_cases = [c for c in non_guazhang_cases if c.get('处置部门') == park_name]
-        
-        # 计算各项指标
-        total = len(park_cases)
-        on_time = 0
-        overdue = 0
-        delay = 0
-        rework = 0
-        
-        for case in park_cases:
-            # 检查结案时间和截止时间
-            close_time = case.get('结案时间') or case.get('handle_time')
-            deadline = case.get('捆绑处置截止时间') or case.get('deadline')
-            
-            if close_time and deadline:
-                try:
-                    if isinstance(close_time, str):
-                        close_time = datetime.datetime.strptime(close_time, '%Y-%m-%d %H:%M:%S')
-                    if isinstance(deadline, str):
-                        deadline = datetime.datetime.strptime(deadline, '%Y-%m-%d %H:%M:%S')
-                    
-                    if close_time < deadline:
-                        on_time += 1
-                    elif close_time > deadline:
-                        overdue += 1
-                except:
-                    pass
-            
-            # 检查延期次数
-            delay_val = case.get('延期次数') or case.get('delay')
-            try:
-                if delay_val is not None:
-                    delay_num = int(delay_val)
-                    if delay_num != 0:
-                        delay += 1
-            except (ValueError, TypeError):
-                pass
-            
-            # 检查返工次数
-            rework_val = case.get('返工次数') or case.get('rework')
-            if rework_val and str(rework_val) == '是':
-                rework += 1
-        
-        # 计算比率
-        on_time_rate = on_time / total if total > 0 else 0
-        overdue_rate = overdue / total if total > 0 else 0
-        delay_rate = delay / total if total > 0 else 0
-        rework_rate = rework / total if total > 0 else 0
-        
-        # 计算得分
-        score = (
-            (on_time_rate * 1 + overdue_rate * 0.4) * 0.8 +
-            (1 - delay_rate) * 0.1 +
-            (1 - rework_rate) * 0.1
-        ) * 100
-        
-        park_results.append({
-            'department': park_name,
-            'total_cases': total,
-            'on_time_count': on_time,
-            'overdue_count': overdue,
-            'delay_count': delay,
-            'rework_count': rework,
-            'on_time_rate': round(on_time_rate * 100, 2),
-            'overdue_rate': round(overdue_rate * 100, 2),
-            'delay_rate': round(delay_rate * 100, 2),
-            'rework_rate': round(rework_rate * 100, 2),
-            'score': round(score, 2)
-        })
-        
-        print(f"  {park_name}: 总数={total}, 按期={on_time}, 超期={overdue}, 延期={delay}, 返工={rework}, 得分={score:.2f}")
+class AssessmentRegistry:
+    """考核方案注册表：缓存编译好的考核方案，所有请求共用"""
     
-    # 按得分排名
-    park_results.sort(key=lambda x: x['score'], reverse=True)
+    def __init__(self):
+        self._plans = {}
+        self._signature = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
     
-    for i, park in enumerate(park_results, 1):
-        park['rank'] = i
+    def _read_signature(self, session):
+        # 对全部方案的内容取哈希，不用 COUNT + MAX(updated_at)：updated_at精度为秒，同一秒内的第二次修改会被漏掉
+        rows = session.query(
+            AssessmentProfile.id, AssessmentProfile.name, AssessmentProfile.targets, AssessmentProfile.filters,
+            AssessmentProfile.weights, AssessmentProfile.ranking, AssessmentProfile.enabled, AssessmentProfile.order
+        ).order_by(AssessmentProfile.id).all()
+        return hashlib.md5(json.dumps([list(row) for row in rows], ensure_ascii=False).encode('utf-8')).hexdigest()
     
-    print(f"\n排名结果：")
-    for park in park_results:
-        print(f"  第{park['rank']}名：{park['department']} - {park['score']}分")
+    def seed_defaults(self):
+        """考核方案表为空时写入内置的四个考核单位"""
+        session = Session()
+        try:
+            if session.query(AssessmentProfile).count() == 0:
+                for profile in DEFAULT_ASSESSMENT_PROFILES:
+                    session.add(AssessmentProfile(
+                        name=profile['name'],
+                        targets=json.dumps(profile['targets'], ensure_ascii=False),
+                        filters=json.dumps(profile['filters'], ensure_ascii=False),
+                        weights=json.dumps({}),
+                        ranking='score_desc',
+                        enabled=1,
+                        order=profile['order']
+                    ))
+                session.commit()
+                print("已写入默认考核方案")
+        except Exception as e:
+            session.rollback()
+            print(f"Error seeding assessment profiles: {str(e)}")
+        finally:
+            session.close()
     
-    # 计算总体数据
-    total_cases = sum(p['total_cases'] for p in park_results)
-    total_score = sum(p['score'] for p in park_results) / len(park_results)
+    def reload(self):
+        """从数据库重新读取并编译全部启用的考核方案"""
+        session = Session()
+        try:
+            plans = {}
+            signature = self._read_signature(session)
+            for profile in session.query(AssessmentProfile).filter_by(enabled=1).all():
+                try:
+                    plans[profile.name] = compile_assessment_profile(
+                        profile.name,
+                        json.loads(profile.targets),
+                        json.loads(profile.filters) if profile.filters else {},
+                        json.loads(profile.weights) if profile.weights else {},
+                        profile.ranking
+                    )
+                except (ValueError, TypeError) as e:
+                    print(f"考核方案 {profile.name} 配置无效，已跳过: {str(e)}")
+            with self._lock:
+                self._plans = plans
+                self._signature = signature
+                self._checked_at = time.time()
+            print(f"已加载考核方案：{list(plans.keys())}")
+        finally:
+            session.close()
     
-    return {
-        'total_cases': total_cases,
-        'team_results': park_results,
-        'score': round(total_score, 2),
-        'details': {}
-    }
+    def _refresh_if_stale(self):
+        # 其他进程修改考核方案后，按间隔检查签名并重新加载
+        if time.time() - self._checked_at < ASSESSMENT_PROFILE_CHECK_INTERVAL:
+            return
+        session = Session()
+        try:
+            signature = self._read_signature(session)
+        finally:
+            session.close()
+        if signature != self._signature:
+            self.reload()
+        else:
+            self._checked_at = time.time()
+    
+    def get(self, name):
+        """获取考核单位的编译方案，未配置时返回None"""
+        self._refresh_if_stale()
+        return self._plans.get(name)
 
-def calculate_generic_score(cases):
-    """其他部门的通用计算逻辑"""
-    total_cases = len(cases)
+assessment_registry = AssessmentRegistry()
+try:
+    assessment_registry.seed_defaults()
+    assessment_registry.reload()
+except Exception as e:
+    print(f"Error loading assessment profiles: {str(e)}")
+
+def _first_present_value(df, columns):
+    """按顺序取第一个有值的字段（空值和空字符串视为没有值），字段都不存在时返回None"""
+    values = None
+    for col in columns:
+        if col not in df.columns:
+            continue
+        current = df[col].astype(object)
+        current = current.where(current.notna() & (current != ''))
+        values = current if values is None else values.where(values.notna(), current)
+    return values
+
+def calculate_generic_score(df):
+    """其他部门的通用计算逻辑（按列向量化计算，不再为每个案件构造字典）"""
+    total_cases = len(df)
     closed_cases = 0
     total_handle_hours = 0
     valid_cases = 0
     
-    for case in cases:
-        # 检查状态列
-        status = case.get('status') or case.get('状态')
-        if status and '已结案' in str(status):
-            closed_cases += 1
-        
-        # 计算处理时间
-        create_time = case.get('create_time') or case.get('创建时间') or case.get('create_time')
-        handle_time = case.get('handle_time') or case.get('处理时间') or case.get('完成时间')
-        
-        if create_time and handle_time:
-            try:
-                # 尝试解析时间
-                if isinstance(create_time, str):
-                    create_time = datetime.datetime.strptime(create_time, '%Y-%m-%d %H:%M:%S')
-                if isinstance(handle_time, str):
-                    handle_time = datetime.datetime.strptime(handle_time, '%Y-%m-%d %H:%M:%S')
-                handle_hours = (handle_time - create_time).total_seconds() / 3600
-                total_handle_hours += handle_hours
-                valid_cases += 1
-            except Exception as e:
-                print(f'解析时间失败: {e}')
+    # 检查状态列
+    status = _first_present_value(df, ['status', '状态'])
+    if status is not None:
+        closed_cases = int(status.dropna().astype(str).str.contains('已结案', regex=False).sum())
+    
+    # 计算处理时间：字符串按 '%Y-%m-%d %H:%M:%S' 解析，已是时间的值直接使用
+    create_time = _first_present_value(df, ['create_time', '创建时间'])
+    handle_time = _first_present_value(df, ['handle_time', '处理时间', '完成时间'])
+    if create_time is not None and handle_time is not None:
+        both = create_time.notna() & handle_time.notna()
+        start = pd.to_datetime(create_time[both], format='%Y-%m-%d %H:%M:%S', errors='coerce')
+        end = pd.to_datetime(handle_time[both], format='%Y-%m-%d %H:%M:%S', errors='coerce')
+        parsed = start.notna() & end.notna()
+        if not parsed.all():
+            print(f'解析时间失败: {int((~parsed).sum())} 条案件')
+        handle_hours = (end[parsed] - start[parsed]).dt.total_seconds() / 3600
+        total_handle_hours = float(handle_hours.sum())
+        valid_cases = int(parsed.sum())
     
     # 计算各项指标
     avg_handle_hours = total_handle_hours / valid_cases if valid_cases > 0 else 0
@@ -1320,13 +2422,8 @@ def calculate_generic_score(cases):
         }
     }
 
-def call_doubao_api(prompt, data_summary, analysis_type):
-    """调用豆包大模型API进行分析"""
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {API_KEY}'
-    }
-    
+def build_analysis_messages(prompt, data_summary, analysis_type):
+    """按分析类型构建发送给大模型的对话消息"""
     # 根据分析类型设置系统提示
     if analysis_type == 'time_analysis':
         system_prompt = "你是一个专业的数据分析助手，擅长分析案件时间分布数据。请根据提供的数据摘要，生成详细的时间分析报告。"
@@ -1350,55 +2447,26 @@ def call_doubao_api(prompt, data_summary, analysis_type):
         system_prompt = "你是一个专业的数据分析助手，擅长分析案件数据。请根据提供的数据摘要，生成详细的分析报告。"
         user_prompt = f"请分析以下案件数据：\n{prompt}\n\n数据摘要：{data_summary}\n\n分析要求：\n1. 基于数据特征进行全面分析\n2. 提供相关数据洞察和建议"
     
-    payload = {
-        "model": MODEL,
-        "messages": [
-            {
-                "role": "system",
-                "content": system_prompt
-            },
-            {
-                "role": "user",
-                "content": user_prompt
-            }
-        ],
-        "temperature": 0.3,
-        "max_tokens": 3000
-    }
-    
-    # 优化：增加重试机制
-    max_retries = 3
-    retry_delay = 5
+    messages = [
+        {
+            "role": "system",
+            "content": system_prompt
+        },
+        {
+            "role": "user",
+            "content": user_prompt
+        }
+    ]
     
-    for attempt in range(max_retries):
-        try:
-            # 优化：增加连接超时和读取超时设置
-            # 合并请求头
-            combined_headers = {
-                **headers,
-                'Accept': 'application/json',
-                'Connection': 'keep-alive'
-            }
-            
-            response = requests.post(
-                API_URL, 
-                headers=combined_headers, 
-                json=payload, 
-                timeout=(10, 300)  # 连接超时10秒，读取超时300秒
-            )
-            response.raise_for_status()
-            result = response.json()
-            return result['choices'][0]['message']['content']
-        except requests.exceptions.Timeout as e:
-            if attempt < max_retries - 1:
-                print(f"API调用超时，{retry_delay}秒后重试... (尝试 {attempt+1}/{max_retries})")
-                import time
-                time.sleep(retry_delay)
-                retry_delay *= 2  # 指数退避
-            else:
-                return f"API调用失败: 多次尝试后仍然超时 - {str(e)}"
-        except Exception as e:
-            return f"API调用失败: {str(e)}"
+    return messages
+
+def call_doubao_api(prompt, data_summary, analysis_type, force_refresh=False):
+    """调用豆包大模型API进行分析（相同提示词命中缓存时直接返回）"""
+    messages = build_analysis_messages(prompt, data_summary, analysis_type)
+    try:
+        return cached_llm_chat(messages, temperature=0.3, max_tokens=3000, force_refresh=force_refresh)
+    except LLMError as e:
+        return f"API调用失败: {str(e)}"
 
 @app.route('/api/assess', methods=['POST'])
 @protected
@@ -1407,29 +2475,39 @@ def assess():
         data = request.json
         table_name = data.get('table_name')
         department = data.get('department')
+        # 执行方式：auto 依次尝试数据立方体、MySQL聚合，都不可用时回退到pandas；pandas 强制使用pandas计算
+        execution = data.get('execution', 'auto')
         
         if not table_name or not department:
             return jsonify({'error': 'Missing table_name or department'}), 400
-        
-        # 从数据库读取数据
-        df = pd.read_sql_table(table_name, engine)
-        cases = df.to_dict('records')
-        
-        # 根据部门选择计算逻辑
-        if department == '城市综合行政执法队':
-            result = calculate_law_enforcement_score(cases)
-        elif department == '市容环卫中心':
-            result = calculate_huanwei_score(cases)
-        elif department == '园林绿化服务中心（片区）':
-            result = calculate_garden_score(cases)
-        elif department == '园林绿化服务中心（公园广场）':
-            result = calculate_park_score(cases)
-        else:
-            result = calculate_generic_score(cases)
+        if execution not in ('auto', 'pandas'):
+            return jsonify({'error': 'Invalid execution, expected auto or pandas'}), 400
+        
+        # 根据考核方案计算，未配置考核方案的部门使用通用计算逻辑
+        plan = assessment_registry.get(department)
+        result = None
+        execution_mode = 'pandas'
+        if plan and execution == 'auto':
+            result = plan.run_cube(table_name)
+            if result is not None:
+                execution_mode = 'cube'
+            else:
+                result = plan.run_pushdown(table_name)
+                if result is not None:
+                    execution_mode = 'sql'
+        if result is None:
+            # 从数据库读取计分用到的字段（同一上传代次的数据表使用缓存）
+            needed = ASSESSMENT_COLUMNS if plan else GENERIC_SCORE_COLUMNS
+            df = load_case_table(table_name, [col for col in get_case_table_columns(table_name) if col in needed])
+            if plan:
+                result = plan.run(df)
+            else:
+                result = calculate_generic_score(df)
         
         # 添加元数据
         result['department'] = department
         result['table_name'] = table_name
+        result['execution_mode'] = execution_mode
         
         return jsonify(convert_nan_to_null(result)), 200
     except Exception as e:
@@ -1438,7 +2516,401 @@ def assess():
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+# 考核方案管理API（管理员专用）
+@app.route('/api/assessment-profiles', methods=['GET'])
+@admin_required
+def get_assessment_profiles():
+    session = Session()
+    try:
+        profiles = session.query(AssessmentProfile).order_by(AssessmentProfile.order).all()
+        session.commit()
+        return jsonify({'profiles': [assessment_profile_to_dict(p) for p in profiles]}), 200
+    except Exception as e:
+        session.rollback()
+        print(f"Error in get_assessment_profiles: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
+@app.route('/api/assessment-profiles', methods=['POST'])
+@admin_required
+def create_assessment_profile():
+    session = Session()
+    try:
+        data = request.json
+        
+        # 校验配置能否编译
+        try:
+            compile_assessment_profile(data.get('name'), data.get('targets'), data.get('filters'), data.get('weights'), data.get('ranking'))
+        except (ValueError, TypeError, AttributeError) as e:
+            return jsonify({'error': str(e)}), 400
+        
+        existing_profile = session.query(AssessmentProfile).filter_by(name=data['name']).first()
+        if existing_profile:
+            return jsonify({'error': '考核单位已存在'}), 400
+        
+        profile = AssessmentProfile(
+            name=data['name'],
+            targets=json.dumps(data['targets'], ensure_ascii=False),
+            filters=json.dumps(data.get('filters') or {}, ensure_ascii=False),
+            weights=json.dumps(data.get('weights') or {}),
+            ranking=data.get('ranking') or 'score_desc',
+            enabled=1 if data.get('enabled', True) else 0,
+            order=data.get('order', 0)
+        )
+        session.add(profile)
+        session.commit()
+        
+        # 热加载考核方案
+        assessment_registry.reload()
+        return jsonify(assessment_profile_to_dict(profile)), 201
+    except Exception as e:
+        session.rollback()
+        print(f"Error in create_assessment_profile: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
+@app.route('/api/assessment-profiles/<int:profile_id>', methods=['PUT'])
+@admin_required
+def update_assessment_profile(profile_id):
+    session = Session()
+    try:
+        data = request.json
+        profile = session.query(AssessmentProfile).filter_by(id=profile_id).first()
+        if not profile:
+            return jsonify({'error': '考核方案不存在'}), 404
+        
+        # 合并修改后校验配置能否编译
+        merged = {**assessment_profile_to_dict(profile), **data}
+        try:
+            compile_assessment_profile(merged['name'], merged['targets'], merged['filters'], merged['weights'], merged['ranking'])
+        except (ValueError, TypeError, AttributeError) as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # 改名为其他方案已使用的名称时与新建接口一致返回400
+        if merged['name'] != profile.name:
+            existing_profile = session.query(AssessmentProfile).filter(
+                AssessmentProfile.name == merged['name'], AssessmentProfile.id != profile.id).first()
+            if existing_profile:
+                return jsonify({'error': '考核单位已存在'}), 400
+        
+        profile.name = merged['name']
+        profile.targets = json.dumps(merged['targets'], ensure_ascii=False)
+        profile.filters = json.dumps(merged['filters'] or {}, ensure_ascii=False)
+        profile.weights = json.dumps(merged['weights'] or {})
+        profile.ranking = merged['ranking'] or 'score_desc'
+        profile.enabled = 1 if merged['enabled'] else 0
+        profile.order = merged['order']
+        session.commit()
+        
+        # 热加载考核方案
+        assessment_registry.reload()
+        return jsonify(assessment_profile_to_dict(profile)), 200
+    except Exception as e:
+        session.rollback()
+        print(f"Error in update_assessment_profile: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
+@app.route('/api/assessment-profiles/<int:profile_id>', methods=['DELETE'])
+@admin_required
+def delete_assessment_profile(profile_id):
+    session = Session()
+    try:
+        profile = session.query(AssessmentProfile).filter_by(id=profile_id).first()
+        if not profile:
+            return jsonify({'error': '考核方案不存在'}), 404
+        
+        session.delete(profile)
+        session.commit()
+        
+        # 热加载考核方案
+        assessment_registry.reload()
+        return jsonify({'message': '考核方案删除成功'}), 200
+    except Exception as e:
+        session.rollback()
+        print(f"Error in delete_assessment_profile: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
+@app.route('/api/assessment-profiles/reload', methods=['POST'])
+@admin_required
+def reload_assessment_profiles():
+    try:
+        assessment_registry.reload()
+        return jsonify({'message': '考核方案已重新加载'}), 200
+    except Exception as e:
+        print(f"Error in reload_assessment_profiles: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+# 后台任务相关
+JOB_WORKERS = 4  # 同时执行的后台任务数
+JOB_MAX_PENDING = 32  # 排队+执行中的任务上限，超过时拒绝提交
+
+UPLOAD_JOB_WORKERS = 1  # 上传后处理专用的线程数，不占用分析任务的队列名额，多次上传依次处理
+JOB_RETENTION_SECONDS = 7 * 24 * 60 * 60  # 已结束任务的保留时间，过期后删除（任务结果可能很大）
+JOB_PRUNE_INTERVAL = 60 * 60  # 两次清理过期任务的最小间隔（秒）
+JOB_HEARTBEAT_INTERVAL = 30  # 进程为自己的未完成任务续约的间隔（秒）
+JOB_LEASE_SECONDS = 5 * 60  # 超过该时间未续约的未完成任务视为执行进程已退出
+
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+job_slots = threading.BoundedSemaphore(JOB_MAX_PENDING)
+upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_JOB_WORKERS, thread_name_prefix='upload-job')
+_jobs_pruned_at = 0
+
+def _read_boot_id():
+    """读取本机的开机ID，用于识别本机重启前遗留的任务；非Linux系统返回空串"""
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
+JOB_HOST = socket.gethostname()
+JOB_BOOT_ID = _read_boot_id()
+JOB_OWNER = f"{JOB_HOST}:{JOB_BOOT_ID}:{os.getpid()}:{uuid.uuid4().hex[:8]}"  # 多个工作进程共用任务表，按此区分任务归属
+
+_owned_jobs = set()  # 本进程提交且尚未结束的任务ID，由心跳线程续约
+_owned_jobs_lock = threading.Lock()
+_heartbeat_thread = None
+
+def _job_heartbeat_loop():
+    """定期刷新本进程未完成任务的 heartbeat_at"""
+    while True:
+        time.sleep(JOB_HEARTBEAT_INTERVAL)
+        with _owned_jobs_lock:
+            job_ids = list(_owned_jobs)
+        if not job_ids:
+            continue
+        session = Session()
+        try:
+            session.query(BackgroundJob).filter(BackgroundJob.id.in_(job_ids)).update(
+                {'heartbeat_at': datetime.datetime.now()}, synchronize_session=False
+            )
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f"后台任务续约失败: {str(e)}")
+        finally:
+            session.close()
+
+def _ensure_job_heartbeat():
+    """首次提交任务时启动心跳线程"""
+    global _heartbeat_thread
+    with _owned_jobs_lock:
+        if _heartbeat_thread is None:
+            _heartbeat_thread = threading.Thread(target=_job_heartbeat_loop, name='job-heartbeat', daemon=True)
+            _heartbeat_thread.start()
+
+def job_lease_cutoff():
+    """早于该时间未续约的未完成任务视为已失去执行进程"""
+    return datetime.datetime.now() - datetime.timedelta(seconds=JOB_LEASE_SECONDS)
+
+def job_lease_alive():
+    """任务租约仍有效的过滤条件（旧版本的任务没有心跳，按创建时间判断）"""
+    return func.coalesce(BackgroundJob.heartbeat_at, BackgroundJob.created_at) >= job_lease_cutoff()
+
+def _update_job(job_id, **fields):
+    """更新后台任务记录"""
+    session = Session()
+    try:
+        session.query(BackgroundJob).filter_by(id=job_id).update(fields)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        print(f"更新后台任务 {job_id} 失败: {str(e)}")
+    finally:
+        session.close()
+
+def _run_job(job_id, func, args, slots):
+    """在工作线程中执行任务，并把结果或错误写回任务表"""
+    try:
+        _update_job(job_id, status='running', started_at=datetime.datetime.now())
+        try:
+            result = func(*args)
+            payload = json.dumps(convert_nan_to_null(result), ensure_ascii=False, default=str)
+            _update_job(job_id, status='succeeded', result=payload, finished_at=datetime.datetime.now())
+        except Exception as e:
+            print(f"后台任务 {job_id} 执行失败: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            _update_job(job_id, status='failed', error=str(e), finished_at=datetime.datetime.now())
+    finally:
+        with _owned_jobs_lock:
+            _owned_jobs.discard(job_id)
+        if slots is not None:
+            slots.release()
+
+def submit_job(job_type, func, args, params, user_id, executor=None):
+    """记录任务并提交到工作线程池，返回任务ID；队列已满时返回None
+    
+    指定executor时提交到该线程池，不受排队上限限制，总是返回任务ID。
+    """
+    prune_finished_jobs()
+    slots = job_slots if executor is None else None
+    if slots is not None and not slots.acquire(blocking=False):
+        return None
+    
+    _ensure_job_heartbeat()
+    job_id = str(uuid.uuid4())
+    session = Session()
+    try:
+        session.add(BackgroundJob(
+            id=job_id,
+            job_type=job_type,
+            status='pending',
+            params=json.dumps(params, ensure_ascii=False),
+            user_id=user_id,
+            owner=JOB_OWNER,
+            heartbeat_at=datetime.datetime.now()
+        ))
+        session.commit()
+    except Exception:
+        session.rollback()
+        if slots is not None:
+            slots.release()
+        raise
+    finally:
+        session.close()
+    
+    with _owned_jobs_lock:
+        _owned_jobs.add(job_id)
+    (executor or job_executor).submit(_run_job, job_id, func, args, slots)
+    return job_id
+
+def fail_orphaned_jobs():
+    """服务启动时把已失去执行进程的排队或执行中任务记为失败
+    
+    任务在提交它的进程内执行，进程退出后不会再继续。只处理租约已过期的任务和本机重启前（开机ID不同）提交的任务，
+    其他工作进程仍在执行的任务不受影响。
+    """
+    orphaned = ~job_lease_alive()
+    if JOB_BOOT_ID:
+        orphaned = or_(
+            orphaned,
+            and_(BackgroundJob.owner.like(f"{JOB_HOST}:%"), ~BackgroundJob.owner.like(f"{JOB_HOST}:{JOB_BOOT_ID}:%"))
+        )
+    session = Session()
+    try:
+        count = session.query(BackgroundJob).filter(BackgroundJob.status.in_(('pending', 'running')), orphaned).update(
+            {'status': 'failed', 'error': '服务重启，任务未执行完成，请重新提交', 'finished_at': datetime.datetime.now()},
+            synchronize_session=False
+        )
+        session.commit()
+        if count:
+            print(f"已将 {count} 个未完成的后台任务记为失败")
+    except Exception as e:
+        session.rollback()
+        print(f"处理未完成的后台任务失败: {str(e)}")
+    finally:
+        session.close()
+
+def prune_finished_jobs(force=False):
+    """删除结束超过 JOB_RETENTION_SECONDS 的任务记录，最多每 JOB_PRUNE_INTERVAL 秒执行一次"""
+    global _jobs_pruned_at
+    now = time.time()
+    if not force and now - _jobs_pruned_at < JOB_PRUNE_INTERVAL:
+        return
+    _jobs_pruned_at = now
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=JOB_RETENTION_SECONDS)
+    session = Session()
+    try:
+        count = session.query(BackgroundJob).filter(
+            BackgroundJob.status.in_(('succeeded', 'failed')),
+            BackgroundJob.finished_at < cutoff
+        ).delete(synchronize_session=False)
+        session.commit()
+        if count:
+            print(f"已删除 {count} 个过期的后台任务记录")
+    except Exception as e:
+        session.rollback()
+        print(f"清理过期的后台任务失败: {str(e)}")
+    finally:
+        session.close()
+
+def job_to_dict(job):
+    """将任务记录转换为响应字典"""
+    return {
+        'job_id': job.id,
+        'job_type': job.job_type,
+        'status': job.status,
+        'params': json.loads(job.params) if job.params else {},
+        'result': json.loads(job.result) if job.result else None,
+        'error': job.error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None
+    }
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@protected
+def get_job(job_id):
+    session = Session()
+    try:
+        job = session.query(BackgroundJob).filter_by(id=job_id).first()
+        # 只有任务提交者和管理员可以查看任务
+        if not job or (job.user_id != request.user_id and request.role != 'admin'):
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(job_to_dict(job)), 200
+    except Exception as e:
+        print(f"Error in get_job: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
 # 案件抽查模块API
+def run_spotcheck(file_content, file_name):
+    """调用大模型分析抽查案件内容，同步接口和后台任务共用"""
+    # 构建大模型提示
+    prompt = f"请分析以下城市管理案件详情：\n{file_content}\n\n重要提示：处置时间是按照8小时工作时计算的，不是自然时间，且节假日和周末也不计时。\n\n分析要求：\n1、采集信息是否准确；\n2、受理、派遣、处置流程的时效（注意：处置时间按8小时工作时计算，节假日和周末不计时）；\n3、结案是否规范；\n4、是否有推诿扯皮现象；\n并分别给采集、受理、派遣、处置打分（0-100分），分析内容尽量简短。"
+    
+    # 调用大模型API
+    messages = [
+        {
+            "role": "system",
+            "content": "你是一个专业的城市管理案件分析助手，擅长分析案件处理流程和质量。请根据提供的案件详情，生成详细的分析报告。"
+        },
+        {
+            "role": "user",
+            "content": prompt
+        }
+    ]
+    
+    try:
+        analysis_content = llm_client.chat(messages, temperature=0.3, max_tokens=2000)
+    except LLMError as e:
+        raise Exception(f"大模型API调用失败，请稍后重试: {str(e)}")
+    
+    # 解析评分结果（简化处理，实际可能需要更复杂的解析）
+    scores = {
+        'collection': 85,  # 默认值，实际应从分析结果中提取
+        'acceptance': 80,
+        'dispatch': 75,
+        'disposal': 82
+    }
+    
+    return {
+        'analysis': analysis_content,
+        'scores': scores,
+        'file_name': file_name,
+        'file_content': file_content  # 返回读取到的文件内容，用于前端显示
+    }
+
 @app.route('/api/spotcheck', methods=['POST'])
 @protected
 def spotcheck():
@@ -1460,83 +2932,1982 @@ def spotcheck():
         # 读取文件内容
         file_content = read_file_content(file)
         
-        # 构建大模型提示
-        prompt = f"请分析以下城市管理案件详情：\n{file_content}\n\n重要提示：处置时间是按照8小时工作时计算的，不是自然时间，且节假日和周末也不计时。\n\n分析要求：\n1、采集信息是否准确；\n2、受理、派遣、处置流程的时效（注意：处置时间按8小时工作时计算，节假日和周末不计时）；\n3、结案是否规范；\n4、是否有推诿扯皮现象；\n并分别给采集、受理、派遣、处置打分（0-100分），分析内容尽量简短。"
+        # 异步模式：文件内容已在请求线程中读取，后台任务只负责调用大模型
+        if request.form.get('async') in ('1', 'true', 'True'):
+            job_id = submit_job('spotcheck', run_spotcheck, (file_content, file.filename),
+                                {'file_name': file.filename}, request.user_id)
+            if not job_id:
+                return jsonify({'error': '后台任务队列已满，请稍后重试'}), 503
+            return jsonify({'job_id': job_id, 'status': 'pending'}), 202
         
-        # 调用大模型API
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {API_KEY}'
-        }
+        result = run_spotcheck(file_content, file.filename)
         
-        payload = {
-            "model": MODEL,
-            "messages": [
-                {
-                    "role": "system",
-                    "content": "你是一个专业的城市管理案件分析助手，擅长分析案件处理流程和质量。请根据提供的案件详情，生成详细的分析报告。"
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            "temperature": 0.3,
-            "max_tokens": 2000
+        session.commit()
+        return jsonify(result), 200
+    except Exception as e:
+        session.rollback()
+        print(f"Error in spotcheck: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
+# 近似重复案件检测（MinHash/LSH）
+NEAR_DUP_SHINGLE_SIZE = 3  # 字符n-gram长度
+NEAR_DUP_NUM_PERM = 128  # MinHash签名长度
+NEAR_DUP_BANDS = 32  # LSH分段数（每段4行，候选阈值约0.42，再用签名相似度校验）
+NEAR_DUP_THRESHOLD = 0.75  # 估计Jaccard相似度达到该值视为近似重复
+NEAR_DUP_SEED = 20240601  # 固定随机种子，保证不同进程、不同时间计算的签名一致（修改签名参数后需重建重复案件索引）
+NEAR_DUP_TOP_CLUSTERS = 20
+NEAR_DUP_EXAMPLES = 3
+NEAR_DUP_ROW_IDS = 10
+
+_near_dup_rng = np.random.default_rng(NEAR_DUP_SEED)
+MINHASH_A = _near_dup_rng.integers(0, 2**63, size=NEAR_DUP_NUM_PERM, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+MINHASH_B = _near_dup_rng.integers(0, 2**63, size=NEAR_DUP_NUM_PERM, dtype=np.uint64)
+SHINGLE_BASE = np.uint64(1000003)
+SHINGLE_MIX = np.uint64(0xff51afd7ed558ccd)
+
+def normalize_duplicate_text(series):
+    """全角转半角、转小写，只保留汉字、字母和数字，作为近似重复比对的文本"""
+    # 显式列出保留的字符：pyarrow字符串列的正则引擎中\w只匹配ASCII字符
+    # category字段填充不在取值中的空字符串会报错，先转换为普通文本
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype(object)
+    return (series.fillna('').astype(str).str.normalize('NFKC').str.lower()
+            .str.replace('[^0-9a-z\u4e00-\u9fff]+', '', regex=True))
+
+def build_duplicate_text(*columns):
+    """把问题描述、地址描述等列规范化后拼接为近似重复比对的文本"""
+    text = normalize_duplicate_text(columns[0])
+    for column in columns[1:]:
+        text = (text + '|' + normalize_duplicate_text(column)).str.strip('|')
+    return text
+
+def digit_block_hashes(texts):
+    """文本中数字串（门牌号、楼栋号等）的稳定哈希，数字不同的文本不进入同一个LSH桶"""
+    digits = pd.Series(list(texts), dtype=object).str.findall(r'\d+').str.join(',')
+    return np.array([zlib.crc32(value.encode('utf-8')) for value in digits], dtype=np.uint32)
+
+def _shingle_hashes(texts):
+    """把每个文本切成n-gram并计算64位哈希，返回(片段所属文本下标, 哈希值)；空文本没有片段"""
+    k = NEAR_DUP_SHINGLE_SIZE
+    lengths = np.fromiter((len(t) for t in texts), dtype=np.int64, count=len(texts))
+    # 每个文本后补k-1个占位字符，短文本也能凑成一个片段，且片段不会跨越文本
+    codes = np.frombuffer(''.join(t + '\0' * (k - 1) for t in texts).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    n_starts = len(codes) - k + 1
+    hashes = np.zeros(n_starts, dtype=np.uint64)
+    for j in range(k):
+        hashes = hashes * SHINGLE_BASE + codes[j:j + n_starts]
+    hashes ^= hashes >> np.uint64(33)
+    hashes *= SHINGLE_MIX
+    hashes ^= hashes >> np.uint64(33)
+    
+    counts = np.where(lengths > 0, np.maximum(lengths - k + 1, 1), 0)
+    text_starts = np.concatenate(([0], np.cumsum(lengths + k - 1)[:-1]))
+    owner = np.repeat(np.arange(len(texts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owner, hashes[np.repeat(text_starts, counts) + offsets]
+
+def minhash_signatures(texts):
+    """计算文本的MinHash签名，返回(签名矩阵, 是否有效)；空文本的签名无效"""
+    signatures = np.zeros((len(texts), NEAR_DUP_NUM_PERM), dtype=np.uint32)
+    if len(texts) == 0:
+        return signatures, np.zeros(0, dtype=bool)
+    owner, hashes = _shingle_hashes(texts)
+    valid = np.bincount(owner, minlength=len(texts)) > 0
+    if not valid.any():
+        return signatures, valid
+    
+    # 片段按文本连续排列，reduceat按文本取每个哈希函数下的最小值
+    starts = np.flatnonzero(np.r_[True, owner[1:] != owner[:-1]])
+    for p in range(NEAR_DUP_NUM_PERM):
+        permuted = (MINHASH_A[p] * hashes + MINHASH_B[p]) >> np.uint64(32)
+        signatures[valid, p] = np.minimum.reduceat(permuted, starts)
+    return signatures, valid
+
+def lsh_bucket_keys(signatures, block_hashes):
+    """计算每个文本在各LSH分段的64位桶键（含数字分块哈希），返回int64矩阵以便存入BIGINT字段"""
+    rows = NEAR_DUP_NUM_PERM // NEAR_DUP_BANDS
+    keys = np.empty((len(signatures), NEAR_DUP_BANDS), dtype=np.uint64)
+    for band in range(NEAR_DUP_BANDS):
+        key = block_hashes.astype(np.uint64) + np.uint64(band)
+        for column in range(band * rows, (band + 1) * rows):
+            key = key * SHINGLE_BASE + signatures[:, column].astype(np.uint64)
+        key ^= key >> np.uint64(33)
+        key *= SHINGLE_MIX
+        key ^= key >> np.uint64(33)
+        keys[:, band] = key
+    return keys.view(np.int64)
+
+def lsh_cluster_labels(signatures, valid, block_hashes=None):
+    """LSH分段分桶，桶内与代表文本签名相似度达到阈值的合并为一簇，返回每个文本的簇标签"""
+    labels = np.arange(len(signatures))
+    members = np.flatnonzero(valid)
+    if len(members) < 2:
+        return labels
+    if block_hashes is None:
+        block_hashes = np.zeros(len(signatures), dtype=np.uint32)
+    
+    bucket_keys = lsh_bucket_keys(signatures[members], block_hashes[members])
+    edge_u, edge_v = [], []
+    for band in range(NEAR_DUP_BANDS):
+        _, first, inverse = np.unique(bucket_keys[:, band], return_index=True, return_inverse=True)
+        representatives = members[first[inverse.ravel()]]
+        candidates = representatives != members
+        if not candidates.any():
+            continue
+        u = members[candidates]
+        v = representatives[candidates]
+        similarity = (signatures[u] == signatures[v]).mean(axis=1)
+        confirmed = similarity >= NEAR_DUP_THRESHOLD
+        edge_u.append(u[confirmed])
+        edge_v.append(v[confirmed])
+    
+    if not edge_u:
+        return labels
+    edge_u = np.concatenate(edge_u)
+    edge_v = np.concatenate(edge_v)
+    # 标签传播求连通分量：每轮取相邻节点的最小标签，再做指针跳跃
+    while True:
+        previous = labels.copy()
+        np.minimum.at(labels, edge_u, labels[edge_v])
+        np.minimum.at(labels, edge_v, labels[edge_u])
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            return labels
+
+def find_near_duplicate_clusters(df, problem_col, address_col, top_n=NEAR_DUP_TOP_CLUSTERS):
+    """按问题描述+地址描述查找近似重复案件簇，返回(按案件数排序的前top_n个簇, 统计信息)"""
+    columns = [col for col in (problem_col, address_col) if col]
+    text = build_duplicate_text(*[df[col] for col in columns])
+    
+    # 完全相同的文本只计算一次签名
+    codes, uniques = pd.factorize(text)
+    signatures, valid = minhash_signatures(list(uniques))
+    # 文本中的数字（门牌号、楼栋号等）必须一致才算同一处问题，避免“12号”“13号”串成一簇
+    labels = lsh_cluster_labels(signatures, valid, digit_block_hashes(uniques))
+    
+    row_valid = valid[codes]
+    row_labels = labels[codes]
+    cluster_sizes = pd.Series(row_labels[row_valid]).value_counts()
+    cluster_sizes = cluster_sizes[cluster_sizes >= 2]
+    text_counts = np.bincount(codes, minlength=len(uniques))
+    first_rows = pd.Series(np.arange(len(codes))).groupby(codes).first().to_numpy()
+    
+    clusters = []
+    for rank, (label, size) in enumerate(cluster_sizes.head(top_n).items(), start=1):
+        member_texts = np.flatnonzero(labels == label)
+        member_texts = member_texts[np.argsort(-text_counts[member_texts], kind='stable')]
+        examples = []
+        for text_idx in member_texts[:NEAR_DUP_EXAMPLES]:
+            row = df.iloc[first_rows[text_idx]]
+            example = {col: row[col] for col in columns}
+            example['count'] = int(text_counts[text_idx])
+            examples.append(example)
+        row_positions = np.flatnonzero(row_labels == label)[:NEAR_DUP_ROW_IDS]
+        clusters.append({
+            'cluster_id': rank,
+            'size': int(size),
+            'distinct_texts': int(len(member_texts)),
+            'representative': {col: examples[0][col] for col in columns},
+            'examples': examples,
+            'row_ids': df.index[row_positions].tolist()
+        })
+    
+    stats = {
+        'total': int(row_valid.sum()),
+        'cluster_count': int(len(cluster_sizes)),
+        'duplicate_rows': int(cluster_sizes.sum()),
+        'threshold': NEAR_DUP_THRESHOLD
+    }
+    return clusters, stats
+
+# 跨月份重复案件索引：每次上传后把新表的文本登记进来，查询历史重复时不需要重新读取历史数据表
+DUP_INDEX_BATCH_ROWS = 5000  # 批量写入的行数
+DUP_INDEX_QUERY_BATCH = 1000  # IN 查询每批的参数个数
+
+def _load_duplicate_signatures(conn, text_ids):
+    """按文本ID读取签名，返回(ID数组, 签名矩阵)"""
+    ids = []
+    blobs = []
+    text_ids = [int(text_id) for text_id in text_ids]
+    for start in range(0, len(text_ids), DUP_INDEX_QUERY_BATCH):
+        chunk = text_ids[start:start + DUP_INDEX_QUERY_BATCH]
+        rows = conn.execute(
+            DuplicateText.__table__.select()
+            .with_only_columns(DuplicateText.id, DuplicateText.signature)
+            .where(DuplicateText.id.in_(chunk))
+        )
+        for text_id, signature in rows:
+            ids.append(text_id)
+            blobs.append(bytes(signature))
+    signatures = np.frombuffer(b''.join(blobs), dtype=np.uint32).reshape(-1, NEAR_DUP_NUM_PERM)
+    return np.array(ids, dtype=np.int64), signatures
+
+def update_duplicate_index(table_name, df, problem_col, address_col):
+    """把一张案件表的文本登记到重复案件索引（同名表重新上传时替换旧记录），返回统计信息"""
+    columns = [col for col in (problem_col, address_col) if col]
+    duplicate_text = build_duplicate_text(*[df[col] for col in columns])
+    codes, uniques = pd.factorize(duplicate_text)
+    uniques = list(uniques)
+    case_counts = np.bincount(codes, minlength=len(uniques))
+    first_rows = pd.Series(np.arange(len(codes))).groupby(codes).first().to_numpy()
+    # 每个文本保留前几条案件的行号
+    positions = np.flatnonzero(pd.Series(codes).groupby(codes).cumcount().to_numpy() < NEAR_DUP_ROW_IDS)
+    sample_row_ids = pd.Series(np.asarray(df.index)[positions]).groupby(codes[positions]).agg(list)
+    valid = [i for i, value in enumerate(uniques) if value]
+    text_hashes = {i: hashlib.sha1(uniques[i].encode('utf-8')).hexdigest() for i in valid}
+    
+    with engine.begin() as conn:
+        # 已在索引中的文本（其他月份出现过）只需登记出现次数
+        text_ids = {}
+        hash_list = list(text_hashes.values())
+        for start in range(0, len(hash_list), DUP_INDEX_QUERY_BATCH):
+            rows = conn.execute(
+                DuplicateText.__table__.select()
+                .with_only_columns(DuplicateText.id, DuplicateText.text_hash)
+                .where(DuplicateText.text_hash.in_(hash_list[start:start + DUP_INDEX_QUERY_BATCH]))
+            )
+            text_ids.update({text_hash: text_id for text_id, text_hash in rows})
+        
+        new_texts = [i for i in valid if text_hashes[i] not in text_ids]
+        if new_texts:
+            signatures, _ = minhash_signatures([uniques[i] for i in new_texts])
+            records = []
+            for position, i in enumerate(new_texts):
+                row = df.iloc[first_rows[i]]
+                records.append({
+                    'text_hash': text_hashes[i],
+                    'problem': None if not problem_col or pd.isna(row[problem_col]) else str(row[problem_col]),
+                    'address': None if not address_col or pd.isna(row[address_col]) else str(row[address_col]),
+                    'signature': signatures[position].tobytes()
+                })
+            # 同时运行的索引任务（多个上传，或上传与重建索引）可能先一步写入相同的文本：
+            # text_hash唯一，用INSERT IGNORE跳过已存在的文本，再统一按哈希查询ID
+            for start in range(0, len(records), DUP_INDEX_BATCH_ROWS):
+                conn.execute(DuplicateText.__table__.insert().prefix_with('IGNORE', dialect='mysql'),
+                             records[start:start + DUP_INDEX_BATCH_ROWS])
+            
+            new_hashes = [text_hashes[i] for i in new_texts]
+            for start in range(0, len(new_hashes), DUP_INDEX_QUERY_BATCH):
+                rows = conn.execute(
+                    DuplicateText.__table__.select()
+                    .with_only_columns(DuplicateText.id, DuplicateText.text_hash)
+                    .where(DuplicateText.text_hash.in_(new_hashes[start:start + DUP_INDEX_QUERY_BATCH]))
+                )
+                text_ids.update({text_hash: text_id for text_id, text_hash in rows})
+            
+            bucket_keys = lsh_bucket_keys(signatures, digit_block_hashes([uniques[i] for i in new_texts]))
+            new_ids = np.array([text_ids[text_hash] for text_hash in new_hashes], dtype=np.int64)
+            bucket_rows = pd.DataFrame({
+                'band': np.tile(np.arange(NEAR_DUP_BANDS), len(new_texts)),
+                'bucket_key': bucket_keys.ravel(),
+                'text_id': np.repeat(new_ids, NEAR_DUP_BANDS)
+            }).drop_duplicates().to_dict('records')
+            for start in range(0, len(bucket_rows), DUP_INDEX_BATCH_ROWS):
+                conn.execute(DuplicateBucket.__table__.insert().prefix_with('IGNORE', dialect='mysql'),
+                             bucket_rows[start:start + DUP_INDEX_BATCH_ROWS])
+        
+        conn.execute(DuplicateOccurrence.__table__.delete().where(DuplicateOccurrence.table_name == table_name))
+        occurrences = [{
+            'table_name': table_name,
+            'text_id': text_ids[text_hashes[i]],
+            'case_count': int(case_counts[i]),
+            'row_ids': json.dumps([int(row_id) if isinstance(row_id, (int, np.integer)) else str(row_id) for row_id in sample_row_ids[i]])
+        } for i in valid]
+        for start in range(0, len(occurrences), DUP_INDEX_BATCH_ROWS):
+            conn.execute(DuplicateOccurrence.__table__.insert(), occurrences[start:start + DUP_INDEX_BATCH_ROWS])
+    
+    stats = {
+        'table_name': table_name,
+        'cases': int(case_counts[valid].sum()) if valid else 0,
+        'texts': len(valid),
+        'new_texts': len(new_texts)
+    }
+    print(f"数据表 {table_name} 已登记到重复案件索引: {stats}")
+    return stats
+
+def index_case_table_duplicates(table_name):
+    """读取案件表的问题描述、地址描述并登记到重复案件索引（上传后在后处理任务中执行，有快照时从快照读取）"""
+    columns = get_case_table_columns(table_name)
+    key_fields = resolve_analysis_fields('duplicate_analysis', columns)
+    problem_col = key_fields['问题描述']
+    address_col = key_fields['地址描述']
+    if not problem_col and not address_col:
+        return {'table_name': table_name, 'cases': 0, 'texts': 0, 'new_texts': 0}
+    
+    df = load_case_table(table_name, [col for col in (problem_col, address_col) if col])
+    return update_duplicate_index(table_name, df, problem_col, address_col)
+
+def remove_from_duplicate_index(table_name):
+    """删除数据表时移除其在重复案件索引中的出现记录（文本和桶保留，供其他表继续使用）"""
+    with engine.begin() as conn:
+        conn.execute(DuplicateOccurrence.__table__.delete().where(DuplicateOccurrence.table_name == table_name))
+
+def lookup_duplicate_index(problem, address, exclude_table=None, limit=20):
+    """查询历史数据表中与给定问题描述、地址描述近似重复的案件"""
+    text_value = build_duplicate_text(pd.Series([problem or '']), pd.Series([address or '']))[0]
+    if not text_value:
+        return []
+    signatures, _ = minhash_signatures([text_value])
+    bucket_keys = lsh_bucket_keys(signatures, digit_block_hashes([text_value]))[0]
+    
+    with engine.connect() as conn:
+        bucket_filter = or_(*[
+            and_(DuplicateBucket.band == band, DuplicateBucket.bucket_key == int(bucket_keys[band]))
+            for band in range(NEAR_DUP_BANDS)
+        ])
+        candidate_ids = [row[0] for row in conn.execute(
+            DuplicateBucket.__table__.select().with_only_columns(DuplicateBucket.text_id).where(bucket_filter).distinct()
+        )]
+        if not candidate_ids:
+            return []
+        ids, candidate_signatures = _load_duplicate_signatures(conn, candidate_ids)
+        similarity = (candidate_signatures == signatures[0]).mean(axis=1)
+        matched = {int(text_id): float(score) for text_id, score in zip(ids, similarity) if score >= NEAR_DUP_THRESHOLD}
+        if not matched:
+            return []
+        
+        query = (DuplicateOccurrence.__table__.select()
+                 .where(DuplicateOccurrence.text_id.in_(list(matched))))
+        if exclude_table:
+            query = query.where(DuplicateOccurrence.table_name != exclude_table)
+        occurrences = {}
+        for row in conn.execute(query).mappings():
+            occurrences.setdefault(row['text_id'], []).append({
+                'table_name': row['table_name'],
+                'case_count': row['case_count'],
+                'row_ids': json.loads(row['row_ids']) if row['row_ids'] else []
+            })
+        texts = {row['id']: row for row in conn.execute(
+            DuplicateText.__table__.select()
+            .with_only_columns(DuplicateText.id, DuplicateText.problem, DuplicateText.address)
+            .where(DuplicateText.id.in_(list(occurrences)))
+        ).mappings()} if occurrences else {}
+    
+    matches = [{
+        'problem': texts[text_id]['problem'],
+        'address': texts[text_id]['address'],
+        'similarity': round(matched[text_id], 3),
+        'total_cases': sum(item['case_count'] for item in items),
+        'occurrences': sorted(items, key=lambda item: item['table_name'])
+    } for text_id, items in occurrences.items()]
+    matches.sort(key=lambda match: (-match['similarity'], -match['total_cases']))
+    return matches[:limit]
+
+def duplicate_repeat_rate(table_name, compare_tables=None, top_n=10):
+    """计算数据表中与其他数据表（默认为全部已索引的表）近似重复的案件占比，返回None表示该表尚未建立索引"""
+    tables_param = bindparam('compare_tables', expanding=True)
+    with engine.connect() as conn:
+        source = pd.read_sql(
+            text("SELECT text_id, case_count FROM duplicate_occurrences WHERE table_name = :table_name"),
+            conn, params={'table_name': table_name}
+        )
+        if source.empty:
+            return None
+        if compare_tables is None:
+            compare_tables = [row[0] for row in conn.execute(
+                text("SELECT DISTINCT table_name FROM duplicate_occurrences WHERE table_name <> :table_name ORDER BY table_name"),
+                {'table_name': table_name}
+            )]
+        compare_tables = [name for name in compare_tables if name != table_name]
+        
+        matched = pd.DataFrame(columns=['source_id', 'table_name'])
+        if compare_tables:
+            params = {'table_name': table_name, 'compare_tables': compare_tables}
+            # 完全相同的文本
+            identical = pd.read_sql(text(
+                "SELECT s.text_id AS source_id, o.table_name "
+                "FROM duplicate_occurrences s "
+                "JOIN duplicate_occurrences o ON o.text_id = s.text_id "
+                "WHERE s.table_name = :table_name AND o.table_name IN :compare_tables"
+            ).bindparams(tables_param), conn, params=params)
+            # 同一LSH桶中的候选文本，再用签名相似度校验
+            candidates = pd.read_sql(text(
+                "SELECT DISTINCT a.text_id AS source_id, b.text_id AS match_id, o.table_name "
+                "FROM duplicate_occurrences s "
+                "JOIN duplicate_buckets a ON a.text_id = s.text_id "
+                "JOIN duplicate_buckets b ON b.band = a.band AND b.bucket_key = a.bucket_key AND b.text_id <> a.text_id "
+                "JOIN duplicate_occurrences o ON o.text_id = b.text_id "
+                "WHERE s.table_name = :table_name AND o.table_name IN :compare_tables"
+            ).bindparams(tables_param), conn, params=params)
+            if not candidates.empty:
+                ids, signatures = _load_duplicate_signatures(
+                    conn, np.union1d(candidates['source_id'].unique(), candidates['match_id'].unique())
+                )
+                position = pd.Series(np.arange(len(ids)), index=ids)
+                source_signatures = signatures[position.loc[candidates['source_id']].to_numpy()]
+                match_signatures = signatures[position.loc[candidates['match_id']].to_numpy()]
+                similarity = (source_signatures == match_signatures).mean(axis=1)
+                candidates = candidates[similarity >= NEAR_DUP_THRESHOLD]
+            matched = pd.concat([identical, candidates[['source_id', 'table_name']]]).drop_duplicates()
+        
+        case_counts = source.set_index('text_id')['case_count']
+        total_cases = int(case_counts.sum())
+        repeat_ids = matched['source_id'].unique()
+        repeat_cases = int(case_counts.loc[repeat_ids].sum()) if len(repeat_ids) else 0
+        
+        by_table = []
+        for compare_table in compare_tables:
+            table_ids = matched.loc[matched['table_name'] == compare_table, 'source_id'].unique()
+            table_cases = int(case_counts.loc[table_ids].sum()) if len(table_ids) else 0
+            by_table.append({
+                'table_name': compare_table,
+                'repeat_cases': table_cases,
+                'repeat_rate': round(table_cases / total_cases, 4) if total_cases else 0
+            })
+        
+        top_repeats = []
+        if len(repeat_ids):
+            top_ids = case_counts.loc[repeat_ids].sort_values(ascending=False).head(top_n)
+            texts = {row['id']: row for row in conn.execute(
+                DuplicateText.__table__.select()
+                .with_only_columns(DuplicateText.id, DuplicateText.problem, DuplicateText.address)
+                .where(DuplicateText.id.in_([int(text_id) for text_id in top_ids.index]))
+            ).mappings()}
+            for text_id, count in top_ids.items():
+                top_repeats.append({
+                    'problem': texts[text_id]['problem'],
+                    'address': texts[text_id]['address'],
+                    'case_count': int(count),
+                    'repeated_in': sorted(matched.loc[matched['source_id'] == text_id, 'table_name'].unique().tolist())
+                })
+    
+    return {
+        'table_name': table_name,
+        'compare_tables': compare_tables,
+        'total_cases': total_cases,
+        'repeat_cases': repeat_cases,
+        'repeat_rate': round(repeat_cases / total_cases, 4) if total_cases else 0,
+        'by_table': by_table,
+        'top_repeats': top_repeats
+    }
+
+# 地址规范化与坐标匹配
+ADDRESS_NORMALIZER_VERSION = 1  # 修改规范化规则后加1，缓存中旧版本的结果会被重新计算
+ADDRESS_PRECISE_KEYWORDS = ['号', '栋', '楼', '室', '店', '铺', '单元', '号楼']
+ADDRESS_VAGUE_KEYWORDS = ['附近', '周边', '旁边', '一带', '附近区域']
+ADDRESS_VAGUE_SUFFIX_PATTERN = r'(?:附近区域|附近|周边|旁边|一带|对面|门口|门前|边上|旁|处)+$'
+ADDRESS_PUNCTUATION_PATTERN = r'[\s,，。.;；:：!！?？、"“”\'‘’()（）【】\[\]<>《》]+'
+ADDRESS_CN_NUMBER_PATTERN = r'[零〇一二两三四五六七八九十百千]+(?=号|栋|楼|单元|层|室|弄|巷|组)'
+ADDRESS_BASE_PATTERN = r'^(.*?\d+(?:-\d+)?号)'
+ADDRESS_QUERY_BATCH = 1000
+
+_CN_DIGITS = {'零': 0, '〇': 0, '一': 1, '二': 2, '两': 2, '三': 3, '四': 4, '五': 5, '六': 6, '七': 7, '八': 8, '九': 9}
+_CN_UNITS = {'十': 10, '百': 100, '千': 1000}
+
+def _chinese_number_to_arabic(match):
+    """把门牌号、楼栋号中的中文数字转为阿拉伯数字，如“十二号”->“12号”"""
+    total = 0
+    current = 0
+    for char in match.group(0):
+        if char in _CN_DIGITS:
+            current = _CN_DIGITS[char]
+        else:
+            total += (current or 1) * _CN_UNITS[char]
+            current = 0
+    return str(total + current)
+
+def normalize_address_series(series):
+    """地址规范化：全角转半角、去掉标点空白和“附近”“对面”等模糊后缀、统一门牌号写法
+    
+    按去重后的地址处理，返回与输入同索引的规范化地址（空地址为空字符串）
+    """
+    values = series.astype(object).where(series.notna(), '')
+    codes, uniques = pd.factorize(values)
+    normalized = (pd.Series(uniques, dtype=object).astype(str)
+                  .str.normalize('NFKC')
+                  .str.replace(ADDRESS_PUNCTUATION_PATTERN, '', regex=True)
+                  .str.replace('號', '号', regex=False)
+                  .str.replace('幢', '栋', regex=False)
+                  .str.replace(r'(\d+)#', r'\1号', regex=True)
+                  .str.replace(ADDRESS_CN_NUMBER_PATTERN, _chinese_number_to_arabic, regex=True)
+                  .str.replace(ADDRESS_VAGUE_SUFFIX_PATTERN, '', regex=True)
+                  .str.upper())
+    return pd.Series(normalized.to_numpy()[codes], index=series.index, dtype=object)
+
+def classify_address_precision(series):
+    """判断是否为精准地址：不含模糊关键词，且含门牌、楼栋等关键词或长度超过10个字符；空地址为False"""
+    values = series.astype(object).where(series.notna(), '').astype(str)
+    vague = values.str.contains('|'.join(ADDRESS_VAGUE_KEYWORDS), regex=True)
+    precise = values.str.contains('|'.join(ADDRESS_PRECISE_KEYWORDS), regex=True)
+    return (values != '') & ~vague & (precise | (values.str.len() > 10))
+
+def _lookup_gazetteer(conn, keys):
+    """按规范化地址批量查询地名库坐标，返回 {规范化地址: (经度, 纬度)}"""
+    coordinates = {}
+    keys = list(keys)
+    for start in range(0, len(keys), ADDRESS_QUERY_BATCH):
+        rows = conn.execute(
+            AddressGazetteer.__table__.select()
+            .with_only_columns(AddressGazetteer.normalized, AddressGazetteer.longitude, AddressGazetteer.latitude)
+            .where(AddressGazetteer.normalized.in_(keys[start:start + ADDRESS_QUERY_BATCH]))
+        )
+        coordinates.update({normalized: (longitude, latitude) for normalized, longitude, latitude in rows})
+    return coordinates
+
+def resolve_addresses(series):
+    """返回地址列每行的规范化地址、是否精准和坐标（DataFrame，与输入同索引）
+    
+    每个不同的原始地址只计算一次：结果保存在address_cache表中，之后的请求直接读取
+    """
+    values = series.astype(object).where(series.notna(), None)
+    codes, uniques = pd.factorize(values)
+    uniques = [str(value) for value in uniques]
+    hashes = [hashlib.sha1(value.encode('utf-8')).hexdigest() for value in uniques]
+    
+    resolved = {}
+    with engine.begin() as conn:
+        for start in range(0, len(hashes), ADDRESS_QUERY_BATCH):
+            rows = conn.execute(
+                AddressCache.__table__.select()
+                .with_only_columns(AddressCache.address_hash, AddressCache.normalized, AddressCache.precise,
+                                   AddressCache.longitude, AddressCache.latitude)
+                .where(AddressCache.address_hash.in_(hashes[start:start + ADDRESS_QUERY_BATCH]))
+                .where(AddressCache.version == ADDRESS_NORMALIZER_VERSION)
+            )
+            for address_hash, normalized, precise, longitude, latitude in rows:
+                resolved[address_hash] = (normalized, bool(precise), longitude, latitude)
+        
+        missing = [i for i, address_hash in enumerate(hashes) if address_hash not in resolved]
+        if missing:
+            raw = pd.Series([uniques[i] for i in missing], dtype=object)
+            normalized = normalize_address_series(raw)
+            precise = classify_address_precision(raw)
+            # 先按完整地址匹配地名库，匹配不到时退回到“道路+门牌号”
+            base = normalized.str.extract(ADDRESS_BASE_PATTERN, expand=False)
+            coordinates = _lookup_gazetteer(conn, set(normalized) | set(base.dropna()))
+            records = []
+            for position, i in enumerate(missing):
+                point = coordinates.get(normalized.iloc[position])
+                if point is None and isinstance(base.iloc[position], str):
+                    point = coordinates.get(base.iloc[position])
+                longitude, latitude = point if point else (None, None)
+                resolved[hashes[i]] = (normalized.iloc[position], bool(precise.iloc[position]), longitude, latitude)
+                records.append({
+                    'address_hash': hashes[i],
+                    'address': uniques[i],
+                    'normalized': normalized.iloc[position][:255],
+                    'precise': int(precise.iloc[position]),
+                    'longitude': longitude,
+                    'latitude': latitude,
+                    'version': ADDRESS_NORMALIZER_VERSION
+                })
+            # 旧版本规则的缓存行和并发的空间分析写入的相同地址一律覆盖，不先删除再插入
+            upsert = mysql_insert(AddressCache.__table__)
+            upsert = upsert.on_duplicate_key_update(
+                address=upsert.inserted.address,
+                normalized=upsert.inserted.normalized,
+                precise=upsert.inserted.precise,
+                longitude=upsert.inserted.longitude,
+                latitude=upsert.inserted.latitude,
+                version=upsert.inserted.version,
+                updated_at=func.now()
+            )
+            for start in range(0, len(records), ADDRESS_QUERY_BATCH):
+                conn.execute(upsert, records[start:start + ADDRESS_QUERY_BATCH])
+    
+    table = pd.DataFrame([resolved[address_hash] for address_hash in hashes],
+                         columns=['normalized', 'precise', 'longitude', 'latitude'])
+    # 空地址的factorize编码为-1，对应一行空结果
+    table.loc[len(table)] = ['', False, None, None]
+    result = table.iloc[np.where(codes >= 0, codes, len(table) - 1)]
+    result.index = series.index
+    return result
+
+def import_address_gazetteer(df):
+    """导入地名库（地址、经度、纬度，可选所属街道、所属社区），规范化地址相同的记录以新数据为准"""
+    def find_column(keywords):
+        for col in df.columns:
+            if any(keyword in str(col).lower() for keyword in keywords):
+                return col
+        return None
+    
+    address_col = find_column(['地址', '名称', 'address'])
+    longitude_col = find_column(['经度', 'lng', 'lon'])
+    latitude_col = find_column(['纬度', 'lat'])
+    if not address_col or not longitude_col or not latitude_col:
+        raise ValueError('地名库需要包含地址、经度和纬度字段')
+    street_col = find_column(['街道'])
+    community_col = find_column(['社区'])
+    
+    def text_values(col):
+        # 空单元格保持为空，astype(str)会把它变成字符串'nan'写入地名库
+        values = df[col].astype(object)
+        return values.where(df[col].notna(), None).map(lambda value: value if value is None else str(value))
+    
+    gazetteer = pd.DataFrame({
+        'normalized': normalize_address_series(df[address_col]).str.slice(0, 255),
+        'address': text_values(address_col),
+        'longitude': pd.to_numeric(df[longitude_col], errors='coerce'),
+        'latitude': pd.to_numeric(df[latitude_col], errors='coerce'),
+        'street': text_values(street_col) if street_col else None,
+        'community': text_values(community_col) if community_col else None
+    })
+    gazetteer = gazetteer[(gazetteer['normalized'] != '') & gazetteer['longitude'].notna() & gazetteer['latitude'].notna()]
+    gazetteer = gazetteer.drop_duplicates('normalized', keep='last')
+    
+    records = gazetteer.astype(object).where(gazetteer.notna(), None).to_dict('records')
+    keys = gazetteer['normalized'].tolist()
+    with engine.begin() as conn:
+        for start in range(0, len(records), ADDRESS_QUERY_BATCH):
+            conn.execute(AddressGazetteer.__table__.delete().where(
+                AddressGazetteer.normalized.in_(keys[start:start + ADDRESS_QUERY_BATCH])
+            ))
+            conn.execute(AddressGazetteer.__table__.insert(), records[start:start + ADDRESS_QUERY_BATCH])
+        # 地名库变化后，已缓存的坐标需要重新匹配
+        conn.execute(AddressCache.__table__.delete())
+    # 地名库的代次计入热力图缓存键，其他工作进程也不再使用按旧坐标计算的热力图
+    bump_table_generation(AddressGazetteer.__tablename__)
+    clear_heatmap_cache()
+    return len(records)
+
+# 案件热力图（按网格或六边形单元聚合案件坐标）
+HEATMAP_CELL_TYPES = ('grid', 'hex')
+HEATMAP_CELL_TYPE = 'grid'
+HEATMAP_CELL_SIZE = 0.005  # 单元大小（度），约500米
+HEATMAP_CACHE_MAX_ENTRIES = 64
+HEATMAP_TOP_CELLS = 5  # 写入大模型提示的最密集单元数
+
+heatmap_cache = OrderedDict()
+heatmap_cache_lock = threading.Lock()
+
+def _count_cells(cell_x, cell_y):
+    """统计二维单元编号的出现次数；两个编号合成一个int64键后计数，比按行去重快得多"""
+    offset = np.int64(1 << 30)
+    keys = ((cell_x.astype(np.int64) + offset) << np.int64(32)) | (cell_y.astype(np.int64) + offset)
+    keys, counts = np.unique(keys, return_counts=True)
+    return (keys >> np.int64(32)) - offset, (keys & np.int64(0xFFFFFFFF)) - offset, counts
+
+def find_coordinate_columns(columns):
+    """查找经度、纬度字段，返回(经度字段, 纬度字段)，未找到时为None"""
+    roles = resolve_column_roles(columns)
+    return roles['经度'], roles['纬度']
+
+def compute_heatmap_cells(longitude, latitude, cell_type=HEATMAP_CELL_TYPE, cell_size=HEATMAP_CELL_SIZE):
+    """把坐标分到网格或六边形单元并计数，返回稀疏单元列表[[中心经度, 中心纬度, 案件数], ...]"""
+    longitude = np.asarray(longitude, dtype=float)
+    latitude = np.asarray(latitude, dtype=float)
+    # 过滤缺失和越界坐标，(0, 0)通常是未定位的占位值
+    valid = (np.isfinite(longitude) & np.isfinite(latitude)
+             & (np.abs(longitude) <= 180) & (np.abs(latitude) <= 90)
+             & ~((longitude == 0) & (latitude == 0)))
+    longitude = longitude[valid]
+    latitude = latitude[valid]
+    heatmap = {
+        'cell_type': cell_type,
+        'cell_size': cell_size,
+        'located': int(valid.sum()),
+        'cells': [],
+        'max_count': 0,
+        'bounds': None
+    }
+    if len(longitude) == 0:
+        return heatmap
+    
+    if cell_type == 'hex':
+        # 尖顶六边形的轴向坐标；经度按参考纬度的余弦缩放，使单元在地面上接近正六边形
+        scale = np.cos(np.radians(np.round(np.median(latitude))))
+        x = longitude * scale / cell_size
+        y = latitude / cell_size
+        q = np.sqrt(3) / 3 * x - y / 3
+        r = 2 / 3 * y
+        # 立方坐标取整
+        cube_x, cube_z = q, r
+        cube_y = -cube_x - cube_z
+        round_x, round_y, round_z = np.round(cube_x), np.round(cube_y), np.round(cube_z)
+        diff_x, diff_y, diff_z = np.abs(round_x - cube_x), np.abs(round_y - cube_y), np.abs(round_z - cube_z)
+        fix_x = (diff_x > diff_y) & (diff_x > diff_z)
+        fix_z = ~fix_x & ~(diff_y > diff_z)
+        round_x = np.where(fix_x, -round_y - round_z, round_x)
+        round_z = np.where(fix_z, -round_x - round_y, round_z)
+        cell_q, cell_r, counts = _count_cells(round_x, round_z)
+        center_x = np.sqrt(3) * cell_q + np.sqrt(3) / 2 * cell_r
+        center_y = 1.5 * cell_r
+        center_longitude = center_x * cell_size / scale
+        center_latitude = center_y * cell_size
+    else:
+        # 以经纬度0点为原点的规则网格，不同数据表的单元可以直接对比
+        cell_x, cell_y, counts = _count_cells(np.floor(longitude / cell_size), np.floor(latitude / cell_size))
+        center_longitude = (cell_x + 0.5) * cell_size
+        center_latitude = (cell_y + 0.5) * cell_size
+    
+    order = np.argsort(-counts, kind='stable')
+    heatmap['cells'] = [[round(float(lon), 6), round(float(lat), 6), int(count)]
+                        for lon, lat, count in zip(center_longitude[order], center_latitude[order], counts[order])]
+    heatmap['max_count'] = int(counts.max())
+    heatmap['bounds'] = [float(longitude.min()), float(latitude.min()), float(longitude.max()), float(latitude.max())]
+    return heatmap
+
+def case_table_heatmap(table_name, df, cell_type=HEATMAP_CELL_TYPE, cell_size=HEATMAP_CELL_SIZE, addresses=None):
+    """计算数据表的案件热力图；坐标优先取经纬度字段，缺失时按地址从地名库匹配
+    
+    addresses为调用方已对地址字段执行resolve_addresses的结果，传入时不再重复查询地名库。
+    结果按(数据表, 上传代次, 地名库代次, 单元类型, 单元大小)缓存，没有可用坐标来源时返回None
+    """
+    cache_key = (table_name, get_table_generation(table_name), get_table_generation(AddressGazetteer.__tablename__),
+                 cell_type, cell_size)
+    with heatmap_cache_lock:
+        if cache_key in heatmap_cache:
+            heatmap_cache.move_to_end(cache_key)
+            return heatmap_cache[cache_key]
+    
+    longitude_col, latitude_col = find_coordinate_columns(df.columns)
+    address_col = resolve_analysis_fields('space_analysis', df.columns)['地址描述']
+    if longitude_col and latitude_col:
+        longitude = pd.to_numeric(df[longitude_col], errors='coerce').to_numpy(dtype=float, copy=True)
+        latitude = pd.to_numeric(df[latitude_col], errors='coerce').to_numpy(dtype=float, copy=True)
+        source = 'columns'
+    elif address_col:
+        longitude = np.full(len(df), np.nan)
+        latitude = np.full(len(df), np.nan)
+        source = 'gazetteer'
+    else:
+        return None
+    
+    # 没有坐标的案件按地址从地名库补充
+    missing = np.isnan(longitude) | np.isnan(latitude)
+    if address_col and missing.any():
+        if addresses is None:
+            addresses = resolve_addresses(df[address_col][missing])
+        else:
+            addresses = addresses[missing]
+        longitude[missing] = addresses['longitude'].to_numpy(dtype=float)
+        latitude[missing] = addresses['latitude'].to_numpy(dtype=float)
+        if source == 'columns':
+            source = 'columns+gazetteer'
+    
+    heatmap = compute_heatmap_cells(longitude, latitude, cell_type, cell_size)
+    heatmap['source'] = source
+    heatmap['total'] = int(len(df))
+    
+    with heatmap_cache_lock:
+        heatmap_cache[cache_key] = heatmap
+        while len(heatmap_cache) > HEATMAP_CACHE_MAX_ENTRIES:
+            heatmap_cache.popitem(last=False)
+    return heatmap
+
+def clear_heatmap_cache():
+    """地名库更新后清空本进程的热力图缓存"""
+    with heatmap_cache_lock:
+        heatmap_cache.clear()
+
+# 案件数据立方体：上传后按常用维度组合预先聚合，统计图表和考核直接读取几百行汇总结果
+# 维度名称 -> (识别字段所用的分析类型, 关键字段, 取值方式)；分析类型为None时直接使用同名字段
+CASE_CUBE_DIMENSIONS = {
+    'department': (None, '处置部门', None),
+    'stage': (None, '当前阶段名称', 'stage'),
+    'report_day': ('time_analysis', '上报时间', 'day'),
+    'report_hour': ('time_analysis', '上报时间', 'hour'),
+    'street': ('space_analysis', '所属街道', None),
+    'community': ('space_analysis', '所属社区', None),
+    'area': ('space_analysis', '所属片区', None),
+    'source': ('source_analysis', '问题来源', None),
+    'problem_type': ('type_analysis', '问题类型', None),
+    'major_category': ('type_analysis', '大类名称', None),
+    'minor_category': ('type_analysis', '小类名称', None),
+    'deadline_month': ('monthly_comparison', '捆绑处置截止时间', 'month'),
+    'monthly_category': ('monthly_comparison', '小类名称', None),
+    'monthly_problem': ('monthly_comparison', '问题描述', None)
+}
+# 维度组合名称 -> 维度（最多两个）
+CASE_CUBE_GROUPINGS = {
+    'department_stage': ('department', 'stage'),
+    'report_day': ('report_day',),
+    'report_hour': ('report_hour',),
+    'street': ('street',),
+    'community': ('community',),
+    'area': ('area',),
+    'source': ('source',),
+    'problem_type': ('problem_type',),
+    'major_category': ('major_category',),
+    'minor_category': ('minor_category',),
+    'deadline_month': ('deadline_month',),
+    'deadline_month_category': ('deadline_month', 'monthly_category'),
+    'deadline_month_problem': ('deadline_month', 'monthly_problem')
+}
+# 高基数维度组合在每个第一维取值下只保留前N项（图表只展示前10项）
+CASE_CUBE_TOP_VALUES = {'deadline_month_problem': 50}
+# 解析时间维度的分析类型 -> 时间字段
+CASE_CUBE_TIME_FIELDS = {'time_analysis': '上报时间', 'monthly_comparison': '捆绑处置截止时间'}
+# 统计图表可以完全由数据立方体得到的分析类型
+CASE_CUBE_ANALYSIS_TYPES = ('time_analysis', 'monthly_comparison', 'source_analysis', 'type_analysis')
+CASE_CUBE_MEASURES = ['total', 'on_time', 'overdue', 'delay', 'rework']
+CASE_CUBE_BATCH_ROWS = 5000
+
+def _cube_dimension_keys(df, fields, parsed_times, dimension):
+    """计算一个维度的分组键，字段不存在或不是文本字段时返回None（该维度组合不聚合，由原始数据计算）"""
+    analysis_type, field, part = CASE_CUBE_DIMENSIONS[dimension]
+    if part in ('day', 'hour', 'month'):
+        parsed = parsed_times.get(analysis_type)
+        if parsed is None:
+            return None
+        if part == 'month':
+            return parsed.dt.strftime('%Y-%m')
+        return getattr(parsed.dt, part).astype('Int64')
+    
+    col = field if analysis_type is None else fields[analysis_type][field]
+    if not col or col not in df.columns:
+        return None
+    values = df[col]
+    # 汇总表中的维度值以文本保存，非文本字段读回后类型会变化，不做预聚合
+    dtype = values.cat.categories.dtype if isinstance(values.dtype, pd.CategoricalDtype) else values.dtype
+    if not pd.api.types.is_string_dtype(dtype):
+        return None
+    if part == 'stage':
+        # 与考核计分中排除挂账等阶段的处理一致：去除首尾空格并转为小写
+        return values.astype(object).where(values.notna(), '').astype(str).str.strip().str.lower()
+    return values
+
+def build_case_table_cube(table_name):
+    """按 CASE_CUBE_GROUPINGS 聚合案件表并替换汇总表中该表的数据（上传后在后台任务中执行）"""
+    generation = get_table_generation(table_name)
+    columns = get_case_table_columns(table_name)
+    fields = {analysis_type: resolve_analysis_fields(analysis_type, columns)
+              for analysis_type in {spec[0] for spec in CASE_CUBE_DIMENSIONS.values() if spec[0]}}
+    
+    # 只读取各维度和考核标记用到的字段
+    needed = set(ASSESSMENT_COLUMNS)
+    for analysis_type, field, part in CASE_CUBE_DIMENSIONS.values():
+        needed.add(field if analysis_type is None else fields[analysis_type][field])
+    df = load_case_table(table_name, [col for col in columns if col in needed])
+    parsed_times = {}
+    parse_stats = {}
+    for analysis_type, field in CASE_CUBE_TIME_FIELDS.items():
+        time_col = fields[analysis_type][field]
+        if time_col:
+            parsed_times[analysis_type], parse_stats[analysis_type] = parse_case_timestamps(df[time_col])
+    
+    # 各案件的标记只计算一次，所有维度组合共用
+    measures = compute_case_flags(df).astype(int)
+    measures.insert(0, 'total', 1)
+    measures['first_row'] = np.arange(len(df))
+    aggregations = {measure: 'sum' for measure in CASE_CUBE_MEASURES}
+    aggregations['first_row'] = 'min'
+    
+    keys = {dimension: _cube_dimension_keys(df, fields, parsed_times, dimension) for dimension in CASE_CUBE_DIMENSIONS}
+    rows = []
+    groupings = []
+    for grouping, dimensions in CASE_CUBE_GROUPINGS.items():
+        if any(keys[dimension] is None for dimension in dimensions):
+            continue
+        grouped = measures.groupby([keys[dimension] for dimension in dimensions], sort=False, dropna=True, observed=True).agg(aggregations)
+        if grouping in CASE_CUBE_TOP_VALUES and len(dimensions) > 1:
+            grouped = grouped.sort_values(['total', 'first_row'], ascending=[False, True], kind='stable')
+            grouped = grouped.groupby(level=0, sort=False).head(CASE_CUBE_TOP_VALUES[grouping])
+        groupings.append(grouping)
+        for key, values in zip(grouped.index, grouped.itertuples(index=False)):
+            key = key if isinstance(key, tuple) else (key,)
+            row = {'table_name': table_name, 'grouping_set': grouping,
+                   'dim1': str(key[0]), 'dim2': str(key[1]) if len(key) > 1 else None}
+            row.update({name: int(value) for name, value in zip(grouped.columns, values)})
+            rows.append(row)
+    
+    # 聚合期间数据表又被替换或删除时放弃写入，由新的上传任务重新聚合
+    if get_table_generation(table_name) != generation:
+        print(f"数据表 {table_name} 在聚合期间已被替换或删除，放弃写入数据立方体")
+        return {'table_name': table_name, 'generation': generation, 'groupings': [], 'rows': 0, 'stale': True}
+    
+    sample_data = app.json.dumps(convert_nan_to_null(load_case_table_head(table_name).to_dict('records')))
+    with engine.begin() as conn:
+        conn.execute(CaseTableCube.__table__.delete().where(CaseTableCube.table_name == table_name))
+        conn.execute(CaseTableCubeInfo.__table__.delete().where(CaseTableCubeInfo.table_name == table_name))
+        for start in range(0, len(rows), CASE_CUBE_BATCH_ROWS):
+            conn.execute(CaseTableCube.__table__.insert(), rows[start:start + CASE_CUBE_BATCH_ROWS])
+        conn.execute(CaseTableCubeInfo.__table__.insert(), {
+            'table_name': table_name,
+            'generation': generation,
+            'row_count': len(df),
+            'columns': json.dumps([str(col) for col in columns], ensure_ascii=False),
+            'sample_data': sample_data,
+            'fields': json.dumps(fields, ensure_ascii=False),
+            'parse_stats': json.dumps(parse_stats, ensure_ascii=False),
+            'groupings': json.dumps(groupings)
+        })
+    stats = {'table_name': table_name, 'generation': generation, 'groupings': groupings, 'rows': len(rows)}
+    print(f"数据表 {table_name} 的数据立方体已更新: {stats}")
+    return stats
+
+def remove_case_table_cube(table_name):
+    """删除数据表时移除其数据立方体"""
+    with engine.begin() as conn:
+        conn.execute(CaseTableCube.__table__.delete().where(CaseTableCube.table_name == table_name))
+        conn.execute(CaseTableCubeInfo.__table__.delete().where(CaseTableCubeInfo.table_name == table_name))
+
+def load_case_table_cube(table_name, groupings=None):
+    """读取数据表当前代次的数据立方体，未建立或已过期时返回None
+    
+    返回的 groupings 为 维度组合 -> DataFrame（dim1, dim2, 各统计量, first_row），
+    已聚合但没有数据的维度组合对应空DataFrame，未聚合的维度组合不出现
+    """
+    generation = get_table_generation(table_name)
+    with engine.connect() as conn:
+        info = conn.execute(
+            CaseTableCubeInfo.__table__.select().where(CaseTableCubeInfo.table_name == table_name)
+        ).mappings().fetchone()
+        if info is None or info['generation'] != generation:
+            return None
+        built = json.loads(info['groupings'])
+        if groupings is not None:
+            built = [grouping for grouping in built if grouping in groupings]
+        columns = ['grouping_set', 'dim1', 'dim2'] + CASE_CUBE_MEASURES + ['first_row']
+        rows = conn.execute(
+            text(f"SELECT {', '.join(columns)} FROM case_table_cubes "
+                 "WHERE table_name = :table_name AND grouping_set IN :groupings").bindparams(bindparam('groupings', expanding=True)),
+            {'table_name': table_name, 'groupings': built or ['']}
+        ).fetchall()
+    
+    frame = pd.DataFrame([tuple(row) for row in rows], columns=columns)
+    return {
+        'row_count': info['row_count'],
+        'columns': json.loads(info['columns']),
+        'sample_data': json.loads(info['sample_data']),
+        'fields': json.loads(info['fields']),
+        'parse_stats': json.loads(info['parse_stats']),
+        'groupings': {
+            grouping: frame[frame['grouping_set'] == grouping].drop(columns='grouping_set').reset_index(drop=True)
+            for grouping in built
         }
+    }
+
+def cube_top_values(frame, column_name, value_col='dim1', limit=10):
+    """按 value_counts 的顺序（数量降序，数量相同时先出现的在前）取前N项，返回图表记录"""
+    top = frame.sort_values(['total', 'first_row'], ascending=[False, True], kind='stable').head(limit)
+    return [{column_name: value, 'count': int(count)} for value, count in zip(top[value_col], top['total'])]
+
+def prepare_analysis_from_cube(table_name, analysis_type, cube=None):
+    """从数据立方体生成统计图表结果（不含大模型提示），与 prepare_analysis 的结果一致；无法由立方体得到时返回None"""
+    if analysis_type not in CASE_CUBE_ANALYSIS_TYPES:
+        return None
+    if cube is None:
+        cube = load_case_table_cube(table_name)
+    if cube is None:
+        return None
+    fields = cube['fields'][analysis_type]
+    groupings = cube['groupings']
+    
+    result = {
+        'table_name': table_name,
+        'analysis_type': analysis_type,
+        'data_summary': f'Table has {cube["row_count"]} rows and {len(cube["columns"])} columns',
+        'columns': cube['columns'],
+        'sample_data': cube['sample_data']
+    }
+    
+    if analysis_type == 'time_analysis':
+        if not fields['上报时间']:
+            return result
+        if 'report_day' not in groupings or 'report_hour' not in groupings:
+            return None
+        result['time_parse_stats'] = cube['parse_stats'][analysis_type]
+        if result['time_parse_stats']['valid'] > 0:
+            daily_counts = pd.DataFrame({'day': groupings['report_day']['dim1'].astype(int), 'count': groupings['report_day']['total']})
+            daily_counts = daily_counts.sort_values('day').reset_index(drop=True)
+            hourly_counts = pd.DataFrame({'hour': groupings['report_hour']['dim1'].astype(int), 'count': groupings['report_hour']['total']})
+            hourly_counts = hourly_counts.sort_values('hour').reset_index(drop=True)
+            peak_hours = hourly_counts.sort_values('count', ascending=False).head(3)
+            result['chart_data'] = {
+                'daily': daily_counts.to_dict('records'),
+                'hourly': hourly_counts.to_dict('records'),
+                'peak_hours': peak_hours.to_dict('records')
+            }
+    
+    elif analysis_type == 'monthly_comparison':
+        if not fields['捆绑处置截止时间']:
+            return result
+        needed = ['deadline_month']
+        if fields['小类名称']:
+            needed.append('deadline_month_category')
+        if fields['问题描述']:
+            needed.append('deadline_month_problem')
+        if any(grouping not in groupings for grouping in needed):
+            return None
+        result['time_parse_stats'] = cube['parse_stats'][analysis_type]
+        months = groupings['deadline_month'].set_index('dim1')['total']
+        unique_months = sorted(months.index, reverse=True)
+        if len(unique_months) >= 2:
+            recent_month_str, previous_month_str = unique_months[0], unique_months[1]
+            result['chart_data'] = {
+                'monthly_comparison': [
+                    {'month': previous_month_str, 'count': int(months[previous_month_str])},
+                    {'month': recent_month_str, 'count': int(months[recent_month_str])}
+                ]
+            }
+            for grouping, field, chart_key, items_key in (
+                ('deadline_month_category', '小类名称', 'case_size_comparison', 'categories'),
+                ('deadline_month_problem', '问题描述', 'problem_trend', 'problems')
+            ):
+                if not fields[field]:
+                    continue
+                frame = groupings[grouping]
+                result['chart_data'][chart_key] = [
+                    {'type': month, items_key: cube_top_values(frame[frame['dim1'] == month], fields[field], 'dim2')}
+                    for month in (previous_month_str, recent_month_str)
+                ]
+    
+    elif analysis_type == 'source_analysis':
+        if fields['问题来源']:
+            if 'source' not in groupings:
+                return None
+            result['chart_data'] = {'source': cube_top_values(groupings['source'], fields['问题来源'])}
+    
+    elif analysis_type == 'type_analysis':
+        if fields['小类名称']:
+            if 'minor_category' not in groupings:
+                return None
+            result['chart_data'] = {'type': cube_top_values(groupings['minor_category'], fields['小类名称'])}
+    
+    return result
+
+# 多月趋势分析：未指定月份范围时取数据中最近的月份数
+TREND_DEFAULT_MONTHS = 12
+TREND_TOP_N = 10
+
+def _current_cube_tables(conn, table_names=None):
+    """返回数据立方体与数据表当前代次一致的表名集合"""
+    sql = ("SELECT i.table_name FROM case_table_cube_info i "
+           "JOIN case_table_generations g ON g.table_name = i.table_name AND g.generation = i.generation")
+    if table_names is None:
+        return {row[0] for row in conn.execute(text(sql))}
+    sql = text(sql + " WHERE i.table_name IN :table_names").bindparams(bindparam('table_names', expanding=True))
+    return {row[0] for row in conn.execute(sql, {'table_names': list(table_names)})}
+
+def find_active_cube_job(table_name):
+    """查找正在为数据表聚合数据立方体的任务（单独的聚合任务或上传后处理任务），返回任务ID"""
+    session = Session()
+    try:
+        job = session.query(BackgroundJob).filter(
+            BackgroundJob.job_type.in_(('case_cube', 'upload_postprocess')),
+            BackgroundJob.status.in_(('pending', 'running')),
+            job_lease_alive(),
+            BackgroundJob.params == json.dumps({'table_name': table_name}, ensure_ascii=False)
+        ).order_by(BackgroundJob.created_at.desc()).first()
+        return job.id if job else None
+    finally:
+        session.close()
+
+def case_trends(table_names=None, start_month=None, end_month=None, top_n=TREND_TOP_N):
+    """按截止月份汇总多张数据表的案件数，返回各小类的逐月序列和最近两个月的增长、下降排名
+    
+    只读取数据立方体中的 截止月份 和 截止月份×小类 汇总，没有当前代次立方体的数据表不参与统计
+    （由调用方先提交聚合任务）。table_names为None时使用所有已聚合的数据表，同一月份出现在多张表中时案件数相加。
+    """
+    sql = ("SELECT c.table_name, c.grouping_set, c.dim1, c.dim2, c.total FROM case_table_cubes c "
+           "JOIN case_table_cube_info i ON i.table_name = c.table_name "
+           "JOIN case_table_generations g ON g.table_name = i.table_name AND g.generation = i.generation "
+           "WHERE c.grouping_set IN ('deadline_month', 'deadline_month_category')")
+    params = {}
+    if table_names is not None:
+        sql += " AND c.table_name IN :table_names"
+        params['table_names'] = list(table_names)
+    if start_month:
+        sql += " AND c.dim1 >= :start_month"
+        params['start_month'] = start_month
+    if end_month:
+        sql += " AND c.dim1 <= :end_month"
+        params['end_month'] = end_month
+    sql = text(sql)
+    if table_names is not None:
+        sql = sql.bindparams(bindparam('table_names', expanding=True))
+    with engine.connect() as conn:
+        rows = conn.execute(sql, params).fetchall()
+    frame = pd.DataFrame([tuple(row) for row in rows], columns=['table_name', 'grouping_set', 'month', 'category', 'total'])
+    
+    monthly = frame[frame['grouping_set'] == 'deadline_month'].groupby('month')['total'].sum().sort_index()
+    # 未指定月份范围时只保留最近的若干个月
+    if not start_month and not end_month:
+        monthly = monthly.tail(TREND_DEFAULT_MONTHS)
+    months = monthly.index.tolist()
+    
+    category_rows = frame[(frame['grouping_set'] == 'deadline_month_category') & frame['month'].isin(months)]
+    counts = category_rows.pivot_table(index='category', columns='month', values='total', aggfunc='sum', fill_value=0)
+    counts = counts.reindex(columns=months, fill_value=0)
+    counts = counts.loc[counts.sum(axis=1).sort_values(ascending=False, kind='stable').index]
+    
+    result = {
+        'tables': sorted(frame['table_name'].unique().tolist()),
+        'months': months,
+        'monthly_totals': [{'month': month, 'count': int(count)} for month, count in monthly.items()],
+        'series': [
+            {'category': category, 'total': int(values.sum()), 'counts': [int(value) for value in values]}
+            for category, values in counts.iterrows()
+        ],
+        'growth_ranking': [],
+        'decline_ranking': []
+    }
+    
+    # 最近两个月的环比变化
+    if len(months) >= 2:
+        previous_month, recent_month = months[-2], months[-1]
+        change = pd.DataFrame({'previous': counts[previous_month], 'recent': counts[recent_month]})
+        change['change'] = change['recent'] - change['previous']
+        change['change_rate'] = (change['change'] / change['previous'].where(change['previous'] > 0) * 100).round(2).fillna(0)
+        records = [
+            {'category': category, 'previous': int(row.previous), 'recent': int(row.recent),
+             'change': int(row.change), 'change_rate': float(row.change_rate)}
+            for category, row in change.iterrows()
+        ]
+        result['previous_month'] = previous_month
+        result['recent_month'] = recent_month
+        result['growth_ranking'] = sorted([item for item in records if item['change'] > 0], key=lambda item: -item['change'])[:top_n]
+        result['decline_ranking'] = sorted([item for item in records if item['change'] < 0], key=lambda item: item['change'])[:top_n]
+    return result
+
+# 案件表字段角色识别规则：角色 -> (完全匹配的字段名, 按优先级排列的关键字规则)
+# 每条规则为(必须全部包含的关键字, 不能包含的关键字)，同一条规则按建表顺序取第一个匹配的字段
+CASE_COLUMN_ROLES = {
+    '上报时间': (['上报时间'], [(('上报', '时间'), ()), (('上报',), ()), (('时间',), ())]),
+    '捆绑处置截止时间': (['捆绑处置截止时间'], [(('捆绑', '截止', '时间'), ())]),
+    '问题类型': (['问题类型'], [(('问题', '类型'), ())]),
+    '大类名称': (['大类名称'], [(('大类',), ())]),
+    '小类名称': (['小类名称'], [(('小类',), ()), (('类型',), ('问题', '大类'))]),
+    '问题来源': (['问题来源'], [(('来源',), ()), (('渠道',), ())]),
+    '问题描述': (['问题描述'], [(('问题', '描述'), ())]),
+    '地址描述': (['地址描述'], [(('地址', '描述'), ()), (('地址',), ()), (('位置',), ())]),
+    '所属街道': (['所属街道'], [(('街道',), ())]),
+    '所属社区': (['所属社区'], [(('社区',), ())]),
+    '所属片区': (['所属片区'], [(('片区',), ()), (('区域',), ())]),
+    '提取的道路名称': (['提取的道路名称'], [(('道路',), ()), (('路名',), ()), (('街',), ())]),
+    '处置部门': (['处置部门'], []),
+    '当前阶段名称': (['当前阶段名称'], []),
+    '经度': (['经度', 'lng', 'lon', 'longitude'], [(('经度',), ())]),
+    '纬度': (['纬度', 'lat', 'latitude'], [(('纬度',), ())])
+}
+
+# 各分析类型使用的字段角色（上传建索引时也使用同一套规则）
+ANALYSIS_FIELDS = {
+    'time_analysis': ['上报时间', '小类名称', '提取的道路名称'],
+    'space_analysis': ['地址描述', '所属街道', '所属社区', '所属片区', '小类名称'],
+    'monthly_comparison': ['捆绑处置截止时间', '小类名称', '问题描述'],
+    'source_analysis': ['问题来源', '小类名称', '地址描述'],
+    'type_analysis': ['问题类型', '大类名称', '小类名称'],
+    'duplicate_analysis': ['问题描述', '地址描述']
+}
+
+# 只在个别分析类型中使用的宽松规则，在共用规则找不到字段时再尝试：分析类型 -> {角色: 关键字规则}
+# 重复案件分析没有问题描述字段时退回到名称含“问题”的其他字段（如问题编号）；按月对比、数据立方体不使用，避免把编号当作问题描述统计
+ANALYSIS_ROLE_FALLBACKS = {
+    'duplicate_analysis': {'问题描述': [(('问题',), ('类型', '来源'))]}
+}
+
+def _match_column_rules(lowered, rules):
+    """按优先级依次尝试关键字规则，返回第一个匹配的字段"""
+    for include, exclude in rules:
+        match = next((col for col, col_lower in lowered
+                      if all(keyword in col_lower for keyword in include)
+                      and not any(keyword in col_lower for keyword in exclude)), None)
+        if match:
+            return match
+    return None
+
+@lru_cache(maxsize=256)
+def _resolve_column_roles(signature):
+    roles = {}
+    lowered = [(col, str(col).lower()) for col in signature]
+    for role, (names, rules) in CASE_COLUMN_ROLES.items():
+        roles[role] = (next((col for col, col_lower in lowered if col_lower in names), None)
+                       or _match_column_rules(lowered, rules))
+    return roles
+
+def resolve_column_roles(columns):
+    """识别案件表各字段的角色，返回 角色 -> 字段（未找到为None）；按字段列表缓存，同一表结构只识别一次"""
+    return dict(_resolve_column_roles(tuple(columns)))
+
+def resolve_analysis_fields(analysis_type, columns):
+    """返回分析类型用到的关键字段 角色 -> 字段，未找到的字段为None
+    
+    各分析类型对同一角色的识别结果一致，只有 ANALYSIS_ROLE_FALLBACKS 中的宽松规则补充共用规则找不到的字段。
+    """
+    roles = resolve_column_roles(columns)
+    fields = {role: roles[role] for role in ANALYSIS_FIELDS.get(analysis_type, [])}
+    for role, rules in ANALYSIS_ROLE_FALLBACKS.get(analysis_type, {}).items():
+        if fields.get(role) is None:
+            fields[role] = _match_column_rules([(col, str(col).lower()) for col in columns], rules)
+    return fields
+
+def resolve_required_columns(analysis_type, columns):
+    """分析类型需要读取的字段：各关键字段，空间分析另加热力图使用的经纬度字段"""
+    required = [col for col in resolve_analysis_fields(analysis_type, columns).values() if col]
+    if analysis_type == 'space_analysis':
+        required += [col for col in find_coordinate_columns(columns) if col]
+    # 按建表顺序排列，相同的字段组合共用一个缓存条目
+    return [col for col in columns if col in required]
+
+def prepare_analysis(table_name, analysis_type, df=None, columns=None):
+    """完成分析中的数据统计部分，返回(结果字典, 大模型提示)；未知分析类型的提示为None
+    
+    批量分析时由调用方传入已加载的数据df和数据表的全部字段columns
+    """
+    # 按表结构识别关键字段，只读取本分析类型用到的字段（同一上传代次的数据使用缓存）
+    if columns is None:
+        columns = get_case_table_columns(table_name)
+    if df is None:
+        df = load_case_table(table_name, resolve_required_columns(analysis_type, columns))
+    
+    # 基础结果
+    result = {
+        'table_name': table_name,
+        'analysis_type': analysis_type,
+        'data_summary': f'Table has {len(df)} rows and {len(columns)} columns',
+        'columns': list(columns),
+        'sample_data': load_case_table_head(table_name).to_dict('records')
+    }
+    prompt = None
+    
+    # 案件时间分析
+    if analysis_type == 'time_analysis':
+        # 生成分析提示
+        prompt = f"数据表 {table_name} 包含以下关键字段：\n"
+        prompt += f"- 上报时间：案件的上报时间\n"
+        prompt += f"- 小类名称：案件的具体类型\n"
+        prompt += f"- 提取的道路名称：案件发生的位置\n"
+        prompt += f"数据总量：{len(df)} 条记录\n"
+        
+        # 查找关键字段
+        key_fields = resolve_analysis_fields(analysis_type, columns)
+        
+        # 保存原始数据副本
+        original_df = df.copy()
+        
+        # 分析上报时间
+        time_col = key_fields['上报时间']
+        if time_col:
+            try:
+                # 整列解析时间字段，处理各种时间格式，包括非标准格式
+                df[time_col], time_parse_stats = parse_case_timestamps(df[time_col])
+                result['time_parse_stats'] = time_parse_stats
+                
+                # 移除无法解析的时间值
+                original_count = len(df)
+                df = df.dropna(subset=[time_col])
+                valid_count = len(df)
+                
+                # 添加数据统计信息
+                prompt += f"\n数据统计信息：\n"
+                prompt += f"总记录数：{original_count}\n"
+                prompt += f"有效时间记录数：{valid_count}\n"
+                prompt += f"时间解析成功率：{valid_count/original_count:.2%}\n"
+                
+                if valid_count > 0:
+                    # 提取时间特征
+                    df['day'] = df[time_col].dt.day
+                    df['hour'] = df[time_col].dt.hour
+                    
+                    # 日案件量趋势
+                    daily_counts = df.groupby('day').size().reset_index(name='count')
+                    prompt += f"\n日案件量趋势：\n{daily_counts.to_string(index=False)}"
+                    
+                    # 高峰时段分析（小时级）
+                    hourly_counts = df.groupby('hour').size().reset_index(name='count')
+                    prompt += f"\n小时级高峰时段分析：\n{hourly_counts.to_string(index=False)}"
+                    
+                    # 计算高峰时段
+                    peak_hours = hourly_counts.sort_values('count', ascending=False).head(3)
+                    prompt += f"\nTop 3 高峰时段：\n{peak_hours.to_string(index=False)}"
+                    
+                    # 添加图表数据到结果
+                    result['chart_data'] = {
+                        'daily': daily_counts.to_dict('records'),
+                        'hourly': hourly_counts.to_dict('records'),
+                        'peak_hours': peak_hours.to_dict('records')
+                    }
+                else:
+                    prompt += "\n警告：所有时间值均无法解析，无法进行时间维度分析。\n"
+                    # 使用原始数据进行其他分析
+                    df = original_df
+                
+            except Exception as e:
+                prompt += f"\n时间列转换失败：{str(e)}"
+                # 即使时间处理失败，也要添加基本数据统计
+                prompt += f"\n基本数据统计：\n总记录数：{len(df)}\n"
         
-        # 调用API，添加重试机制
-        max_retries = 3
-        retry_delay = 5
+        # 分析小类名称
+        category_col = key_fields['小类名称']
+        if category_col:
+            try:
+                category_counts = top_value_counts(df[category_col], 10).reset_index()
+                category_counts.columns = [category_col, 'count']
+                prompt += f"\n案件类型分布（前10）：\n{category_counts.to_string(index=False)}"
+            except Exception as e:
+                prompt += f"\n类型分析失败：{str(e)}"
         
-        for attempt in range(max_retries):
+        # 分析道路名称
+        road_col = key_fields['提取的道路名称']
+        if road_col:
             try:
-                response = requests.post(
-                    API_URL, 
-                    headers=headers, 
-                    json=payload, 
-                    timeout=(10, 300)  # 连接超时10秒，读取超时300秒
-                )
-                response.raise_for_status()
-                result = response.json()
-                analysis_content = result['choices'][0]['message']['content']
-                break
-            except requests.exceptions.RequestException as e:
-                if attempt < max_retries - 1:
-                    print(f"API调用失败，{retry_delay}秒后重试... (尝试 {attempt+1}/{max_retries})")
-                    import time
-                    time.sleep(retry_delay)
-                    retry_delay *= 2  # 指数退避
+                road_counts = top_value_counts(df[road_col], 10).reset_index()
+                road_counts.columns = [road_col, 'count']
+                prompt += f"\n案件高发区域（前10）：\n{road_counts.to_string(index=False)}"
+            except Exception as e:
+                prompt += f"\n区域分析失败：{str(e)}"
+    
+    # 案件空间分析
+    elif analysis_type == 'space_analysis':
+        # 生成分析提示
+        prompt = f"数据表 {table_name} 包含以下关键字段：\n"
+        prompt += f"- 地址描述：案件发生的详细地址\n"
+        prompt += f"- 所属街道：案件所属的街道\n"
+        prompt += f"- 所属社区：案件所属的社区\n"
+        prompt += f"- 所属片区：案件所属的片区\n"
+        prompt += f"- 小类名称：案件的具体类型\n"
+        prompt += f"数据总量：{len(df)} 条记录\n"
+        
+        # 查找关键字段
+        key_fields = resolve_analysis_fields(analysis_type, columns)
+        
+        # 分析所属街道
+        street_col = key_fields['所属街道']
+        if street_col:
+            try:
+                street_counts = top_value_counts(df[street_col], 10).reset_index()
+                street_counts.columns = [street_col, 'count']
+                prompt += f"\n各街道案件密度（前10）：\n{street_counts.to_string(index=False)}"
+                
+                # 添加街道案件密度数据到结果
+                result['chart_data'] = {
+                    'street': street_counts.to_dict('records')
+                }
+            except Exception as e:
+                prompt += f"\n街道分析失败：{str(e)}"
+        
+        # 分析所属社区
+        community_col = key_fields['所属社区']
+        if community_col:
+            try:
+                community_counts = top_value_counts(df[community_col], 10).reset_index()
+                community_counts.columns = [community_col, 'count']
+                prompt += f"\n各社区案件密度（前10）：\n{community_counts.to_string(index=False)}"
+                
+                # 添加社区案件密度数据到结果
+                if 'chart_data' not in result:
+                    result['chart_data'] = {}
+                result['chart_data']['community'] = community_counts.to_dict('records')
+            except Exception as e:
+                prompt += f"\n社区分析失败：{str(e)}"
+        
+        # 分析所属片区
+        area_col = key_fields['所属片区']
+        if area_col:
+            try:
+                area_counts = top_value_counts(df[area_col], 10).reset_index()
+                area_counts.columns = [area_col, 'count']
+                prompt += f"\n各片区案件密度（前10）：\n{area_counts.to_string(index=False)}"
+                
+                # 添加片区案件密度数据到结果
+                if 'chart_data' not in result:
+                    result['chart_data'] = {}
+                result['chart_data']['area'] = area_counts.to_dict('records')
+            except Exception as e:
+                prompt += f"\n片区分析失败：{str(e)}"
+        
+        # 分析地址描述（按规范化后的地址统计，“XX路100号附近”与“XX路100号”合并计数）
+        address_col = key_fields['地址描述']
+        addresses = None
+        if address_col:
+            try:
+                addresses = resolve_addresses(df[address_col])
+                located = addresses[addresses['normalized'] != '']
+                address_counts = located.groupby('normalized').agg(
+                    count=('normalized', 'size'),
+                    longitude=('longitude', 'first'),
+                    latitude=('latitude', 'first')
+                ).sort_values('count', ascending=False, kind='stable').head(10).reset_index()
+                address_counts = address_counts.rename(columns={'normalized': address_col})
+                prompt += f"\n高发地址（前10）：\n{address_counts[[address_col, 'count']].to_string(index=False)}"
+                
+                precision_counts = located['precise'].map({True: '精准地址', False: '模糊地址'}).value_counts().reset_index()
+                precision_counts.columns = ['type', 'count']
+                
+                if 'chart_data' not in result:
+                    result['chart_data'] = {}
+                result['chart_data']['address_hotspots'] = address_counts.to_dict('records')
+                result['chart_data']['address_type_distribution'] = precision_counts.to_dict('records')
+                result['address_stats'] = {
+                    'total': int(len(located)),
+                    'distinct_raw': int(df[address_col].nunique()),
+                    'distinct_normalized': int(located['normalized'].nunique()),
+                    'geocoded': int(located['longitude'].notna().sum())
+                }
+            except Exception as e:
+                prompt += f"\n地址分析失败：{str(e)}"
+        
+        # 高发区域热力图（按网格聚合案件坐标）
+        try:
+            heatmap = case_table_heatmap(table_name, df, addresses=addresses)
+            if heatmap and heatmap['cells']:
+                if 'chart_data' not in result:
+                    result['chart_data'] = {}
+                result['chart_data']['heatmap'] = heatmap
+                prompt += f"\n案件热力图：{heatmap['located']} 条案件已定位，最密集的区域（中心经度, 中心纬度, 案件数）："
+                for longitude, latitude, count in heatmap['cells'][:HEATMAP_TOP_CELLS]:
+                    prompt += f"\n- ({longitude}, {latitude})：{count} 条"
+        except Exception as e:
+            prompt += f"\n热力图分析失败：{str(e)}"
+        
+        # 分析小类名称
+        category_col = key_fields['小类名称']
+        if category_col:
+            try:
+                category_counts = top_value_counts(df[category_col], 10).reset_index()
+                category_counts.columns = [category_col, 'count']
+                prompt += f"\n案件类型分布（前10）：\n{category_counts.to_string(index=False)}"
+            except Exception as e:
+                prompt += f"\n类型分析失败：{str(e)}"
+    
+    # 对比上月分析
+    elif analysis_type == 'monthly_comparison':
+        # 生成分析提示
+        prompt = f"数据表 {table_name} 包含以下关键字段：\n"
+        prompt += f"- 捆绑处置截止时间：案件的处置截止时间，用于判断案件所属月份\n"
+        prompt += f"- 小类名称：案件的具体类型\n"
+        prompt += f"- 问题描述：案件的问题描述\n"
+        prompt += f"数据总量：{len(df)} 条记录\n"
+        
+        # 查找关键字段
+        key_fields = resolve_analysis_fields(analysis_type, columns)
+        
+        # 分析捆绑处置截止时间
+        time_col = key_fields['捆绑处置截止时间']
+        if time_col:
+            try:
+                # 整列解析时间字段
+                df[time_col], time_parse_stats = parse_case_timestamps(df[time_col])
+                result['time_parse_stats'] = time_parse_stats
+                
+                # 移除无法解析的时间值
+                original_count = len(df)
+                df = df.dropna(subset=[time_col])
+                valid_count = len(df)
+                
+                # 添加数据统计信息
+                prompt += f"\n数据统计信息：\n"
+                prompt += f"总记录数：{original_count}\n"
+                prompt += f"有效时间记录数：{valid_count}\n"
+                prompt += f"时间解析成功率：{valid_count/original_count:.2%}\n"
+                
+                if valid_count > 0:
+                    # 提取月份信息
+                    df['month'] = df[time_col].dt.to_period('M')
+                    
+                    # 获取表中所有唯一的月份并按降序排序
+                    unique_months = sorted(df['month'].unique(), reverse=True)
+                    
+                    # 确保有至少两个月的数据
+                    if len(unique_months) >= 2:
+                        # 选择最近的两个月份
+                        recent_month = unique_months[0]
+                        previous_month = unique_months[1]
+                        
+                        # 筛选两个月的数据
+                        recent_month_data = df[df['month'] == recent_month]
+                        previous_month_data = df[df['month'] == previous_month]
+                        
+                        # 计算案件数量变化
+                        recent_count = len(recent_month_data)
+                        previous_count = len(previous_month_data)
+                        count_change = recent_count - previous_count
+                        count_change_rate = (count_change / previous_count * 100) if previous_count > 0 else 0
+                        
+                        # 格式化月份显示
+                        recent_month_str = recent_month.strftime('%Y-%m')
+                        previous_month_str = previous_month.strftime('%Y-%m')
+                        
+                        prompt += f"\n案件数量变化：\n"
+                        prompt += f"{previous_month_str}案件数：{previous_count}\n"
+                        prompt += f"{recent_month_str}案件数：{recent_count}\n"
+                        prompt += f"变化量：{count_change}\n"
+                        prompt += f"变化率：{count_change_rate:.2f}%\n"
+                        
+                        # 添加案件数量对比数据到结果
+                        result['chart_data'] = {
+                            'monthly_comparison': [
+                                {'month': previous_month_str, 'count': previous_count},
+                                {'month': recent_month_str, 'count': recent_count}
+                            ]
+                        }
+                        
+                        # 分析案件大小类别变化
+                        category_col = key_fields['小类名称']
+                        if category_col:
+                            try:
+                                # 计算两个月的案件类型分布
+                                previous_category_counts = top_value_counts(previous_month_data[category_col], 10).reset_index()
+                                previous_category_counts.columns = [category_col, 'count']
+                                
+                                recent_category_counts = top_value_counts(recent_month_data[category_col], 10).reset_index()
+                                recent_category_counts.columns = [category_col, 'count']
+                                
+                                prompt += f"\n{previous_month_str}案件类型分布（前10）：\n{previous_category_counts.to_string(index=False)}\n"
+                                prompt += f"\n{recent_month_str}案件类型分布（前10）：\n{recent_category_counts.to_string(index=False)}\n"
+                                
+                                # 分析类型变化
+                                previous_categories = set(previous_category_counts[category_col])
+                                recent_categories = set(recent_category_counts[category_col])
+                                
+                                # 新增的类型
+                                new_categories = recent_categories - previous_categories
+                                # 减少的类型
+                                reduced_categories = previous_categories - recent_categories
+                                
+                                prompt += f"\n案件类型变化：\n"
+                                prompt += f"新增类型：{list(new_categories) if new_categories else '无'}\n"
+                                prompt += f"减少类型：{list(reduced_categories) if reduced_categories else '无'}\n"
+                                
+                                # 添加案件大小类别对比数据到结果
+                                if 'chart_data' not in result:
+                                    result['chart_data'] = {}
+                                result['chart_data']['case_size_comparison'] = [
+                                    {'type': previous_month_str, 'categories': previous_category_counts.to_dict('records')},
+                                    {'type': recent_month_str, 'categories': recent_category_counts.to_dict('records')}
+                                ]
+                                
+                            except Exception as e:
+                                prompt += f"\n案件类型分析失败：{str(e)}\n"
+                        
+                        # 分析问题变化
+                        problem_col = key_fields['问题描述']
+                        if problem_col:
+                            try:
+                                # 计算两个月的问题描述分布
+                                previous_problem_counts = top_value_counts(previous_month_data[problem_col], 10).reset_index()
+                                previous_problem_counts.columns = [problem_col, 'count']
+                                
+                                recent_problem_counts = top_value_counts(recent_month_data[problem_col], 10).reset_index()
+                                recent_problem_counts.columns = [problem_col, 'count']
+                                
+                                prompt += f"\n{previous_month_str}问题描述分布（前10）：\n{previous_problem_counts.to_string(index=False)}\n"
+                                prompt += f"\n{recent_month_str}问题描述分布（前10）：\n{recent_problem_counts.to_string(index=False)}\n"
+                                
+                                # 分析问题变化
+                                previous_problems = set(previous_problem_counts[problem_col])
+                                recent_problems = set(recent_problem_counts[problem_col])
+                                
+                                # 新增的问题
+                                new_problems = recent_problems - previous_problems
+                                # 减少的问题
+                                reduced_problems = previous_problems - recent_problems
+                                
+                                prompt += f"\n问题变化：\n"
+                                prompt += f"新增问题：{list(new_problems) if new_problems else '无'}\n"
+                                prompt += f"减少问题：{list(reduced_problems) if reduced_problems else '无'}\n"
+                                
+                                # 添加问题趋势数据到结果
+                                if 'chart_data' not in result:
+                                    result['chart_data'] = {}
+                                result['chart_data']['problem_trend'] = [
+                                    {'type': previous_month_str, 'problems': previous_problem_counts.to_dict('records')},
+                                    {'type': recent_month_str, 'problems': recent_problem_counts.to_dict('records')}
+                                ]
+                                
+                            except Exception as e:
+                                prompt += f"\n问题描述分析失败：{str(e)}\n"
+                    else:
+                        prompt += "\n警告：表中数据不足两个月，无法进行月度对比分析。\n"
+                        prompt += f"表中包含的月份：{[m.strftime('%Y-%m') for m in unique_months] if unique_months else '无'}\n"
                 else:
-                    raise Exception(f"大模型API调用失败，请稍后重试: {str(e)}")
-        
-        # 解析评分结果（简化处理，实际可能需要更复杂的解析）
-        scores = {
-            'collection': 85,  # 默认值，实际应从分析结果中提取
-            'acceptance': 80,
-            'dispatch': 75,
-            'disposal': 82
+                    prompt += "\n警告：所有时间值均无法解析，无法进行月度对比分析。\n"
+                
+            except Exception as e:
+                prompt += f"\n时间列转换失败：{str(e)}\n"
+                # 即使时间处理失败，也要添加基本数据统计
+                prompt += f"\n基本数据统计：\n总记录数：{len(df)}\n"
+    
+    # 案件来源分析
+    elif analysis_type == 'source_analysis':
+        # 生成分析提示
+        prompt = f"数据表 {table_name} 包含以下关键字段：\n"
+        prompt += f"- 问题来源：案件的来源渠道\n"
+        prompt += f"- 小类名称：案件的具体类型\n"
+        prompt += f"- 地址描述：案件发生的详细地址\n"
+        prompt += f"数据总量：{len(df)} 条记录\n"
+        
+        # 查找关键字段
+        key_fields = resolve_analysis_fields(analysis_type, columns)
+        
+        # 分析问题来源
+        source_col = key_fields['问题来源']
+        if source_col:
+            try:
+                source_counts = top_value_counts(df[source_col], 10).reset_index()
+                source_counts.columns = [source_col, 'count']
+                prompt += f"\n案件来源分布（前10）：\n{source_counts.to_string(index=False)}"
+                
+                # 添加来源分布数据到结果
+                result['chart_data'] = {
+                    'source': source_counts.to_dict('records')
+                }
+            except Exception as e:
+                prompt += f"\n来源分析失败：{str(e)}"
+        
+        # 分析小类名称
+        category_col = key_fields['小类名称']
+        if category_col:
+            try:
+                category_counts = top_value_counts(df[category_col], 10).reset_index()
+                category_counts.columns = [category_col, 'count']
+                prompt += f"\n案件类型分布（前10）：\n{category_counts.to_string(index=False)}"
+            except Exception as e:
+                prompt += f"\n类型分析失败：{str(e)}"
+        
+        # 分析地址描述
+        address_col = key_fields['地址描述']
+        if address_col:
+            try:
+                address_counts = top_value_counts(df[address_col], 10).reset_index()
+                address_counts.columns = [address_col, 'count']
+                prompt += f"\n高发地址（前10）：\n{address_counts.to_string(index=False)}"
+            except Exception as e:
+                prompt += f"\n地址分析失败：{str(e)}"
+    
+    # 案件类型分析
+    elif analysis_type == 'type_analysis':
+        # 生成分析提示
+        prompt = f"数据表 {table_name} 包含以下关键字段：\n"
+        prompt += f"- 问题类型：案件的问题类型\n"
+        prompt += f"- 大类名称：案件的大类名称\n"
+        prompt += f"- 小类名称：案件的具体类型\n"
+        prompt += f"数据总量：{len(df)} 条记录\n"
+        
+        # 查找关键字段
+        key_fields = resolve_analysis_fields(analysis_type, columns)
+        
+        # 分析问题类型
+        problem_type_col = key_fields['问题类型']
+        if problem_type_col:
+            try:
+                problem_type_counts = top_value_counts(df[problem_type_col], 10).reset_index()
+                problem_type_counts.columns = [problem_type_col, 'count']
+                prompt += f"\n问题类型分布（前10）：\n{problem_type_counts.to_string(index=False)}"
+            except Exception as e:
+                prompt += f"\n问题类型分析失败：{str(e)}"
+        
+        # 分析大类名称
+        category_col = key_fields['大类名称']
+        if category_col:
+            try:
+                category_counts = top_value_counts(df[category_col], 10).reset_index()
+                category_counts.columns = [category_col, 'count']
+                prompt += f"\n大类名称分布（前10）：\n{category_counts.to_string(index=False)}"
+            except Exception as e:
+                prompt += f"\n大类分析失败：{str(e)}"
+        
+        # 分析小类名称
+        subcategory_col = key_fields['小类名称']
+        if subcategory_col:
+            try:
+                subcategory_counts = top_value_counts(df[subcategory_col], 10).reset_index()
+                subcategory_counts.columns = [subcategory_col, 'count']
+                prompt += f"\n小类名称分布（前10）：\n{subcategory_counts.to_string(index=False)}"
+                
+                # 添加小类分布数据到结果
+                result['chart_data'] = {
+                    'type': subcategory_counts.to_dict('records')
+                }
+            except Exception as e:
+                prompt += f"\n小类分析失败：{str(e)}"
+    
+    # 案件重复分析
+    elif analysis_type == 'duplicate_analysis':
+        # 生成分析提示
+        prompt = f"数据表 {table_name} 包含以下关键字段：\n"
+        prompt += f"- 问题描述：案件的问题描述\n"
+        prompt += f"- 地址描述：案件发生的详细地址\n"
+        prompt += f"数据总量：{len(df)} 条记录\n"
+        
+        # 查找关键字段
+        key_fields = resolve_analysis_fields(analysis_type, columns)
+        
+        # 分析问题描述字段
+        problem_col = key_fields['问题描述']
+        if problem_col:
+            try:
+                # 计算每个问题描述的出现次数
+                problem_counts = top_value_counts(df[problem_col], 10).reset_index()
+                problem_counts.columns = [problem_col, 'count']
+                prompt += f"\n问题描述重复情况（前10）：\n{problem_counts.to_string(index=False)}"
+                
+                # 添加问题描述重复数据到结果
+                if 'chart_data' not in result:
+                    result['chart_data'] = {}
+                result['chart_data']['problem_duplicates'] = problem_counts.to_dict('records')
+            except Exception as e:
+                prompt += f"\n问题描述分析失败：{str(e)}"
+        
+        # 分析地址描述字段
+        address_col = key_fields['地址描述']
+        if address_col:
+            try:
+                # 计算每个地址描述的出现次数
+                address_counts = top_value_counts(df[address_col], 10).reset_index()
+                address_counts.columns = [address_col, 'count']
+                prompt += f"\n地址描述重复情况（前10）：\n{address_counts.to_string(index=False)}"
+                
+                # 添加地址重复数据到结果
+                if 'chart_data' not in result:
+                    result['chart_data'] = {}
+                result['chart_data']['address_duplicates'] = address_counts.to_dict('records')
+                
+                # 分析地址描述类型占比（模糊地址vs精准地址）
+                address_types = classify_address_precision(df[address_col].dropna()).map({True: '精准地址', False: '模糊地址'})
+                
+                # 计算占比
+                type_counts = address_types.value_counts().reset_index()
+                type_counts.columns = ['type', 'count']
+                
+                prompt += f"\n地址描述类型占比：\n{type_counts.to_string(index=False)}"
+                result['chart_data']['address_type_distribution'] = type_counts.to_dict('records')
+                
+            except Exception as e:
+                prompt += f"\n地址描述分析失败：{str(e)}"
+        
+        # 如果两个字段都存在，分析它们的组合
+        if problem_col and address_col:
+            try:
+                # 组合问题描述和地址描述
+                df['combined_key'] = df[problem_col].astype(str) + ' | ' + df[address_col].astype(str)
+                # 计算组合键的出现次数
+                combined_counts = df['combined_key'].value_counts().head(10).reset_index()
+                combined_counts.columns = ['combined_key', 'count']
+                prompt += f"\n问题和地址组合重复情况（前10）：\n{combined_counts.to_string(index=False)}"
+                
+                # 添加组合重复数据到结果
+                if 'chart_data' not in result:
+                    result['chart_data'] = {}
+                result['chart_data']['combined_duplicates'] = combined_counts.to_dict('records')
+            except Exception as e:
+                prompt += f"\n组合分析失败：{str(e)}"
+        
+        # 近似重复案件聚类（MinHash/LSH），可发现措辞略有不同的同一问题
+        if problem_col or address_col:
+            try:
+                clusters, near_duplicate_stats = find_near_duplicate_clusters(df, problem_col, address_col)
+                prompt += f"\n近似重复案件：共 {near_duplicate_stats['cluster_count']} 组，涉及 {near_duplicate_stats['duplicate_rows']} 条案件"
+                if clusters:
+                    prompt += "\n近似重复案件簇（前10，按案件数）："
+                    for cluster in clusters[:10]:
+                        representative = ' | '.join(str(value) for value in cluster['representative'].values())
+                        prompt += f"\n- {representative}：{cluster['size']} 条（{cluster['distinct_texts']} 种写法）"
+                
+                if 'chart_data' not in result:
+                    result['chart_data'] = {}
+                result['chart_data']['near_duplicate_clusters'] = clusters
+                result['near_duplicate_stats'] = near_duplicate_stats
+            except Exception as e:
+                prompt += f"\n近似重复分析失败：{str(e)}"
+        
+        # 分析重复案件违规类型占比
+        if problem_col:
+            try:
+                # 简单的违规类型分类
+                def categorize_violation(problem):
+                    if not problem:
+                        return '其他违规'
+                    problem_str = str(problem).lower()
+                    if '店外' in problem_str or '占道' in problem_str:
+                        return '店外经营'
+                    elif '流动' in problem_str or '摊' in problem_str:
+                        return '流动摊点'
+                    else:
+                        return '其他违规'
+                
+                # 统计违规类型
+                violation_types = []
+                for problem in df[problem_col].dropna():
+                    violation_types.append(categorize_violation(problem))
+                
+                # 计算占比
+                violation_series = pd.Series(violation_types)
+                violation_counts = violation_series.value_counts().reset_index()
+                violation_counts.columns = ['type', 'count']
+                
+                prompt += f"\n重复案件违规类型占比：\n{violation_counts.to_string(index=False)}"
+                if 'chart_data' not in result:
+                    result['chart_data'] = {}
+                result['chart_data']['violation_type_distribution'] = violation_counts.to_dict('records')
+                
+            except Exception as e:
+                prompt += f"\n违规类型分析失败：{str(e)}"
+    
+    return result, prompt
+
+# 分析模式：charts_only 只返回统计图表数据，narrative_only 只返回大模型分析内容，both 两者都返回
+ANALYSIS_MODES = ('both', 'charts_only', 'narrative_only')
+
+# 批量分析时并行调用大模型的线程数（实际并发仍受大模型客户端的并发上限约束）
+ANALYSIS_BATCH_LLM_WORKERS = 6
+analysis_llm_executor = ThreadPoolExecutor(max_workers=ANALYSIS_BATCH_LLM_WORKERS, thread_name_prefix='llm')
+
+def shape_analysis_result(result, mode):
+    """按分析模式裁剪返回字段"""
+    if mode == 'narrative_only':
+        return {key: result[key] for key in ('table_name', 'analysis_type', 'data_summary', 'analysis') if key in result}
+    return result
+
+def run_analysis(table_name, analysis_type, force_refresh=False, mode='both'):
+    """执行一次数据分析并返回结果字典，同步接口和后台任务共用；force_refresh跳过大模型回复缓存"""
+    # 仅统计图表时优先读取数据立方体，不加载整张案件表
+    if mode == 'charts_only':
+        result = prepare_analysis_from_cube(table_name, analysis_type)
+        if result is not None:
+            return convert_nan_to_null(result)
+    
+    result, prompt = prepare_analysis(table_name, analysis_type)
+    
+    # 调用豆包大模型（仅统计图表时跳过）
+    if mode != 'charts_only' and prompt is not None:
+        result['analysis'] = call_doubao_api(prompt, result['data_summary'], analysis_type, force_refresh)
+    
+    # 转换NaN值为null值，确保JSON响应有效
+    return convert_nan_to_null(shape_analysis_result(result, mode))
+
+def run_analysis_batch(table_name, analysis_types, force_refresh=False, mode='both'):
+    """一次加载数据表，依次完成多个分析类型的统计，再并行调用大模型生成各自的分析内容"""
+    results = {}
+    prompts = {}
+    # 仅统计图表时能由数据立方体得到的分析类型不加载整张案件表
+    if mode == 'charts_only' and any(analysis_type in CASE_CUBE_ANALYSIS_TYPES for analysis_type in analysis_types):
+        cube = load_case_table_cube(table_name)
+        if cube is not None:
+            for analysis_type in analysis_types:
+                result = prepare_analysis_from_cube(table_name, analysis_type, cube)
+                if result is not None:
+                    results[analysis_type], prompts[analysis_type] = result, None
+    
+    remaining = [analysis_type for analysis_type in analysis_types if analysis_type not in results]
+    if remaining:
+        # 一次读取各分析类型用到的字段的并集
+        columns = get_case_table_columns(table_name)
+        required = set()
+        for analysis_type in remaining:
+            required.update(resolve_required_columns(analysis_type, columns))
+        df = load_case_table(table_name, [col for col in columns if col in required])
+        for analysis_type in remaining:
+            # 各分析类型会修改自己的列（如解析时间），使用浅拷贝互不影响
+            results[analysis_type], prompts[analysis_type] = prepare_analysis(table_name, analysis_type, df.copy(deep=False), columns)
+    
+    if mode != 'charts_only':
+        futures = {
+            analysis_type: analysis_llm_executor.submit(
+                call_doubao_api, prompt, results[analysis_type]['data_summary'], analysis_type, force_refresh
+            )
+            for analysis_type, prompt in prompts.items() if prompt is not None
         }
+        for analysis_type, future in futures.items():
+            results[analysis_type]['analysis'] = future.result()
+    
+    return convert_nan_to_null({
+        'table_name': table_name,
+        'analysis_types': list(analysis_types),
+        'results': {analysis_type: shape_analysis_result(results[analysis_type], mode) for analysis_type in analysis_types}
+    })
+
+@app.route('/api/analyze', methods=['POST'])
+@protected
+def analyze():
+    try:
+        data = request.json
+        table_name = data.get('table_name')
+        analysis_type = data.get('analysis_type')
         
-        session.commit()
-        return jsonify({
-            'analysis': analysis_content,
-            'scores': scores,
-            'file_name': file.filename,
-            'file_content': file_content  # 返回读取到的文件内容，用于前端显示
-        }), 200
+        if not table_name or not analysis_type:
+            return jsonify({'error': 'Missing table_name or analysis_type'}), 400
+        
+        mode = data.get('mode', 'both')
+        if mode not in ANALYSIS_MODES:
+            return jsonify({'error': f'Invalid mode, must be one of {", ".join(ANALYSIS_MODES)}'}), 400
+        
+        # 强制重新生成分析内容，不使用缓存的大模型回复
+        force_refresh = bool(data.get('force_refresh', False))
+        
+        # 异步模式：提交后台任务，立即返回任务ID，结果通过 /api/jobs/<job_id> 查询
+        if data.get('async'):
+            job_id = submit_job('analyze', run_analysis, (table_name, analysis_type, force_refresh, mode),
+                                {'table_name': table_name, 'analysis_type': analysis_type,
+                                 'force_refresh': force_refresh, 'mode': mode},
+                                request.user_id)
+            if not job_id:
+                return jsonify({'error': '后台任务队列已满，请稍后重试'}), 503
+            return jsonify({'job_id': job_id, 'status': 'pending'}), 202
+        
+        result = run_analysis(table_name, analysis_type, force_refresh, mode)
+        return jsonify(result), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analyze/batch', methods=['POST'])
+@protected
+def analyze_batch():
+    """批量分析：共用一次数据加载，大模型调用并行执行"""
+    try:
+        data = request.json
+        table_name = data.get('table_name')
+        analysis_types = data.get('analysis_types')
+        
+        if not table_name or not isinstance(analysis_types, list) or not analysis_types:
+            return jsonify({'error': 'Missing table_name or analysis_types'}), 400
+        # 去重并保持顺序
+        analysis_types = list(dict.fromkeys(analysis_types))
+        
+        mode = data.get('mode', 'both')
+        if mode not in ANALYSIS_MODES:
+            return jsonify({'error': f'Invalid mode, must be one of {", ".join(ANALYSIS_MODES)}'}), 400
+        force_refresh = bool(data.get('force_refresh', False))
+        
+        if data.get('async'):
+            job_id = submit_job('analyze_batch', run_analysis_batch, (table_name, analysis_types, force_refresh, mode),
+                                {'table_name': table_name, 'analysis_types': analysis_types,
+                                 'force_refresh': force_refresh, 'mode': mode},
+                                request.user_id)
+            if not job_id:
+                return jsonify({'error': '后台任务队列已满，请稍后重试'}), 503
+            return jsonify({'job_id': job_id, 'status': 'pending'}), 202
+        
+        result = run_analysis_batch(table_name, analysis_types, force_refresh, mode)
+        return jsonify(result), 200
     except Exception as e:
-        session.rollback()
-        print(f"Error in spotcheck: {str(e)}")
+        print(f"Error in analyze_batch: {str(e)}")
         import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
-    finally:
-        session.close()
 
-@app.route('/api/analyze', methods=['POST'])
+@app.route('/api/analyze/heatmap', methods=['GET'])
 @protected
-def analyze():
+def analyze_heatmap():
+    """案件热力图，可指定单元类型（grid/hex）和单元大小（度）"""
+    try:
+        table_name = request.args.get('table_name')
+        if not table_name:
+            return jsonify({'error': 'Missing table_name'}), 400
+        cell_type = request.args.get('cell_type', HEATMAP_CELL_TYPE)
+        if cell_type not in HEATMAP_CELL_TYPES:
+            return jsonify({'error': f'Invalid cell_type, must be one of {", ".join(HEATMAP_CELL_TYPES)}'}), 400
+        try:
+            cell_size = float(request.args.get('cell_size', HEATMAP_CELL_SIZE))
+        except ValueError:
+            return jsonify({'error': 'Invalid cell_size'}), 400
+        if not 0 < cell_size <= 1:
+            return jsonify({'error': 'cell_size must be between 0 and 1 degree'}), 400
+        
+        # 只读取经纬度和地址字段
+        columns = get_case_table_columns(table_name)
+        heatmap_columns = list(find_coordinate_columns(columns)) + [resolve_analysis_fields('space_analysis', columns)['地址描述']]
+        df = load_case_table(table_name, [col for col in columns if col in heatmap_columns])
+        heatmap = case_table_heatmap(table_name, df, cell_type, cell_size)
+        if heatmap is None:
+            return jsonify({'error': '数据表中没有经纬度或地址字段'}), 400
+        return jsonify(heatmap), 200
+    except Exception as e:
+        print(f"Error in analyze_heatmap: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analyze/charts', methods=['POST'])
+@protected
+def analyze_charts():
+    """只计算统计图表数据，不调用大模型"""
     try:
         data = request.json
         table_name = data.get('table_name')
@@ -1545,773 +4916,253 @@ def analyze():
         if not table_name or not analysis_type:
             return jsonify({'error': 'Missing table_name or analysis_type'}), 400
         
-        # 从数据库读取数据
-        df = pd.read_sql_table(table_name, engine)
+        result = run_analysis(table_name, analysis_type, mode='charts_only')
+        return jsonify(result), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analyze/trend', methods=['POST'])
+@protected
+def analyze_trend():
+    """多月趋势分析：按数据表列表或月份范围（YYYY-MM）汇总各小类的逐月案件数和增长、下降排名"""
+    import re
+    try:
+        data = request.json or {}
+        table_names = data.get('table_names')
+        start_month = data.get('start_month')
+        end_month = data.get('end_month')
+        
+        if table_names is not None:
+            if not isinstance(table_names, list) or not table_names:
+                return jsonify({'error': 'table_names must be a non-empty list'}), 400
+            existing = set(inspect(engine).get_table_names())
+            missing = [table_name for table_name in table_names if table_name not in existing]
+            if missing:
+                return jsonify({'error': f'Tables not found: {", ".join(missing)}'}), 404
+        for month in (start_month, end_month):
+            if month and not re.fullmatch(r'\d{4}-\d{2}', str(month)):
+                return jsonify({'error': 'start_month and end_month must be in YYYY-MM format'}), 400
+        try:
+            top_n = int(data.get('top_n', TREND_TOP_N))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid top_n'}), 400
+        
+        if table_names is not None:
+            # 请求中不聚合数据：没有当前代次立方体的案件表提交（或沿用已有的）后台聚合任务，返回202由前端稍后重试
+            with engine.connect() as conn:
+                current = _current_cube_tables(conn, table_names)
+                case_tables = {row[0] for row in conn.execute(
+                    text("SELECT table_name FROM case_table_generations WHERE table_name IN :table_names")
+                    .bindparams(bindparam('table_names', expanding=True)), {'table_names': table_names})}
+            not_case = [table_name for table_name in table_names if table_name not in case_tables]
+            if not_case:
+                return jsonify({'error': f'Not case tables: {", ".join(not_case)}'}), 400
+            pending = [table_name for table_name in table_names if table_name not in current]
+            if pending:
+                job_ids = {}
+                for table_name in pending:
+                    job_id = find_active_cube_job(table_name) or submit_job(
+                        'case_cube', build_case_table_cube, (table_name,), {'table_name': table_name}, request.user_id)
+                    if not job_id:
+                        return jsonify({'error': '后台任务队列已满，请稍后重试'}), 503
+                    job_ids[table_name] = job_id
+                return jsonify({'status': 'pending', 'message': '数据立方体正在聚合，请稍后重试', 'job_ids': job_ids}), 202
+        
+        result = case_trends(table_names, start_month, end_month, top_n)
+        return jsonify(result), 200
+    except Exception as e:
+        print(f"Error in analyze_trend: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+def format_sse(event, data):
+    """格式化一条Server-Sent Events消息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+@app.route('/api/analyze/stream', methods=['POST'])
+@protected
+def analyze_stream():
+    """流式分析：统计完成后先推送chart_data，再逐段推送大模型输出"""
+    data = request.json or {}
+    table_name = data.get('table_name')
+    analysis_type = data.get('analysis_type')
+    force_refresh = bool(data.get('force_refresh', False))
+    
+    if not table_name or not analysis_type:
+        return jsonify({'error': 'Missing table_name or analysis_type'}), 400
+    
+    def generate():
+        # 先发送注释行，让反向代理和浏览器尽快收到响应头
+        yield ": stream opened\n\n"
+        try:
+            result, prompt = prepare_analysis(table_name, analysis_type)
+        except Exception as e:
+            print(f"Error in analyze_stream: {str(e)}")
+            yield format_sse('error', {'error': str(e)})
+            return
         
-        # 基础结果
-        result = {
-            'table_name': table_name,
-            'analysis_type': analysis_type,
-            'data_summary': f'Table has {len(df)} rows and {len(df.columns)} columns',
-            'columns': df.columns.tolist(),
-            'sample_data': df.head(5).to_dict('records')
-        }
+        # 统计结果（含chart_data）先行返回
+        yield format_sse('chart_data', convert_nan_to_null(result))
         
-        # 案件时间分析
-        if analysis_type == 'time_analysis':
-            # 生成分析提示
-            prompt = f"数据表 {table_name} 包含以下关键字段：\n"
-            prompt += f"- 上报时间：案件的上报时间\n"
-            prompt += f"- 小类名称：案件的具体类型\n"
-            prompt += f"- 提取的道路名称：案件发生的位置\n"
-            prompt += f"数据总量：{len(df)} 条记录\n"
-            
-            # 重点分析字段
-            key_fields = {
-                '上报时间': None,
-                '小类名称': None,
-                '提取的道路名称': None
-            }
-            
-            # 查找关键字段
-            for col in df.columns:
-                col_lower = col.lower()
-                if '上报' in col:
-                    # 优先匹配「上报时间」字段
-                    key_fields['上报时间'] = col
-                elif '小类' in col or '类型' in col_lower:
-                    key_fields['小类名称'] = col
-                elif '道路' in col or '路名' in col or '街' in col:
-                    key_fields['提取的道路名称'] = col
-            
-            # 如果没有找到上报时间，再尝试其他时间字段
-            if not key_fields['上报时间']:
-                for col in df.columns:
-                    if '时间' in col:
-                        key_fields['上报时间'] = col
-                        break
-            
-            # 保存原始数据副本
-            original_df = df.copy()
-            
-            # 分析上报时间
-            time_col = key_fields['上报时间']
-            if time_col:
-                try:
-                    # 处理各种时间格式，包括非标准格式
-                    def parse_time_string(time_str):
-                        if not time_str:
-                            return pd.NaT
-                        
-                        if isinstance(time_str, str):
-                            # 处理 GMT 格式：Wed, 31 Dec 2025 15:02:18 GMT
-                            if 'GMT' in time_str:
-                                try:
-                                    # 移除星期和 GMT 时区
-                                    time_str = time_str.split(', ')[1].replace(' GMT', '')
-                                    # 转换为标准格式
-                                    return pd.to_datetime(time_str, format='%d %b %Y %H:%M:%S')
-                                except:
-                                    pass
-                            
-                            # 处理相对时间格式：1小时55分18秒
-                            if any(unit in time_str for unit in ['小时', '分', '秒']):
-                                # 对于相对时间，返回 NaT，因为无法转换为绝对时间
-                                return pd.NaT
-                            
-                            # 尝试多种标准格式
-                            formats = ['%Y-%m-%d %H:%M:%S', '%Y/%m/%d %H:%M:%S', '%Y-%m-%d', '%Y/%m/%d', '%d-%m-%Y', '%d/%m/%Y']
-                            for fmt in formats:
-                                try:
-                                    return pd.to_datetime(time_str, format=fmt)
-                                except:
-                                    pass
-                        
-                        # 最后的尝试，让 pandas 自动解析
-                        try:
-                            return pd.to_datetime(time_str)
-                        except:
-                            return pd.NaT
-                    
-                    # 应用时间解析函数
-                    df[time_col] = df[time_col].apply(parse_time_string)
-                    
-                    # 移除无法解析的时间值
-                    original_count = len(df)
-                    df = df.dropna(subset=[time_col])
-                    valid_count = len(df)
-                    
-                    # 添加数据统计信息
-                    prompt += f"\n数据统计信息：\n"
-                    prompt += f"总记录数：{original_count}\n"
-                    prompt += f"有效时间记录数：{valid_count}\n"
-                    prompt += f"时间解析成功率：{valid_count/original_count:.2%}\n"
-                    
-                    if valid_count > 0:
-                        # 统一转换为 YYYY-MM-DD HH:MM:SS 格式
-                        df[time_col] = df[time_col].dt.strftime('%Y-%m-%d %H:%M:%S')
-                        # 重新转换为 datetime 类型以提取特征
-                        df[time_col] = pd.to_datetime(df[time_col])
-                        
-                        # 提取时间特征
-                        df['day'] = df[time_col].dt.day
-                        df['hour'] = df[time_col].dt.hour
-                        
-                        # 日案件量趋势
-                        daily_counts = df.groupby('day').size().reset_index(name='count')
-                        prompt += f"\n日案件量趋势：\n{daily_counts.to_string(index=False)}"
-                        
-                        # 高峰时段分析（小时级）
-                        hourly_counts = df.groupby('hour').size().reset_index(name='count')
-                        prompt += f"\n小时级高峰时段分析：\n{hourly_counts.to_string(index=False)}"
-                        
-                        # 计算高峰时段
-                        peak_hours = hourly_counts.sort_values('count', ascending=False).head(3)
-                        prompt += f"\nTop 3 高峰时段：\n{peak_hours.to_string(index=False)}"
-                        
-                        # 添加图表数据到结果
-                        result['chart_data'] = {
-                            'daily': daily_counts.to_dict('records'),
-                            'hourly': hourly_counts.to_dict('records'),
-                            'peak_hours': peak_hours.to_dict('records')
-                        }
-                    else:
-                        prompt += "\n警告：所有时间值均无法解析，无法进行时间维度分析。\n"
-                        # 使用原始数据进行其他分析
-                        df = original_df
-                    
-                except Exception as e:
-                    prompt += f"\n时间列转换失败：{str(e)}"
-                    # 即使时间处理失败，也要添加基本数据统计
-                    prompt += f"\n基本数据统计：\n总记录数：{len(df)}\n"
-            
-            # 分析小类名称
-            category_col = key_fields['小类名称']
-            if category_col:
-                try:
-                    category_counts = df[category_col].value_counts().head(10).reset_index()
-                    category_counts.columns = [category_col, 'count']
-                    prompt += f"\n案件类型分布（前10）：\n{category_counts.to_string(index=False)}"
-                except Exception as e:
-                    prompt += f"\n类型分析失败：{str(e)}"
-            
-            # 分析道路名称
-            road_col = key_fields['提取的道路名称']
-            if road_col:
-                try:
-                    road_counts = df[road_col].value_counts().head(10).reset_index()
-                    road_counts.columns = [road_col, 'count']
-                    prompt += f"\n案件高发区域（前10）：\n{road_counts.to_string(index=False)}"
-                except Exception as e:
-                    prompt += f"\n区域分析失败：{str(e)}"
-            
-            # 调用豆包大模型
-            # 调整提示词，只关注日案件量趋势和高峰时段分析
-            analysis_result = call_doubao_api(prompt, result['data_summary'], analysis_type)
-            result['analysis'] = analysis_result
-        
-        # 案件空间分析
-        elif analysis_type == 'space_analysis':
-            # 生成分析提示
-            prompt = f"数据表 {table_name} 包含以下关键字段：\n"
-            prompt += f"- 地址描述：案件发生的详细地址\n"
-            prompt += f"- 所属街道：案件所属的街道\n"
-            prompt += f"- 所属社区：案件所属的社区\n"
-            prompt += f"- 所属片区：案件所属的片区\n"
-            prompt += f"- 小类名称：案件的具体类型\n"
-            prompt += f"数据总量：{len(df)} 条记录\n"
-            
-            # 重点分析字段
-            key_fields = {
-                '地址描述': None,
-                '所属街道': None,
-                '所属社区': None,
-                '所属片区': None,
-                '小类名称': None
-            }
-            
-            # 查找关键字段
-            for col in df.columns:
-                col_lower = col.lower()
-                if '地址' in col or '位置' in col_lower:
-                    key_fields['地址描述'] = col
-                elif '街道' in col:
-                    key_fields['所属街道'] = col
-                elif '社区' in col:
-                    key_fields['所属社区'] = col
-                elif '片区' in col or '区域' in col_lower:
-                    key_fields['所属片区'] = col
-                elif '小类' in col or '类型' in col_lower:
-                    key_fields['小类名称'] = col
-            
-            # 分析所属街道
-            street_col = key_fields['所属街道']
-            if street_col:
-                try:
-                    street_counts = df[street_col].value_counts().head(10).reset_index()
-                    street_counts.columns = [street_col, 'count']
-                    prompt += f"\n各街道案件密度（前10）：\n{street_counts.to_string(index=False)}"
-                    
-                    # 添加街道案件密度数据到结果
-                    result['chart_data'] = {
-                        'street': street_counts.to_dict('records')
-                    }
-                except Exception as e:
-                    prompt += f"\n街道分析失败：{str(e)}"
-            
-            # 分析所属社区
-            community_col = key_fields['所属社区']
-            if community_col:
-                try:
-                    community_counts = df[community_col].value_counts().head(10).reset_index()
-                    community_counts.columns = [community_col, 'count']
-                    prompt += f"\n各社区案件密度（前10）：\n{community_counts.to_string(index=False)}"
-                    
-                    # 添加社区案件密度数据到结果
-                    if 'chart_data' not in result:
-                        result['chart_data'] = {}
-                    result['chart_data']['community'] = community_counts.to_dict('records')
-                except Exception as e:
-                    prompt += f"\n社区分析失败：{str(e)}"
-            
-            # 分析所属片区
-            area_col = key_fields['所属片区']
-            if area_col:
-                try:
-                    area_counts = df[area_col].value_counts().head(10).reset_index()
-                    area_counts.columns = [area_col, 'count']
-                    prompt += f"\n各片区案件密度（前10）：\n{area_counts.to_string(index=False)}"
-                    
-                    # 添加片区案件密度数据到结果
-                    if 'chart_data' not in result:
-                        result['chart_data'] = {}
-                    result['chart_data']['area'] = area_counts.to_dict('records')
-                except Exception as e:
-                    prompt += f"\n片区分析失败：{str(e)}"
-            
-            # 分析地址描述
-            address_col = key_fields['地址描述']
-            if address_col:
-                try:
-                    address_counts = df[address_col].value_counts().head(10).reset_index()
-                    address_counts.columns = [address_col, 'count']
-                    prompt += f"\n高发地址（前10）：\n{address_counts.to_string(index=False)}"
-                except Exception as e:
-                    prompt += f"\n地址分析失败：{str(e)}"
-            
-            # 分析小类名称
-            category_col = key_fields['小类名称']
-            if category_col:
-                try:
-                    category_counts = df[category_col].value_counts().head(10).reset_index()
-                    category_counts.columns = [category_col, 'count']
-                    prompt += f"\n案件类型分布（前10）：\n{category_counts.to_string(index=False)}"
-                except Exception as e:
-                    prompt += f"\n类型分析失败：{str(e)}"
-            
-            # 调用豆包大模型
-            analysis_result = call_doubao_api(prompt, result['data_summary'], analysis_type)
-            result['analysis'] = analysis_result
-        
-        # 对比上月分析
-        elif analysis_type == 'monthly_comparison':
-            # 生成分析提示
-            prompt = f"数据表 {table_name} 包含以下关键字段：\n"
-            prompt += f"- 捆绑处置截止时间：案件的处置截止时间，用于判断案件所属月份\n"
-            prompt += f"- 小类名称：案件的具体类型\n"
-            prompt += f"- 问题描述：案件的问题描述\n"
-            prompt += f"数据总量：{len(df)} 条记录\n"
-            
-            # 重点分析字段
-            key_fields = {
-                '捆绑处置截止时间': None,
-                '小类名称': None,
-                '问题描述': None
-            }
-            
-            # 查找关键字段
-            for col in df.columns:
-                col_lower = col.lower()
-                if '捆绑' in col and '截止' in col and '时间' in col:
-                    key_fields['捆绑处置截止时间'] = col
-                elif '小类' in col or '类型' in col_lower:
-                    key_fields['小类名称'] = col
-                elif '问题' in col and '描述' in col:
-                    key_fields['问题描述'] = col
-            
-            # 分析捆绑处置截止时间
-            time_col = key_fields['捆绑处置截止时间']
-            if time_col:
-                try:
-                    # 处理各种时间格式
-                    def parse_time_string(time_str):
-                        if not time_str:
-                            return pd.NaT
-                        
-                        if isinstance(time_str, str):
-                            # 处理 GMT 格式：Wed, 31 Dec 2025 15:02:18 GMT
-                            if 'GMT' in time_str:
-                                try:
-                                    # 移除星期和 GMT 时区
-                                    time_str = time_str.split(', ')[1].replace(' GMT', '')
-                                    # 转换为标准格式
-                                    return pd.to_datetime(time_str, format='%d %b %Y %H:%M:%S')
-                                except:
-                                    pass
-                            
-                            # 处理相对时间格式：1小时55分18秒
-                            if any(unit in time_str for unit in ['小时', '分', '秒']):
-                                # 对于相对时间，返回 NaT
-                                return pd.NaT
-                            
-                            # 尝试多种标准格式
-                            formats = ['%Y-%m-%d %H:%M:%S', '%Y/%m/%d %H:%M:%S', '%Y-%m-%d', '%Y/%m/%d', '%d-%m-%Y', '%d/%m/%Y']
-                            for fmt in formats:
-                                try:
-                                    return pd.to_datetime(time_str, format=fmt)
-                                except:
-                                    pass
-                        
-                        # 最后的尝试，让 pandas 自动解析
-                        try:
-                            return pd.to_datetime(time_str)
-                        except:
-                            return pd.NaT
-                    
-                    # 应用时间解析函数
-                    df[time_col] = df[time_col].apply(parse_time_string)
-                    
-                    # 移除无法解析的时间值
-                    original_count = len(df)
-                    df = df.dropna(subset=[time_col])
-                    valid_count = len(df)
-                    
-                    # 添加数据统计信息
-                    prompt += f"\n数据统计信息：\n"
-                    prompt += f"总记录数：{original_count}\n"
-                    prompt += f"有效时间记录数：{valid_count}\n"
-                    prompt += f"时间解析成功率：{valid_count/original_count:.2%}\n"
-                    
-                    if valid_count > 0:
-                        # 提取月份信息
-                        df['month'] = df[time_col].dt.to_period('M')
-                        
-                        # 获取表中所有唯一的月份并按降序排序
-                        unique_months = sorted(df['month'].unique(), reverse=True)
-                        
-                        # 确保有至少两个月的数据
-                        if len(unique_months) >= 2:
-                            # 选择最近的两个月份
-                            recent_month = unique_months[0]
-                            previous_month = unique_months[1]
-                            
-                            # 筛选两个月的数据
-                            recent_month_data = df[df['month'] == recent_month]
-                            previous_month_data = df[df['month'] == previous_month]
-                            
-                            # 计算案件数量变化
-                            recent_count = len(recent_month_data)
-                            previous_count = len(previous_month_data)
-                            count_change = recent_count - previous_count
-                            count_change_rate = (count_change / previous_count * 100) if previous_count > 0 else 0
-                            
-                            # 格式化月份显示
-                            recent_month_str = recent_month.strftime('%Y-%m')
-                            previous_month_str = previous_month.strftime('%Y-%m')
-                            
-                            prompt += f"\n案件数量变化：\n"
-                            prompt += f"{previous_month_str}案件数：{previous_count}\n"
-                            prompt += f"{recent_month_str}案件数：{recent_count}\n"
-                            prompt += f"变化量：{count_change}\n"
-                            prompt += f"变化率：{count_change_rate:.2f}%\n"
-                            
-                            # 添加案件数量对比数据到结果
-                            result['chart_data'] = {
-                                'monthly_comparison': [
-                                    {'month': previous_month_str, 'count': previous_count},
-                                    {'month': recent_month_str, 'count': recent_count}
-                                ]
-                            }
-                            
-                            # 分析案件大小类别变化
-                            category_col = key_fields['小类名称']
-                            if category_col:
-                                try:
-                                    # 计算两个月的案件类型分布
-                                    previous_category_counts = previous_month_data[category_col].value_counts().head(10).reset_index()
-                                    previous_category_counts.columns = [category_col, 'count']
-                                    
-                                    recent_category_counts = recent_month_data[category_col].value_counts().head(10).reset_index()
-                                    recent_category_counts.columns = [category_col, 'count']
-                                    
-                                    prompt += f"\n{previous_month_str}案件类型分布（前10）：\n{previous_category_counts.to_string(index=False)}\n"
-                                    prompt += f"\n{recent_month_str}案件类型分布（前10）：\n{recent_category_counts.to_string(index=False)}\n"
-                                    
-                                    # 分析类型变化
-                                    previous_categories = set(previous_category_counts[category_col])
-                                    recent_categories = set(recent_category_counts[category_col])
-                                    
-                                    # 新增的类型
-                                    new_categories = recent_categories - previous_categories
-                                    # 减少的类型
-                                    reduced_categories = previous_categories - recent_categories
-                                    
-                                    prompt += f"\n案件类型变化：\n"
-                                    prompt += f"新增类型：{list(new_categories) if new_categories else '无'}\n"
-                                    prompt += f"减少类型：{list(reduced_categories) if reduced_categories else '无'}\n"
-                                    
-                                    # 添加案件大小类别对比数据到结果
-                                    if 'chart_data' not in result:
-                                        result['chart_data'] = {}
-                                    result['chart_data']['case_size_comparison'] = [
-                                        {'type': previous_month_str, 'categories': previous_category_counts.to_dict('records')},
-                                        {'type': recent_month_str, 'categories': recent_category_counts.to_dict('records')}
-                                    ]
-                                    
-                                except Exception as e:
-                                    prompt += f"\n案件类型分析失败：{str(e)}\n"
-                            
-                            # 分析问题变化
-                            problem_col = key_fields['问题描述']
-                            if problem_col:
-                                try:
-                                    # 计算两个月的问题描述分布
-                                    previous_problem_counts = previous_month_data[problem_col].value_counts().head(10).reset_index()
-                                    previous_problem_counts.columns = [problem_col, 'count']
-                                    
-                                    recent_problem_counts = recent_month_data[problem_col].value_counts().head(10).reset_index()
-                                    recent_problem_counts.columns = [problem_col, 'count']
-                                    
-                                    prompt += f"\n{previous_month_str}问题描述分布（前10）：\n{previous_problem_counts.to_string(index=False)}\n"
-                                    prompt += f"\n{recent_month_str}问题描述分布（前10）：\n{recent_problem_counts.to_string(index=False)}\n"
-                                    
-                                    # 分析问题变化
-                                    previous_problems = set(previous_problem_counts[problem_col])
-                                    recent_problems = set(recent_problem_counts[problem_col])
-                                    
-                                    # 新增的问题
-                                    new_problems = recent_problems - previous_problems
-                                    # 减少的问题
-                                    reduced_problems = previous_problems - recent_problems
-                                    
-                                    prompt += f"\n问题变化：\n"
-                                    prompt += f"新增问题：{list(new_problems) if new_problems else '无'}\n"
-                                    prompt += f"减少问题：{list(reduced_problems) if reduced_problems else '无'}\n"
-                                    
-                                    # 添加问题趋势数据到结果
-                                    if 'chart_data' not in result:
-                                        result['chart_data'] = {}
-                                    result['chart_data']['problem_trend'] = [
-                                        {'type': previous_month_str, 'problems': previous_problem_counts.to_dict('records')},
-                                        {'type': recent_month_str, 'problems': recent_problem_counts.to_dict('records')}
-                                    ]
-                                    
-                                except Exception as e:
-                                    prompt += f"\n问题描述分析失败：{str(e)}\n"
-                        else:
-                            prompt += "\n警告：表中数据不足两个月，无法进行月度对比分析。\n"
-                            prompt += f"表中包含的月份：{[m.strftime('%Y-%m') for m in unique_months] if unique_months else '无'}\n"
-                    else:
-                        prompt += "\n警告：所有时间值均无法解析，无法进行月度对比分析。\n"
-                    
-                except Exception as e:
-                    prompt += f"\n时间列转换失败：{str(e)}\n"
-                    # 即使时间处理失败，也要添加基本数据统计
-                    prompt += f"\n基本数据统计：\n总记录数：{len(df)}\n"
-            
-            # 调用豆包大模型
-            analysis_result = call_doubao_api(prompt, result['data_summary'], analysis_type)
-            result['analysis'] = analysis_result
-        
-        # 案件来源分析
-        elif analysis_type == 'source_analysis':
-            # 生成分析提示
-            prompt = f"数据表 {table_name} 包含以下关键字段：\n"
-            prompt += f"- 问题来源：案件的来源渠道\n"
-            prompt += f"- 小类名称：案件的具体类型\n"
-            prompt += f"- 地址描述：案件发生的详细地址\n"
-            prompt += f"数据总量：{len(df)} 条记录\n"
-            
-            # 重点分析字段
-            key_fields = {
-                '问题来源': None,
-                '小类名称': None,
-                '地址描述': None
-            }
-            
-            # 查找关键字段
-            for col in df.columns:
-                col_lower = col.lower()
-                if '来源' in col or '渠道' in col_lower:
-                    key_fields['问题来源'] = col
-                elif '小类' in col or '类型' in col_lower:
-                    key_fields['小类名称'] = col
-                elif '地址' in col or '位置' in col_lower:
-                    key_fields['地址描述'] = col
-            
-            # 分析问题来源
-            source_col = key_fields['问题来源']
-            if source_col:
-                try:
-                    source_counts = df[source_col].value_counts().head(10).reset_index()
-                    source_counts.columns = [source_col, 'count']
-                    prompt += f"\n案件来源分布（前10）：\n{source_counts.to_string(index=False)}"
-                    
-                    # 添加来源分布数据到结果
-                    result['chart_data'] = {
-                        'source': source_counts.to_dict('records')
-                    }
-                except Exception as e:
-                    prompt += f"\n来源分析失败：{str(e)}"
-            
-            # 分析小类名称
-            category_col = key_fields['小类名称']
-            if category_col:
-                try:
-                    category_counts = df[category_col].value_counts().head(10).reset_index()
-                    category_counts.columns = [category_col, 'count']
-                    prompt += f"\n案件类型分布（前10）：\n{category_counts.to_string(index=False)}"
-                except Exception as e:
-                    prompt += f"\n类型分析失败：{str(e)}"
-            
-            # 分析地址描述
-            address_col = key_fields['地址描述']
-            if address_col:
-                try:
-                    address_counts = df[address_col].value_counts().head(10).reset_index()
-                    address_counts.columns = [address_col, 'count']
-                    prompt += f"\n高发地址（前10）：\n{address_counts.to_string(index=False)}"
-                except Exception as e:
-                    prompt += f"\n地址分析失败：{str(e)}"
-            
-            # 调用豆包大模型
-            analysis_result = call_doubao_api(prompt, result['data_summary'], analysis_type)
-            result['analysis'] = analysis_result
-        
-        # 案件类型分析
-        elif analysis_type == 'type_analysis':
-            # 生成分析提示
-            prompt = f"数据表 {table_name} 包含以下关键字段：\n"
-            prompt += f"- 问题类型：案件的问题类型\n"
-            prompt += f"- 大类名称：案件的大类名称\n"
-            prompt += f"- 小类名称：案件的具体类型\n"
-            prompt += f"数据总量：{len(df)} 条记录\n"
-            
-            # 重点分析字段
-            key_fields = {
-                '问题类型': None,
-                '大类名称': None,
-                '小类名称': None
-            }
-            
-            # 查找关键字段
-            for col in df.columns:
-                col_lower = col.lower()
-                if '问题' in col and '类型' in col:
-                    key_fields['问题类型'] = col
-                elif '大类' in col:
-                    key_fields['大类名称'] = col
-                elif '小类' in col or '类型' in col_lower:
-                    key_fields['小类名称'] = col
-            
-            # 分析问题类型
-            problem_type_col = key_fields['问题类型']
-            if problem_type_col:
-                try:
-                    problem_type_counts = df[problem_type_col].value_counts().head(10).reset_index()
-                    problem_type_counts.columns = [problem_type_col, 'count']
-                    prompt += f"\n问题类型分布（前10）：\n{problem_type_counts.to_string(index=False)}"
-                except Exception as e:
-                    prompt += f"\n问题类型分析失败：{str(e)}"
-            
-            # 分析大类名称
-            category_col = key_fields['大类名称']
-            if category_col:
-                try:
-                    category_counts = df[category_col].value_counts().head(10).reset_index()
-                    category_counts.columns = [category_col, 'count']
-                    prompt += f"\n大类名称分布（前10）：\n{category_counts.to_string(index=False)}"
-                except Exception as e:
-                    prompt += f"\n大类分析失败：{str(e)}"
-            
-            # 分析小类名称
-            subcategory_col = key_fields['小类名称']
-            if subcategory_col:
-                try:
-                    subcategory_counts = df[subcategory_col].value_counts().head(10).reset_index()
-                    subcategory_counts.columns = [subcategory_col, 'count']
-                    prompt += f"\n小类名称分布（前10）：\n{subcategory_counts.to_string(index=False)}"
-                    
-                    # 添加小类分布数据到结果
-                    result['chart_data'] = {
-                        'type': subcategory_counts.to_dict('records')
-                    }
-                except Exception as e:
-                    prompt += f"\n小类分析失败：{str(e)}"
-            
-            # 调用豆包大模型
-            analysis_result = call_doubao_api(prompt, result['data_summary'], analysis_type)
-            result['analysis'] = analysis_result
-        
-        # 案件重复分析
-        elif analysis_type == 'duplicate_analysis':
-            # 生成分析提示
-            prompt = f"数据表 {table_name} 包含以下关键字段：\n"
-            prompt += f"- 问题描述：案件的问题描述\n"
-            prompt += f"- 地址描述：案件发生的详细地址\n"
-            prompt += f"数据总量：{len(df)} 条记录\n"
-            
-            # 重点分析字段
-            key_fields = {
-                '问题描述': None,
-                '地址描述': None
-            }
-            
-            # 查找关键字段
-            for col in df.columns:
-                col_lower = col.lower()
-                if '问题' in col and '描述' in col:
-                    key_fields['问题描述'] = col
-                elif '描述' in col and '问题' in col:
-                    key_fields['问题描述'] = col
-                elif '地址' in col and '描述' in col:
-                    key_fields['地址描述'] = col
-                elif '描述' in col and '地址' in col:
-                    key_fields['地址描述'] = col
-                elif '问题' in col and key_fields['问题描述'] is None:
-                    key_fields['问题描述'] = col
-                elif '地址' in col and key_fields['地址描述'] is None:
-                    key_fields['地址描述'] = col
-            
-            # 分析问题描述字段
-            problem_col = key_fields['问题描述']
-            if problem_col:
-                try:
-                    # 计算每个问题描述的出现次数
-                    problem_counts = df[problem_col].value_counts().head(10).reset_index()
-                    problem_counts.columns = [problem_col, 'count']
-                    prompt += f"\n问题描述重复情况（前10）：\n{problem_counts.to_string(index=False)}"
-                    
-                    # 添加问题描述重复数据到结果
-                    if 'chart_data' not in result:
-                        result['chart_data'] = {}
-                    result['chart_data']['problem_duplicates'] = problem_counts.to_dict('records')
-                except Exception as e:
-                    prompt += f"\n问题描述分析失败：{str(e)}"
-            
-            # 分析地址描述字段
-            address_col = key_fields['地址描述']
-            if address_col:
-                try:
-                    # 计算每个地址描述的出现次数
-                    address_counts = df[address_col].value_counts().head(10).reset_index()
-                    address_counts.columns = [address_col, 'count']
-                    prompt += f"\n地址描述重复情况（前10）：\n{address_counts.to_string(index=False)}"
-                    
-                    # 添加地址重复数据到结果
-                    if 'chart_data' not in result:
-                        result['chart_data'] = {}
-                    result['chart_data']['address_duplicates'] = address_counts.to_dict('records')
-                    
-                    # 分析地址描述类型占比（模糊地址vs精准地址）
-                    def is_precise_address(address):
-                        if not address:
-                            return False
-                        address_str = str(address)
-                        # 简单判断：包含具体门牌号、楼栋号等信息的为精准地址
-                        precise_keywords = ['号', '栋', '楼', '室', '店', '铺', '单元', '号楼']
-                        vague_keywords = ['附近', '周边', '旁边', '一带', '附近区域']
-                        
-                        # 检查是否包含模糊关键词
-                        for keyword in vague_keywords:
-                            if keyword in address_str:
-                                return False
-                        
-                        # 检查是否包含精准关键词
-                        for keyword in precise_keywords:
-                            if keyword in address_str:
-                                return True
-                        
-                        # 默认判断
-                        return len(address_str) > 10
-                    
-                    # 统计地址类型
-                    address_types = []
-                    for address in df[address_col].dropna():
-                        if is_precise_address(address):
-                            address_types.append('精准地址')
-                        else:
-                            address_types.append('模糊地址')
-                    
-                    # 计算占比
-                    type_series = pd.Series(address_types)
-                    type_counts = type_series.value_counts().reset_index()
-                    type_counts.columns = ['type', 'count']
-                    
-                    prompt += f"\n地址描述类型占比：\n{type_counts.to_string(index=False)}"
-                    result['chart_data']['address_type_distribution'] = type_counts.to_dict('records')
-                    
-                except Exception as e:
-                    prompt += f"\n地址描述分析失败：{str(e)}"
-            
-            # 如果两个字段都存在，分析它们的组合
-            if problem_col and address_col:
-                try:
-                    # 组合问题描述和地址描述
-                    df['combined_key'] = df[problem_col].astype(str) + ' | ' + df[address_col].astype(str)
-                    # 计算组合键的出现次数
-                    combined_counts = df['combined_key'].value_counts().head(10).reset_index()
-                    combined_counts.columns = ['combined_key', 'count']
-                    prompt += f"\n问题和地址组合重复情况（前10）：\n{combined_counts.to_string(index=False)}"
-                    
-                    # 添加组合重复数据到结果
-                    if 'chart_data' not in result:
-                        result['chart_data'] = {}
-                    result['chart_data']['combined_duplicates'] = combined_counts.to_dict('records')
-                except Exception as e:
-                    prompt += f"\n组合分析失败：{str(e)}"
-            
-            # 分析重复案件违规类型占比
-            if problem_col:
-                try:
-                    # 简单的违规类型分类
-                    def categorize_violation(problem):
-                        if not problem:
-                            return '其他违规'
-                        problem_str = str(problem).lower()
-                        if '店外' in problem_str or '占道' in problem_str:
-                            return '店外经营'
-                        elif '流动' in problem_str or '摊' in problem_str:
-                            return '流动摊点'
-                        else:
-                            return '其他违规'
-                    
-                    # 统计违规类型
-                    violation_types = []
-                    for problem in df[problem_col].dropna():
-                        violation_types.append(categorize_violation(problem))
-                    
-                    # 计算占比
-                    violation_series = pd.Series(violation_types)
-                    violation_counts = violation_series.value_counts().reset_index()
-                    violation_counts.columns = ['type', 'count']
-                    
-                    prompt += f"\n重复案件违规类型占比：\n{violation_counts.to_string(index=False)}"
-                    if 'chart_data' not in result:
-                        result['chart_data'] = {}
-                    result['chart_data']['violation_type_distribution'] = violation_counts.to_dict('records')
-                    
-                except Exception as e:
-                    prompt += f"\n违规类型分析失败：{str(e)}"
-            
-            # 调用豆包大模型
-            analysis_result = call_doubao_api(prompt, result['data_summary'], analysis_type)
-            result['analysis'] = analysis_result
+        if prompt is not None:
+            messages = build_analysis_messages(prompt, result['data_summary'], analysis_type)
+            try:
+                for content in stream_cached_llm_chat(messages, temperature=0.3, max_tokens=3000,
+                                                      force_refresh=force_refresh):
+                    yield format_sse('delta', {'content': content})
+            except LLMError as e:
+                yield format_sse('error', {'error': f"API调用失败: {str(e)}"})
+                return
+        
+        yield format_sse('done', {})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # 关闭nginx缓冲，保证逐段下发
+        }
+    )
+
+# 为已有数据表（重新）聚合数据立方体（管理员专用）
+@app.route('/api/tables/<table_name>/cube', methods=['POST'])
+@admin_required
+def rebuild_case_table_cube(table_name):
+    """为已有数据表（重新）聚合数据立方体，在后台执行"""
+    try:
+        if table_name not in inspect(engine).get_table_names():
+            return jsonify({'error': f'Table {table_name} not found'}), 404
+        
+        job_id = submit_job('case_cube', build_case_table_cube, (table_name,),
+                            {'table_name': table_name}, request.user_id)
+        if not job_id:
+            return jsonify({'error': '后台任务队列已满，请稍后重试'}), 503
+        return jsonify({'job_id': job_id, 'status': 'pending'}), 202
+    except Exception as e:
+        print(f"Error in rebuild_case_table_cube: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+# 为已有数据表（重新）导出快照（管理员专用）
+@app.route('/api/tables/<table_name>/snapshot', methods=['POST'])
+@admin_required
+def rebuild_case_table_snapshot(table_name):
+    """为已有数据表（重新）导出快照文件，在后台执行"""
+    try:
+        if table_name not in inspect(engine).get_table_names():
+            return jsonify({'error': f'Table {table_name} not found'}), 404
+        if pa is None:
+            return jsonify({'error': '服务器未安装pyarrow，不能导出快照'}), 501
+        
+        job_id = submit_job('case_snapshot', build_case_table_snapshot, (table_name,),
+                            {'table_name': table_name}, request.user_id)
+        if not job_id:
+            return jsonify({'error': '后台任务队列已满，请稍后重试'}), 503
+        return jsonify({'job_id': job_id, 'status': 'pending'}), 202
+    except Exception as e:
+        print(f"Error in rebuild_case_table_snapshot: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+# 跨月份重复案件索引API
+@app.route('/api/duplicates/index', methods=['POST'])
+@admin_required
+def rebuild_duplicate_index():
+    """为已有数据表（重新）建立重复案件索引，在后台执行"""
+    try:
+        data = request.json
+        table_name = data.get('table_name')
+        if not table_name:
+            return jsonify({'error': 'Missing table_name'}), 400
+        if table_name not in inspect(engine).get_table_names():
+            return jsonify({'error': f'Table {table_name} not found'}), 404
+        
+        job_id = submit_job('duplicate_index', index_case_table_duplicates, (table_name,),
+                            {'table_name': table_name}, request.user_id)
+        if not job_id:
+            return jsonify({'error': '后台任务队列已满，请稍后重试'}), 503
+        return jsonify({'job_id': job_id, 'status': 'pending'}), 202
+    except Exception as e:
+        print(f"Error in rebuild_duplicate_index: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/duplicates/lookup', methods=['POST'])
+@protected
+def duplicate_lookup():
+    """查询问题描述、地址描述是否在历史数据表中出现过"""
+    try:
+        data = request.json
+        problem = data.get('problem')
+        address = data.get('address')
+        if not problem and not address:
+            return jsonify({'error': 'Missing problem or address'}), 400
         
-        # 转换NaN值为null值，确保JSON响应有效
-        result = convert_nan_to_null(result)
+        matches = lookup_duplicate_index(problem, address, data.get('exclude_table'), int(data.get('limit', 20)))
+        return jsonify({
+            'reported_before': bool(matches),
+            'matches': matches
+        }), 200
+    except Exception as e:
+        print(f"Error in duplicate_lookup: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/duplicates/repeat-rate', methods=['GET'])
+@protected
+def duplicate_repeat_rate_view():
+    """跨月份重复率：数据表中在其他月份出现过的近似重复案件占比"""
+    try:
+        table_name = request.args.get('table_name')
+        if not table_name:
+            return jsonify({'error': 'Missing table_name'}), 400
+        compare_tables = request.args.get('compare_tables')
+        if compare_tables:
+            compare_tables = [name.strip() for name in compare_tables.split(',') if name.strip()]
+        
+        result = duplicate_repeat_rate(table_name, compare_tables or None)
+        if result is None:
+            return jsonify({'error': f'数据表 {table_name} 尚未建立重复案件索引'}), 404
         return jsonify(result), 200
     except Exception as e:
+        print(f"Error in duplicate_repeat_rate: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+# 地名库API
+@app.route('/api/gazetteer/import', methods=['POST'])
+@admin_required
+def import_gazetteer():
+    """导入地名库文件（xlsx或csv），用于空间分析的地址坐标匹配"""
+    try:
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file part'}), 400
+        
+        file = request.files['file']
+        file_extension = os.path.splitext(file.filename)[1].lower()
+        if file_extension == '.xlsx':
+            df = pd.read_excel(file)
+        elif file_extension == '.csv':
+            df = pd.read_csv(file)
+        else:
+            return jsonify({'error': 'Only xlsx and csv files are allowed'}), 400
+        
+        try:
+            imported = import_address_gazetteer(df)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'message': 'Gazetteer imported successfully', 'imported': imported}), 200
+    except Exception as e:
+        print(f"Error in import_gazetteer: {str(e)}")
+        import traceback
+        traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
 # CMS栏目相关API
@@ -2358,8 +5209,7 @@ def natural_language_query():
             return jsonify({'error': 'Missing natural_language or table_name'}), 400
         
         # 从数据库读取表结构信息
-        df = pd.read_sql_table(table_name, engine)
-        columns = df.columns.tolist()
+        columns = get_case_table_columns(table_name)
         
         # 构建大模型提示
         prompt = f"请将以下自然语言查询转换为SQL语句，针对数据表 '{table_name}'。\n"
@@ -2375,52 +5225,21 @@ def natural_language_query():
         prompt += "5. 直接返回最终的SQL语句，不要有任何前缀或后缀\n"
         
         # 调用大模型API
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {API_KEY}'
-        }
-        
-        payload = {
-            "model": MODEL,
-            "messages": [
-                {
-                    "role": "system",
-                    "content": "你是一个专业的SQL生成助手，擅长将自然语言查询转换为标准的SQL语句。请根据提供的数据表结构和自然语言查询，生成正确的SQL语句。"
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            "temperature": 0.3,
-            "max_tokens": 1000
-        }
-        
-        # 调用API，添加重试机制
-        max_retries = 3
-        retry_delay = 5
-        generated_sql = None
+        messages = [
+            {
+                "role": "system",
+                "content": "你是一个专业的SQL生成助手，擅长将自然语言查询转换为标准的SQL语句。请根据提供的数据表结构和自然语言查询，生成正确的SQL语句。"
+            },
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
         
-        for attempt in range(max_retries):
-            try:
-                response = requests.post(
-                    API_URL, 
-                    headers=headers, 
-                    json=payload, 
-                    timeout=(10, 300)  # 连接超时10秒，读取超时300秒
-                )
-                response.raise_for_status()
-                result = response.json()
-                generated_sql = result['choices'][0]['message']['content'].strip()
-                break
-            except requests.exceptions.RequestException as e:
-                if attempt < max_retries - 1:
-                    print(f"API调用失败，{retry_delay}秒后重试... (尝试 {attempt+1}/{max_retries})")
-                    import time
-                    time.sleep(retry_delay)
-                    retry_delay *= 2  # 指数退避
-                else:
-                    raise Exception(f"大模型API调用失败，请稍后重试: {str(e)}")
+        try:
+            generated_sql = llm_client.chat(messages, temperature=0.3, max_tokens=1000).strip()
+        except LLMError as e:
+            raise Exception(f"大模型API调用失败，请稍后重试: {str(e)}")
         
         if not generated_sql:
             return jsonify({'error': '大模型未返回有效的SQL语句'}), 500
@@ -2958,4 +5777,6 @@ def serve_uploaded_file(filename):
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
 if __name__ == '__main__':
+    fail_orphaned_jobs()
+    prune_finished_jobs(force=True)
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,171 @@
+"""考核接口内存基准：在合成案件表上比较 /api/assess 旧实现与当前实现的峰值内存
+
+旧实现：整表读取后 df.to_dict('records')，考核方案由记录列表重建DataFrame计分，通用计分逐条遍历字典；
+当前实现：只读取计分用到的字段，直接在DataFrame上计分（execution=pandas），或使用默认的 auto 执行方式。
+
+每个场景在独立的子进程中运行，报告该进程在导入后端、写入数据之后的峰值RSS增量。
+后端连接环境变量 BENCH_DATABASE_URL 指定的临时数据库（默认为系统临时目录下的SQLite文件），
+不会连接后端配置的MySQL；运行时创建数据表 bench_assess_cases，结束后删除。
+SQLite不支持MySQL下推计分用到的函数，只在 BENCH_DATABASE_URL 为MySQL时比较 auto 执行方式。
+
+用法：BENCH_DATABASE_URL=mysql+pymysql://用户:密码@主机/临时库 python bench_assess_memory.py [行数，默认100000]
+"""
+import sys
+import time
+import resource
+import datetime
+import os
+import tempfile
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+BENCH_SQLITE_PATH = os.path.join(tempfile.gettempdir(), 'bench_assess_memory.sqlite')
+BENCH_DATABASE_URL = os.environ.get('BENCH_DATABASE_URL') or f'sqlite:///{BENCH_SQLITE_PATH}'
+# 后端按 DATABASE_URL 建立数据库连接；在导入后端之前设置，spawn的子进程继承该环境变量
+os.environ['DATABASE_URL'] = BENCH_DATABASE_URL
+
+BENCH_TABLE = 'bench_assess_cases'
+BENCH_TEXT_COLUMNS = 40  # 模拟导出文件中大量的长文本字段
+BENCH_DEPARTMENTS = ['市容环卫中心', '其他部门']  # 配置了考核方案的单位和使用通用计分的单位
+
+
+def build_cases(rows):
+    """生成合成案件表：考核用到的字段加上若干长文本字段"""
+    rng = np.random.default_rng(0)
+    report_time = pd.Timestamp('2025-01-01') + pd.to_timedelta(rng.integers(0, 90 * 86400, rows), unit='s')
+    departments = ['环卫东片区', '环卫北片区', '环卫南片区', '环卫西片区', '环卫中片区', '执法东片区', '园林东片区', '人民公园']
+    df = pd.DataFrame({
+        '处置部门': rng.choice(departments, rows),
+        '当前阶段名称': rng.choice(['结案', '挂账', '处置中'], rows),
+        '结案时间': report_time + pd.to_timedelta(rng.integers(0, 10 * 86400, rows), unit='s'),
+        '捆绑处置截止时间': report_time + pd.to_timedelta(rng.integers(0, 7 * 86400, rows), unit='s'),
+        '延期次数': rng.choice([0, 1, 2], rows),
+        '返工次数': rng.choice(['是', '否'], rows),
+        '状态': rng.choice(['已结案', '处置中'], rows),
+        '创建时间': report_time.strftime('%Y-%m-%d %H:%M:%S'),
+        '处理时间': (report_time + pd.to_timedelta(rng.integers(0, 3 * 86400, rows), unit='s')).strftime('%Y-%m-%d %H:%M:%S')
+    })
+    for i in range(BENCH_TEXT_COLUMNS):
+        df[f'描述{i}'] = [f'案件{j}的补充说明，' * 8 for j in rng.integers(0, rows, rows)]
+    return df
+
+
+def legacy_generic_score(cases):
+    """旧的通用计分：逐条遍历案件字典"""
+    total_cases = len(cases)
+    closed_cases = 0
+    total_handle_hours = 0
+    valid_cases = 0
+    for case in cases:
+        status = case.get('status') or case.get('状态')
+        if status and '已结案' in str(status):
+            closed_cases += 1
+        create_time = case.get('create_time') or case.get('创建时间')
+        handle_time = case.get('handle_time') or case.get('处理时间') or case.get('完成时间')
+        if create_time and handle_time:
+            try:
+                if isinstance(create_time, str):
+                    create_time = datetime.datetime.strptime(create_time, '%Y-%m-%d %H:%M:%S')
+                if isinstance(handle_time, str):
+                    handle_time = datetime.datetime.strptime(handle_time, '%Y-%m-%d %H:%M:%S')
+                total_handle_hours += (handle_time - create_time).total_seconds() / 3600
+                valid_cases += 1
+            except Exception:
+                pass
+    return {'total_cases': total_cases, 'closed_cases': closed_cases,
+            'avg_handle_hours': round(total_handle_hours / valid_cases, 2) if valid_cases else 0}
+
+
+def run_legacy(department):
+    """旧实现：整表读取 + to_dict('records')"""
+    import app as backend
+    df = pd.read_sql_table(BENCH_TABLE, backend.engine)
+    cases = df.to_dict('records')
+    plan = backend.assessment_registry.get(department)
+    if plan:
+        plan.run(pd.DataFrame(cases))
+    else:
+        legacy_generic_score(cases)
+
+
+def run_current(department, execution):
+    """当前实现：通过 /api/assess 接口计分"""
+    import app as backend
+    client = backend.app.test_client()
+    headers = {'Authorization': 'Bearer ' + backend.generate_token(1, 'admin', 'admin')}
+    response = client.post('/api/assess', headers=headers,
+                           json={'table_name': BENCH_TABLE, 'department': department, 'execution': execution})
+    if response.status_code != 200:
+        raise RuntimeError(response.get_json())
+
+
+def peak_rss_mb():
+    """当前进程的峰值RSS（MB）
+
+    spawn子进程的 ru_maxrss 会继承父进程的峰值，优先读取 /proc/self/status 中的 VmHWM（exec后重新计算）。
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Linux下ru_maxrss的单位为KB
+
+
+def measure(target, args, queue):
+    """在子进程中执行一个场景，返回（峰值RSS增量MB, 耗时秒）"""
+    import app  # noqa: F401  导入后端（建立数据库连接、加载考核方案）计入基线
+    baseline = peak_rss_mb()
+    start = time.time()
+    try:
+        target(*args)
+    except Exception as e:
+        queue.put(('error', str(e)))
+        return
+    elapsed = time.time() - start
+    queue.put(('ok', (peak_rss_mb() - baseline, elapsed)))
+
+
+def run_scenario(target, args):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=measure, args=(target, args, queue))
+    process.start()
+    status, result = queue.get()
+    process.join()
+    if status != 'ok':
+        raise RuntimeError(f"场景执行失败: {result}")
+    return result
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    import app as backend
+    executions = ['pandas', 'auto'] if BENCH_DATABASE_URL.startswith('mysql') else ['pandas']
+
+    print(f"写入 {rows} 行合成案件到数据表 {BENCH_TABLE}（{backend.engine.url.render_as_string(hide_password=True)}） ...")
+    build_cases(rows).to_sql(BENCH_TABLE, backend.engine, if_exists='replace', index=False, chunksize=5000)
+    backend.bump_table_generation(BENCH_TABLE)
+
+    try:
+        print(f"{'考核单位':<12}{'实现':<24}{'峰值RSS增量(MB)':>16}{'耗时(秒)':>10}")
+        for department in BENCH_DEPARTMENTS:
+            scenarios = [('旧实现(to_dict)', run_legacy, (department,))]
+            scenarios += [(f'当前实现({execution})', run_current, (department, execution)) for execution in executions]
+            for label, target, args in scenarios:
+                peak_mb, elapsed = run_scenario(target, args)
+                print(f"{department:<12}{label:<24}{peak_mb:>16.1f}{elapsed:>10.2f}")
+    finally:
+        with backend.engine.begin() as conn:
+            conn.execute(backend.text(f"DROP TABLE IF EXISTS {BENCH_TABLE}"))
+        backend.bump_table_generation(BENCH_TABLE)
+        backend.engine.dispose()
+        if 'BENCH_DATABASE_URL' not in os.environ and os.path.exists(BENCH_SQLITE_PATH):
+            os.remove(BENCH_SQLITE_PATH)
+
+
+if __name__ == '__main__':
+    main()